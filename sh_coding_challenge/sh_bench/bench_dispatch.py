@@ -0,0 +1,105 @@
+# End to end relay delivery benchmark for the SH challenge
+# Requires Python3
+#
+# Starts fake_relay.py on localhost, routes N recipients with get_routes(),
+# and delivers the routes twice: one at a time over a single keep-alive
+# connection (a hand-rolled serial sender), then with
+# dispatcher_lib.RelayDispatcher.  Reports wall time, routes/sec and retries.
+#
+# Usage:
+#   python bench_dispatch.py [--recipients 100 1000 10000] [--latency-ms 2]
+#                            [--fail-rate 0.0]
+
+
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Server launch helpers shared with the throughput benchmark
+from bench_servers import HOST, SERVER_DIR, free_port, wait_for_port
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+import dispatcher_lib
+import router_lib
+
+DEFAULT_RECIPIENTS = (100, 1000, 10000)
+
+MESSAGE = "SH Rocks"
+
+
+def send_serial(port, routes):
+    """
+    Deliver 'routes' one at a time over one keep-alive connection.
+
+    @returns int - Routes that got a 200 response
+
+    """
+    conn      = http.client.HTTPConnection(HOST, port)
+    delivered = 0
+
+    for route in routes:
+        body = json.dumps({"message": MESSAGE, "recipients": route['recipients']})
+        conn.request('POST', dispatcher_lib.RELAY_PATH, body=body,
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        delivered += (response.status == 200)
+
+    conn.close()
+
+    return delivered
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark relay delivery")
+    parser.add_argument('--recipients', type=int, nargs='+', default=DEFAULT_RECIPIENTS)
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    port  = free_port()
+    relay = subprocess.Popen([sys.executable, 'fake_relay.py', '--host', HOST,
+                              '--port', str(port), '--latency-ms', str(args.latency_ms),
+                              '--fail-rate', str(args.fail_rate)],
+                             cwd=BENCH_DIR, stdout=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(port)
+
+        print("%10s %7s %-10s %10s %10s %9s %8s"
+              % ('recipients', 'routes', 'sender', 'seconds', 'routes/s', 'failed', 'retries'))
+
+        for num_recipients in args.recipients:
+            routes = router_lib.get_routes(["+1555%07d" % index
+                                            for index in range(num_recipients)])
+
+            start     = time.perf_counter()
+            delivered = send_serial(port, routes)
+            serial    = time.perf_counter() - start
+
+            print("%10d %7d %-10s %10.3f %10.0f %9d %8s"
+                  % (num_recipients, len(routes), 'serial', serial,
+                     len(routes) / serial, len(routes) - delivered, '-'))
+
+            start   = time.perf_counter()
+            results = dispatcher_lib.dispatch_routes(
+                MESSAGE, routes, resolver=dispatcher_lib.localhost_resolver(port))
+            elapsed = time.perf_counter() - start
+
+            failed  = sum(result.error is not None for result in results)
+            retries = sum(result.attempts - 1 for result in results)
+
+            print("%10d %7d %-10s %10.3f %10.0f %9d %8d   (%.1fx)"
+                  % (num_recipients, len(routes), 'dispatcher', elapsed,
+                     len(routes) / elapsed, failed, retries, serial / elapsed))
+
+    finally:
+        relay.terminate()
+        relay.wait()
@@ -0,0 +1,78 @@
+# Compare the pure-Python and NumPy get_routes() backends
+# Requires Python3 and NumPy
+#
+# Times get_routes() on the same NumPy-packed recipients with each backend,
+# for N from 10 to 10^6, and reports the smallest N from which the NumPy
+# backend stays faster.  router_lib.NUMPY_MIN_RECIPIENTS should be set near
+# that crossover.
+#
+# Usage:
+#   python bench_numpy_binner.py [--max-n 1000000]
+
+
+import argparse
+import sys
+
+# Also puts sh_server on sys.path
+from bench_router_lib import time_call
+
+import recipients_lib
+import router_lib
+
+# Sizes between powers of 10 too, to locate the crossover more precisely
+STEPS = (1, 2, 5)
+
+
+def sizes_up_to(max_n):
+    """
+    Return N = 10, 20, 50, 100, 200, 500, ... up to and including 'max_n'.
+
+    """
+    sizes = []
+    decade = 10
+    while decade <= max_n:
+        sizes.extend(step * decade for step in STEPS if step * decade <= max_n)
+        decade *= 10
+
+    return sizes
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the get_routes() backends")
+    parser.add_argument('--max-n', type=int, default=10 ** 6)
+    args = parser.parse_args()
+
+    if recipients_lib.import_numpy() is None:
+        print("NumPy is not installed")
+        sys.exit(1)
+
+    print("%9s %14s %14s %8s" % ('N', 'python usec', 'numpy usec', 'speedup'))
+
+    crossover = None
+
+    for n in sizes_up_to(args.max_n):
+        packed = recipients_lib.PackedRecipients.from_strings(
+            ["+1%010d" % index for index in range(n)])
+
+        timings = {}
+        for backend in ('python', 'numpy'):
+            route = lambda items: router_lib.get_routes(items, backend=backend)
+            route(packed)
+            timings[backend] = time_call(route, packed)
+
+        speedup = timings['python'] / timings['numpy']
+        print("%9d %14.2f %14.2f %7.2fx"
+              % (n, timings['python'] * 1e6, timings['numpy'] * 1e6, speedup))
+
+        if speedup > 1:
+            crossover = crossover or n
+        else:
+            crossover = None
+
+    print()
+    if crossover:
+        print("NumPy backend is faster from N = %d (NUMPY_MIN_RECIPIENTS = %d)"
+              % (crossover, router_lib.NUMPY_MIN_RECIPIENTS))
+    else:
+        print("NumPy backend is not faster at the largest N tested")
@@ -0,0 +1,242 @@
+# Microbenchmark and scaling suite for the SH challenge routing code
+# Requires Python3
+#
+# Times grouper(), div_mod(), their lazy versions igrouper() and idiv_mod(),
+# binner() and get_routes() for N = 1 .. 10^6 recipients, measures their peak
+# memory with tracemalloc, writes the results as JSON and compares them
+# against a stored baseline.  Lazy results are consumed in full, so the
+# figures are the cost of the whole split.
+#
+# Usage:
+#   python bench_router_lib.py [--max-n 1000000] [--output results.json]
+#   python bench_router_lib.py --save-baseline
+#   python bench_router_lib.py --compare [--threshold 0.25]
+#
+# --compare exits with status 1 if any time or peak memory figure is more than
+# 'threshold' (a fraction) above the baseline.
+
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR  = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, '..', 'sh_server')
+sys.path.insert(0, SERVER_DIR)
+
+import itertools_ext_lib
+import router_lib
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline_router_lib.json')
+
+DEFAULT_MAX_N     = 10 ** 6
+DEFAULT_THRESHOLD = 0.25
+
+# Each timing is the best of this many repeats...
+REPEATS = 5
+
+# ...of a loop that runs for at least this many seconds
+MIN_LOOP_SEC = 0.02
+
+# Regressions smaller than these are treated as noise
+MIN_TIME_DELTA_SEC = 1e-6
+MIN_MEMORY_DELTA   = 4096
+
+
+
+def consume_idiv_mod(items):
+    """
+    Run idiv_mod() to the end, as div_mod() does.
+
+    @returns (list, tuple) - The chunks and the remainder
+
+    """
+    chunks = itertools_ext_lib.idiv_mod(items, 25)
+
+    return list(chunks), chunks.remainder
+
+
+# Functions under test, each called with the list of N recipients.  binner()
+# returns lazy ChunkView sequences; each is turned into a list of chunks.
+BENCHMARKS = {
+    'grouper':    lambda items: itertools_ext_lib.grouper(items, 25),
+    'div_mod':    lambda items: itertools_ext_lib.div_mod(items, 25),
+    'igrouper':   lambda items: list(itertools_ext_lib.igrouper(items, 25)),
+    'idiv_mod':   consume_idiv_mod,
+    'binner':     lambda items: [list(view) for view in router_lib.binner(items)],
+    'get_routes': lambda items: router_lib.get_routes(items),
+}
+
+
+def sizes_up_to(max_n):
+    """
+    Return N = 1, 10, 100, ... up to and including 'max_n'.
+
+    """
+    sizes = []
+    n = 1
+    while n <= max_n:
+        sizes.append(n)
+        n *= 10
+
+    return sizes
+
+
+def time_call(func, items):
+    """
+    Best-of-REPEATS time of one call of func(items), in seconds.
+
+    """
+    # Find a loop count that runs for at least MIN_LOOP_SEC
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(items)
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= MIN_LOOP_SEC:
+            break
+        loops *= 10
+
+    best = elapsed
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(items)
+        best = min(best, time.perf_counter() - start)
+
+    return best / loops
+
+
+def peak_memory(func, items):
+    """
+    Peak bytes allocated by func(items), as traced by tracemalloc.
+
+    """
+    tracemalloc.start()
+    try:
+        result = func(items)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    del result
+    return peak
+
+
+def run_benchmarks(max_n, names=None):
+    """
+    Run every benchmark in 'names' (default: all) for N up to 'max_n'.
+
+    @returns dict - {"python": ..., "results": {name: {N: {"sec": ...,
+                                                           "peak_bytes": ...}}}}
+
+    """
+    names = names or sorted(BENCHMARKS)
+    results = {name: {} for name in names}
+
+    for n in sizes_up_to(max_n):
+        items = ["+1%010d" % index for index in range(n)]
+
+        for name in names:
+            func = BENCHMARKS[name]
+
+            # Warm any caches, so steady-state cost is measured
+            func(items)
+
+            results[name][str(n)] = {
+                'sec':        time_call(func, items),
+                'peak_bytes': peak_memory(func, items),
+            }
+
+    return {
+        'python':  platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    List every figure in 'current' more than 'threshold' above 'baseline'.
+
+    @returns list of str - One message per regression
+
+    """
+    regressions = []
+
+    for name, by_n in current['results'].items():
+        for n, figures in by_n.items():
+            base = baseline['results'].get(name, {}).get(n)
+            if base is None:
+                continue
+
+            for key, min_delta in (('sec', MIN_TIME_DELTA_SEC),
+                                   ('peak_bytes', MIN_MEMORY_DELTA)):
+                limit = base[key] * (1 + threshold)
+                if figures[key] > limit and figures[key] - base[key] > min_delta:
+                    regressions.append("%s N=%s %s: %.6g > baseline %.6g (+%d%%)"
+                                       % (name, n, key, figures[key], base[key],
+                                          100 * (figures[key] / base[key] - 1)))
+
+    return regressions
+
+
+def print_results(current):
+    """
+    Print a results table.
+
+    """
+    print("%-12s %9s %14s %14s" % ('function', 'N', 'usec/call', 'peak bytes'))
+
+    for name, by_n in sorted(current['results'].items()):
+        for n, figures in sorted(by_n.items(), key=lambda item: int(item[0])):
+            print("%-12s %9s %14.2f %14d"
+                  % (name, n, figures['sec'] * 1e6, figures['peak_bytes']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the SH routing code")
+    parser.add_argument('--max-n', type=int, default=DEFAULT_MAX_N)
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS))
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--compare', action='store_true',
+                        help="fail on regressions against the baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed regression, as a fraction of the baseline")
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.max_n, args.benchmarks)
+    print_results(current)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(current, output_file, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(current, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print()
+            for message in regressions:
+                print("FAIL: %s" % message)
+            sys.exit(1)
+
+        print()
+        print("PASS: no regressions beyond %d%% of %s"
+              % (100 * args.threshold, args.baseline))
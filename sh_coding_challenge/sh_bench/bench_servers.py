@@ -0,0 +1,202 @@
+# Compare the Flask and asyncio SH challenge servers
+# Requires Python3
+#
+# Starts each server on localhost, drives it with concurrent keep-alive
+# clients, and reports requests/sec and latency percentiles.
+#
+# Usage:
+#   python bench_servers.py [--clients 16] [--requests 200] [--recipients 30]
+#                           [--workers N] [--servers flask asyncio ...]
+
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sh_server')
+
+HOST = '127.0.0.1'
+
+# Commands starting each server on HOST:<port>
+SERVER_COMMANDS = {
+    'flask':   [sys.executable, '-c',
+                'import sys, sh_server; '
+                'sh_server.app.run(sys.argv[1], int(sys.argv[2]), threaded=True)',
+                HOST, '{port}'],
+    'asyncio': [sys.executable, 'sh_async_server.py', '--host', HOST, '--port', '{port}'],
+    'flask-prefork':   [sys.executable, 'sh_server.py', '--host', HOST,
+                        '--port', '{port}', '--workers', '{workers}'],
+    'asyncio-prefork': [sys.executable, 'sh_async_server.py', '--host', HOST,
+                        '--port', '{port}', '--workers', '{workers}'],
+}
+
+
+def free_port():
+    """
+    Return a localhost TCP port that is currently unused.
+
+    """
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(name, port, workers, timeout=10):
+    """
+    Start server 'name' on 'port' and wait until it accepts connections.
+
+    @param int $workers - Worker processes, for the prefork servers
+
+    @returns subprocess.Popen
+
+    """
+    command = [arg.format(port=port, workers=workers) for arg in SERVER_COMMANDS[name]]
+    process = subprocess.Popen(command, cwd=SERVER_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(port, timeout)
+    except RuntimeError:
+        process.kill()
+        raise RuntimeError("%s server did not start on port %d" % (name, port))
+
+    return process
+
+
+def wait_for_port(port, timeout=10):
+    """
+    Wait until something accepts connections on HOST:'port'.
+
+    Raises RuntimeError after 'timeout' seconds.
+
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise RuntimeError("Nothing accepts connections on port %d" % port)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+
+    """
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_client(port, body, num_requests, latencies, errors):
+    """
+    Send 'num_requests' requests over one keep-alive connection, appending
+    each latency (seconds) to 'latencies'.
+
+    """
+    headers = {'Content-Type': 'application/json'}
+    conn = http.client.HTTPConnection(HOST, port)
+
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        try:
+            conn.request('POST', '/route', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            conn.close()
+            conn = http.client.HTTPConnection(HOST, port)
+            continue
+
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(1)
+
+    conn.close()
+
+
+def bench_server(name, num_clients, num_requests, num_recipients, workers):
+    """
+    Benchmark one server.
+
+    @returns dict of results
+
+    """
+    payload = {'message': 'SH Rocks',
+               'recipients': ["+1555555%04d" % index for index in range(num_recipients)]}
+    body = json.dumps(payload).encode('utf-8')
+
+    port = free_port()
+    process = start_server(name, port, workers)
+
+    try:
+        # Warm up
+        run_client(port, body, 10, [], [])
+
+        latencies = []
+        errors    = []
+        threads = [threading.Thread(target=run_client,
+                                    args=(port, body, num_requests, latencies, errors))
+                   for _ in range(num_clients)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies.sort()
+
+    return {
+        'server':       name,
+        'requests':     len(latencies),
+        'errors':       len(errors),
+        'requests_sec': len(latencies) / elapsed,
+        'p50_ms':       percentile(latencies, 0.50) * 1000,
+        'p99_ms':       percentile(latencies, 0.99) * 1000,
+        'max_ms':       (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the SH challenge servers")
+    parser.add_argument('--clients',    type=int, default=16,
+                        help="concurrent keep-alive connections")
+    parser.add_argument('--requests',   type=int, default=200,
+                        help="requests per connection")
+    parser.add_argument('--recipients', type=int, default=30,
+                        help="recipients per request")
+    parser.add_argument('--workers',    type=int, default=os.cpu_count(),
+                        help="worker processes for the prefork servers")
+    parser.add_argument('--servers', nargs='+', default=sorted(SERVER_COMMANDS),
+                        choices=sorted(SERVER_COMMANDS))
+    args = parser.parse_args()
+
+    print("%-16s %9s %7s %12s %9s %9s %9s"
+          % ('server', 'requests', 'errors', 'requests/s', 'p50 ms', 'p99 ms', 'max ms'))
+
+    for name in args.servers:
+        result = bench_server(name, args.clients, args.requests, args.recipients,
+                              args.workers)
+        print("%-16s %9d %7d %12.1f %9.2f %9.2f %9.2f"
+              % (result['server'], result['requests'], result['errors'],
+                 result['requests_sec'], result['p50_ms'], result['p99_ms'],
+                 result['max_ms']))
@@ -0,0 +1,183 @@
+# Cold start benchmark for the SH challenge servers
+# Requires Python3
+#
+# Measures the import time of each server module with 'python -X importtime'
+# and lists its slowest imports, then starts each server with and without
+# --prewarm and times how long it takes to accept connections and to answer
+# its first requests.
+#
+# Usage:
+#   python bench_startup.py [--runs 5] [--budget-ms 350]
+#
+# Exits with status 1 if the median import time of sh_server is above the
+# budget.
+
+
+import argparse
+import http.client
+import json
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# Server launch helpers shared with the throughput benchmark
+from bench_servers import HOST, SERVER_DIR, free_port
+
+DEFAULT_RUNS      = 5
+DEFAULT_BUDGET_MS = 350
+
+# Slowest imports listed per module
+TOP_IMPORTS = 10
+
+# Server scripts started by the first request benchmark
+SERVER_SCRIPTS = ('sh_server.py', 'sh_async_server.py')
+
+# 'import time:      self [us] |   cumulative |   name' lines of -X importtime
+IMPORTTIME_LINE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)$')
+
+# First requests sent to a freshly started server: (name, payload)
+FIRST_REQUESTS = (
+    ('valid',   {"message": "SH Rocks",
+                 "recipients": ["+1555%07d" % index for index in range(43)]}),
+    ('invalid', {"message": "SH Rocks", "recipients": []}),
+    ('packed',  {"message": "SH Rocks",
+                 "recipients": ["+1555%07d" % index for index in range(10000)]}),
+)
+
+
+def import_times(statement):
+    """
+    Run 'statement' in a fresh interpreter under -X importtime.
+
+    @returns dict - {module name: cumulative import time in us}
+
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=SERVER_DIR, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            imports[match.group(4)] = int(match.group(2))
+
+    return imports
+
+
+def measure_import(module, startup_modules=()):
+    """
+    Import 'module' in a fresh interpreter under -X importtime.
+
+    @param set $startup_modules - Modules imported by the interpreter itself
+                                  (e.g. site), left out of 'imports'
+
+    @returns (total_us, imports)
+        total_us - cumulative import time of 'module' in microseconds
+        imports  - {name: cumulative us} of every module imported on the way
+
+    """
+    imports = import_times('import ' + module)
+
+    return imports[module], {name: time_us for name, time_us in imports.items()
+                             if name not in startup_modules}
+
+
+def time_first_requests(script, prewarm):
+    """
+    Start 'script' and time its startup and first requests.
+
+    @returns dict - 'ready' (launch until a connection is accepted) and the
+                    latency of each FIRST_REQUESTS entry, in seconds
+
+    """
+    port    = free_port()
+    command = [sys.executable, script, '--host', HOST, '--port', str(port)]
+    if prewarm:
+        command.append('--prewarm')
+
+    start   = time.perf_counter()
+    process = subprocess.Popen(command, cwd=SERVER_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while True:
+            try:
+                conn = http.client.HTTPConnection(HOST, port)
+                conn.connect()
+                break
+            except OSError:
+                if process.poll() is not None or time.perf_counter() - start > 30:
+                    raise RuntimeError("%s did not start" % script)
+                time.sleep(0.005)
+
+        timings = {'ready': time.perf_counter() - start}
+
+        for name, payload in FIRST_REQUESTS:
+            body = json.dumps(payload)
+
+            request_start = time.perf_counter()
+            conn.request('POST', '/route', body=body,
+                         headers={'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            timings[name] = time.perf_counter() - request_start
+
+        conn.close()
+
+    finally:
+        process.terminate()
+        process.wait()
+
+    return timings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark server cold start")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="maximum median import time of sh_server")
+    args = parser.parse_args()
+
+    #
+    # Import time
+    #
+    medians = {}
+    startup_modules = set(import_times('pass'))
+
+    for module in ('sh_server', 'sh_async_server'):
+        runs = [measure_import(module, startup_modules) for _ in range(args.runs)]
+        medians[module] = statistics.median(total for total, imports in runs) / 1000
+
+        print("%s: median import time %.1f ms over %d runs"
+              % (module, medians[module], args.runs))
+
+        imports = runs[-1][1]
+        for name in sorted(imports, key=imports.get, reverse=True)[1:TOP_IMPORTS + 1]:
+            print("    %-40s %8.1f ms" % (name, imports[name] / 1000))
+        print()
+
+    #
+    # Time to ready and to first responses
+    #
+    columns = ('ready',) + tuple(name for name, payload in FIRST_REQUESTS)
+
+    print("%-20s %-8s" % ('server', 'prewarm') +
+          ''.join("%12s" % (column + ' ms') for column in columns))
+
+    for script in SERVER_SCRIPTS:
+        for prewarm in (False, True):
+            timings = time_first_requests(script, prewarm)
+            print("%-20s %-8s" % (script, 'yes' if prewarm else 'no') +
+                  ''.join("%12.1f" % (timings[column] * 1000) for column in columns))
+
+    print()
+    if medians['sh_server'] > args.budget_ms:
+        print("FAIL: sh_server imports in %.1f ms, budget is %.1f ms"
+              % (medians['sh_server'], args.budget_ms))
+        sys.exit(1)
+
+    print("PASS: sh_server imports in %.1f ms, budget is %.1f ms"
+          % (medians['sh_server'], args.budget_ms))
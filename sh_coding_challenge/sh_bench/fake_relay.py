@@ -0,0 +1,128 @@
+# Localhost stand-in for the SH relays
+# Requires Python3
+#
+# Accepts POST /send {"message": ..., "recipients": [...]} on keep-alive
+# HTTP/1.1 connections and answers {"accepted": <number of recipients>}
+# after a simulated transaction latency.  A fraction of requests can be
+# failed with 503 to exercise the dispatcher's retries.  Serves every relay
+# IP from one port; point the dispatcher at it with
+# dispatcher_lib.localhost_resolver(port).
+#
+# Usage:
+#   python fake_relay.py [--port 8080] [--latency-ms 2] [--fail-rate 0.0]
+
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+
+BENCH_DIR  = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, '..', 'sh_server')
+sys.path.insert(0, SERVER_DIR)
+
+import dispatcher_lib
+import sh_async_server
+
+DEFAULT_HOST       = '127.0.0.1'
+DEFAULT_LATENCY_MS = 2.0
+
+
+class FakeRelay:
+    """
+    Fake relay server state: latency, failure injection and counters.
+
+    """
+
+    def __init__(self, latency=DEFAULT_LATENCY_MS / 1000, fail_rate=0.0, seed=None):
+        self.latency    = latency
+        self.fail_rate  = fail_rate
+        self.random     = random.Random(seed)
+
+        self.requests   = 0
+        self.failures   = 0
+        self.recipients = 0
+
+    def handle(self, method, path, body):
+        """
+        @returns (int, bytes) - HTTP status code and JSON response body
+
+        """
+        if method != 'POST' or path != dispatcher_lib.RELAY_PATH:
+            return 404, sh_async_server.encode_json({"error": "Not found: %s" % path})
+
+        self.requests += 1
+
+        if self.fail_rate and self.random.random() < self.fail_rate:
+            self.failures += 1
+            return 503, sh_async_server.encode_json({"error": "Injected failure"})
+
+        try:
+            num_recipients = len(json.loads(body)['recipients'])
+        except (ValueError, KeyError, TypeError):
+            return 400, sh_async_server.encode_json({"error": "Bad request"})
+
+        self.recipients += num_recipients
+
+        return 200, sh_async_server.encode_json({"accepted": num_recipients})
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await sh_async_server.read_request(reader, writer)
+                except sh_async_server.HTTPError:
+                    break
+
+                if request is None:
+                    break
+
+                method, path, query, version, headers, body = request
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                status, response_body = self.handle(method, path, body)
+                writer.write(sh_async_server.build_response(status, response_body, True))
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=dispatcher_lib.RELAY_PORT):
+        """
+        Start serving.  Port 0 picks a free port.
+
+        @returns asyncio.Server - Its sockets give the bound port
+
+        """
+        return await asyncio.start_server(self.handle_connection, host, port,
+                                          limit=sh_async_server.MAX_HEADER_BYTES)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Fake SH relay")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=dispatcher_lib.RELAY_PORT)
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS)
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help="fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    relay = FakeRelay(args.latency_ms / 1000, args.fail_rate)
+
+    async def serve():
+        server = await relay.start(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
@@ -5,6 +5,14 @@ import subprocess
 import shlex
 import requests
 import json
+import argparse
+import http.client
+import random
+import struct
+import sys
+import threading
+import time
+import urllib.parse
 
 SERVER_URI = "http://localhost:5000/route"
 #SERVER_URI = "http://71.198.20.93:5000/route"
@@ -15,6 +23,12 @@ MESSAGE = "SH Rocks"
 # Request payload before addition of 'recipients'
 BASE_PAYLOAD = {'message': MESSAGE}
 
+# Content type of the compact binary /route request body
+PACKED_MIMETYPE = 'application/x-sh-route'
+
+# Default load generation request mix: "recipients:weight,..."
+DEFAULT_LOAD_MIX = "1:40,5:20,30:20,100:15,1000:5"
+
  
 def shell_cmd(cmdln):
     """
@@ -78,6 +92,70 @@ def send_via_requests(dictionary):
 
     return response
 
+
+def encode_packed_payload(message, recipients):
+    """
+    Encode a /route request body in the compact binary format: uint32
+    message length, UTF-8 message, uint32 recipient count, then one uint64
+    per recipient number (without the '+'), all little-endian.
+
+    @param str  $message    - Message text
+
+    @param list $recipients - E.164 phone number strings
+
+    @returns bytes
+
+    """
+    message = message.encode('utf-8')
+
+    return (struct.pack('<I', len(message)) + message +
+            struct.pack('<I%dQ' % len(recipients), len(recipients),
+                        *(int(recipient[1:]) for recipient in recipients)))
+
+
+def send_via_packed(message, recipients):
+    """
+    Send a compact binary /route request to the SHChallenge server.
+
+    @returns (int, dict) - HTTP status code and decoded JSON response
+
+    """
+    headers = {'content-type': PACKED_MIMETYPE}
+
+    r = requests.post(SERVER_URI, data=encode_packed_payload(message, recipients),
+                      headers=headers)
+
+    return r.status_code, r.json()
+
+
+
+def expand_compact_routes(recipients, response):
+    """
+    Expand a '/route?format=compact' response into the full route list.
+
+    @param list $recipients - The 'recipients' list the request was sent with
+
+    @param dict $response   - Decoded compact response:
+                              {"message": ..., "tiers": [{"size": ...,
+                              "start": ..., "end": ..., "ips": [...]}, ...]}
+
+    @returns list - [{"ip": ..., "recipients": [...]}, ...], as the full
+                    format would have returned them
+
+    """
+    routes = []
+
+    for tier in response['tiers']:
+        size  = tier['size']
+        start = tier['start']
+
+        for index, ip in enumerate(tier['ips']):
+            routes.append({'ip': ip,
+                           'recipients': recipients[start + index * size:
+                                                    start + (index + 1) * size]})
+
+    return routes
+
     
 def build_recipient_list(num):
     """
@@ -272,9 +350,156 @@ def verify_routes(num_recipients, routes):
         sys.exit(1)
 
 
-    
-if __name__ == '__main__':
 
+def parse_load_mix(mix):
+    """
+    Parse a request mix specification.
+
+    @param str $mix - Comma separated "recipients:weight" pairs, e.g.
+                      "1:40,30:20,1000:5" sends 1-recipient requests 40/65 of
+                      the time, 30-recipient requests 20/65 of the time, etc.
+
+    @returns (list of int, list of float) - recipient counts and their weights
+
+    """
+    counts  = []
+    weights = []
+
+    for item in mix.split(','):
+        count, sep, weight = item.partition(':')
+        counts.append(int(count))
+        weights.append(float(weight) if sep else 1.0)
+
+    return counts, weights
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+
+    """
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def load_worker(uri, bodies, weights, num_requests, seed, results):
+    """
+    Send 'num_requests' requests over one persistent keep-alive connection.
+
+    @param str  $uri          - Server URI, e.g. SERVER_URI
+
+    @param list $bodies       - Pre-encoded request bodies, one per mix entry
+
+    @param list $weights      - Relative frequency of each body
+
+    @param int  $num_requests - Number of requests to send
+
+    @param int  $seed         - Random seed, so runs are repeatable
+
+    @param list $results      - (latency seconds, HTTP status) tuples are
+                                appended here.  Status 0 means a connection
+                                error.
+
+    """
+    parts   = urllib.parse.urlsplit(uri)
+    headers = {'Content-Type': 'application/json'}
+    rng     = random.Random(seed)
+
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+    for body in rng.choices(bodies, weights, k=num_requests):
+        start = time.perf_counter()
+        try:
+            conn.request('POST', parts.path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            status = 0
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+        results.append((time.perf_counter() - start, status))
+
+    conn.close()
+
+
+def run_load(uri, concurrency, num_requests, mix):
+    """
+    Drive the SH server with 'concurrency' persistent connections.
+
+    @param str $uri          - Server URI
+
+    @param int $concurrency  - Number of concurrent connections
+
+    @param int $num_requests - Total number of requests to send
+
+    @param str $mix          - Request mix (see parse_load_mix())
+
+    @returns dict - Throughput, latency percentiles (ms) and status counts
+
+    """
+    counts, weights = parse_load_mix(mix)
+
+    # Encode each request body once, up front
+    bodies = []
+    for count in counts:
+        payload = {'message': MESSAGE, 'recipients': build_recipient_list(count)}
+        bodies.append(json.dumps(payload).encode('utf-8'))
+
+    results = []
+    threads = []
+    for index in range(concurrency):
+        share = num_requests // concurrency + (index < num_requests % concurrency)
+        threads.append(threading.Thread(target=load_worker,
+                                        args=(uri, bodies, weights, share, index, results)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, status in results)
+
+    statuses = {}
+    for latency, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    return {
+        'requests':     len(results),
+        'elapsed_sec':  elapsed,
+        'requests_sec': len(results) / elapsed if elapsed else 0.0,
+        'p50_ms':       percentile(latencies, 0.50) * 1000,
+        'p95_ms':       percentile(latencies, 0.95) * 1000,
+        'p99_ms':       percentile(latencies, 0.99) * 1000,
+        'max_ms':       (latencies[-1] if latencies else 0.0) * 1000,
+        'statuses':     statuses,
+    }
+
+
+def print_load_report(stats):
+    """
+    Print the results of run_load().
+
+    """
+    print("Requests:    %d in %.2f s" % (stats['requests'], stats['elapsed_sec']))
+    print("Throughput:  %.1f requests/s" % stats['requests_sec'])
+    print("Latency ms:  p50 %.2f  p95 %.2f  p99 %.2f  max %.2f"
+          % (stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+    print("Statuses:    %s" % ", ".join("%s: %d" % (status or 'conn error', count)
+                                        for status, count in sorted(stats['statuses'].items())))
+
+
+def run_functional_tests():
+    """
+    Send 1 to 30 recipient requests and verify every response.
+
+    """
     # ==========================================================================
     # Test SH server
     # ==========================================================================
@@ -316,8 +541,257 @@ if __name__ == '__main__':
         routes = response['routes']
         verify_routes(num_recipients=num_recipients, routes=routes)
 
-    
 
-    
- 
+def route_blocks(routes):
+    """
+    Strip routes down to what two responses to the same request always
+    share: each route's tier (third IP octet) and recipients.  The relay
+    within the tier can differ when the server balances relay load across
+    requests.
+
+    @returns list of (str, list) tuples
 
+    """
+    return [(route['ip'].split('.')[2], route['recipients']) for route in routes]
+
+
+def run_batch_tests():
+    """
+    Verify /route/batch answers JSON array and NDJSON batches in input order,
+    with an error object for each bad item.
+
+    """
+    print()
+    print("Testing batch requests...")
+    print("=========================")
+
+    batch_uri = SERVER_URI + "/batch"
+
+    valid_payloads = [{"message": MESSAGE, "recipients": build_recipient_list(num)}
+                      for num in (3, 30)]
+    expected = [send_via_requests(payload) for payload in valid_payloads]
+
+    #
+    # JSON array: two valid payloads around an invalid one
+    #
+    print("Verify JSON array batch keeps input order and reports bad items... ", end="")
+
+    batch = [valid_payloads[0], {"message": MESSAGE, "recipients": []}, valid_payloads[1]]
+
+    r = requests.post(batch_uri, json=batch)
+    results = r.json().get('results', [])
+
+    if (r.status_code == 200 and len(results) == 3 and
+        route_blocks(results[0].get('routes', [])) == route_blocks(expected[0]['routes']) and
+        'error' in results[1] and
+        route_blocks(results[2].get('routes', [])) == route_blocks(expected[1]['routes'])):
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %s" % (r.status_code, r.text[:200]))
+
+    #
+    # NDJSON: a blank line is skipped, a line of bad JSON gets an error
+    #
+    print("Verify NDJSON batch keeps input order and reports bad lines... ", end="")
+
+    body = "\n".join([json.dumps(valid_payloads[1]), "", "{not json",
+                      json.dumps(valid_payloads[0])])
+
+    r = requests.post(batch_uri, data=body, headers={'content-type': 'application/x-ndjson'})
+    results = r.json().get('results', [])
+
+    if (r.status_code == 200 and len(results) == 3 and
+        route_blocks(results[0].get('routes', [])) == route_blocks(expected[1]['routes']) and
+        'error' in results[1] and
+        route_blocks(results[2].get('routes', [])) == route_blocks(expected[0]['routes'])):
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %s" % (r.status_code, r.text[:200]))
+
+    #
+    # A JSON body that isn't an array is rejected whole
+    #
+    print("Verify non-array batch body is rejected... ", end="")
+
+    r = requests.post(batch_uri, json=valid_payloads[0])
+
+    if r.status_code == 400 and 'error' in r.json():
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %s" % (r.status_code, r.text[:200]))
+
+
+def run_stream_tests():
+    """
+    Verify '?stream=1' responses match the normal response: byte for byte
+    in affinity mode, and route for route in plan mode, where relays can
+    differ between requests under a load-balancing scheduler.
+
+    """
+    print()
+    print("Testing streamed responses...")
+    print("=============================")
+
+    # 6443 recipients make more routes than the server streams per chunk
+    for num_recipients in (43, 6443):
+        payload = {"message": MESSAGE, "recipients": build_recipient_list(num_recipients)}
+
+        for mode in ('plan', 'affinity'):
+            print("Verify %d-recipient %s mode streamed response matches... "
+                  % (num_recipients, mode), end="")
+
+            streamed = requests.post(SERVER_URI, params={'stream': '1', 'mode': mode},
+                                     json=payload)
+            whole    = requests.post(SERVER_URI, params={'mode': mode}, json=payload)
+
+            if mode == 'affinity':
+                matches = (streamed.content == whole.content)
+            else:
+                matches = (streamed.json()['message'] == whole.json()['message'] and
+                           route_blocks(streamed.json()['routes']) ==
+                           route_blocks(whole.json()['routes']))
+
+            if streamed.status_code == 200 and whole.status_code == 200 and matches:
+                print("PASS")
+            else:
+                print("\n")
+                print("FAIL: returned: %d %s" % (streamed.status_code, streamed.text[:200]))
+                print("FAIL: expected: %d %s" % (whole.status_code, whole.text[:200]))
+
+
+def run_packed_tests():
+    """
+    Verify compact binary requests get the same responses as JSON ones, and
+    the same validation.
+
+    """
+    print()
+    print("Testing compact binary requests...")
+    print("==================================")
+
+    for num_recipients in (1, 7, 30, 1000):
+        print("Verify %d-recipient packed request matches JSON... " % num_recipients, end="")
+
+        payload = build_test_payload(num_recipients)
+
+        status, response = send_via_packed(MESSAGE, payload['recipients'])
+        expected = send_via_requests(payload)
+
+        if (status == 200 and response.get('message') == expected['message'] and
+            route_blocks(response['routes']) == route_blocks(expected['routes'])):
+            print("PASS")
+        else:
+            print("\n")
+            print("FAIL: returned: %d %s" % (status, response))
+
+    # Packed requests are streamed whenever the same JSON request is
+    print("Verify streamed packed request matches streamed JSON... ", end="")
+
+    payload = build_test_payload(6443)
+
+    packed = requests.post(SERVER_URI, params={'stream': '1', 'mode': 'affinity'},
+                           data=encode_packed_payload(MESSAGE, payload['recipients']),
+                           headers={'content-type': PACKED_MIMETYPE})
+    whole  = requests.post(SERVER_URI, params={'stream': '1', 'mode': 'affinity'}, json=payload)
+
+    if (packed.status_code == 200 and packed.content == whole.content and
+        packed.headers.get('transfer-encoding') == whole.headers.get('transfer-encoding')):
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %s, transfer-encoding %s instead of %s"
+              % (packed.status_code, packed.text[:200], packed.headers.get('transfer-encoding'),
+                 whole.headers.get('transfer-encoding')))
+
+    for name, recipients in (("empty", []), ("duplicate", ["+15555550000"] * 2)):
+        print("Verify %s packed request is rejected... " % name, end="")
+
+        status, response = send_via_packed(MESSAGE, recipients)
+
+        if status == 400 and 'error' in response:
+            print("PASS")
+        else:
+            print("\n")
+            print("FAIL: returned: %d %s" % (status, response))
+
+
+def run_compact_tests():
+    """
+    Verify '?format=compact' responses expand to the full responses.
+
+    """
+    print()
+    print("Testing compact responses...")
+    print("============================")
+
+    for num_recipients in (1, 7, 30, 1000):
+        print("Verify %d-recipient compact response expands to the full one... "
+              % num_recipients, end="")
+
+        payload  = build_test_payload(num_recipients)
+        expected = send_via_requests(payload)
+
+        r = requests.post(SERVER_URI, params={'format': 'compact'}, json=payload)
+        response = r.json()
+
+        if (r.status_code == 200 and response.get('message') == MESSAGE and
+            route_blocks(expand_compact_routes(payload['recipients'], response)) ==
+            route_blocks(expected['routes'])):
+            print("PASS")
+        else:
+            print("\n")
+            print("FAIL: returned: %d %s" % (r.status_code, response))
+
+    print("Verify compact format is rejected with affinity mode... ", end="")
+
+    r = requests.post(SERVER_URI, params={'format': 'compact', 'mode': 'affinity'},
+                      json=build_test_payload(5))
+
+    if r.status_code == 400 and 'error' in r.json():
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %s" % (r.status_code, r.text))
+
+    # Compact tiers have keys out of alphabetical order, so this catches
+    # a server that doesn't sort them
+    print("Verify compact response is encoded like jsonify()... ", end="")
+
+    r = requests.post(SERVER_URI, params={'format': 'compact'}, json=build_test_payload(43))
+    expected = json.dumps(r.json(), separators=(',', ':'), sort_keys=True) + '\n'
+
+    if r.status_code == 200 and r.text == expected:
+        print("PASS")
+    else:
+        print("\n")
+        print("FAIL: returned: %d %r, expected %r" % (r.status_code, r.text, expected))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Test the SH challenge server")
+    parser.add_argument('--load', action='store_true',
+                        help="run a load test instead of the functional tests")
+    parser.add_argument('--uri', default=SERVER_URI)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="load test: concurrent keep-alive connections")
+    parser.add_argument('--requests', type=int, default=10000,
+                        help="load test: total number of requests")
+    parser.add_argument('--mix', default=DEFAULT_LOAD_MIX,
+                        help="load test: recipient count distribution, "
+                             "as 'recipients:weight,...'")
+    args = parser.parse_args()
+
+    if args.load:
+        print_load_report(run_load(args.uri, args.concurrency, args.requests, args.mix))
+
+    else:
+        SERVER_URI = args.uri
+        run_functional_tests()
+        run_batch_tests()
+        run_stream_tests()
+        run_packed_tests()
+        run_compact_tests()
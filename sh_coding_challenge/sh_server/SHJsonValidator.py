@@ -1,7 +1,8 @@
 # JSON schema validator
 # Requires Python3
-
-import jsonschema
+#
+# jsonschema is only imported when the fast path rejects an input, so valid
+# traffic never pays for importing it.
 
 class SHJsonValidator:
 
@@ -9,6 +10,9 @@ class SHJsonValidator:
         """
         Initialize a JSON validator for SH Challenge input.
 
+        The schema is checked and its jsonschema validator is built once, the
+        first time it is needed, rather than on every call to validate_input().
+
         """
         self.SH_input_schema =  {
                                          "title": "SH Challenge Schema",
@@ -25,10 +29,150 @@ class SHJsonValidator:
                                              }
                                          },
                                          "required": ["message", "recipients"]
-                                      } 
+                                      }
+
+        self._schema_validator = None
+
+
+    @property
+    def schema_validator(self):
+        """
+        The jsonschema validator for the SH Challenge schema, built on first
+        use.
+
+        """
+        if self._schema_validator is None:
+            import jsonschema
+
+            validator_class = jsonschema.validators.validator_for(self.SH_input_schema)
+            validator_class.check_schema(self.SH_input_schema)
+
+            self._schema_validator = validator_class(self.SH_input_schema)
+
+        return self._schema_validator
+
+
+    def is_valid(self, SH_input):
+        """
+        Fast path: hand-written equivalent of the SH Challenge schema.
+
+        @param obj $SH_input - Decoded JSON payload
+
+        @returns bool - True if 'SH_input' matches the schema
+
+        Uniqueness is checked with a set, so it is O(N) for N recipients.
+
+        """
+        if type(SH_input) is not dict:
+            return False
+
+        try:
+            message    = SH_input['message']
+            recipients = SH_input['recipients']
+        except KeyError:
+            return False
+
+        if type(message) is not str or type(recipients) is not list:
+            return False
+
+        if not recipients:
+            return False
+
+        for recipient in recipients:
+            if type(recipient) is not str:
+                return False
+
+        return len(set(recipients)) == len(recipients)
+
 
- 
     def validate_input(self, SH_input):
-        jsonschema.validate(SH_input, self.SH_input_schema)
-        
-        
+        """
+        Raise jsonschema.exceptions.ValidationError if 'SH_input' doesn't match
+        the SH Challenge schema.
+
+        Valid input only goes through the fast path.  The full jsonschema
+        validator only runs on rejected input, to build the error message.
+
+        @param obj $SH_input - Decoded JSON payload
+
+        """
+        if self.is_valid(SH_input):
+            return
+
+        # The schema stays the authority: input the fast path rejects (e.g. a
+        # dict subclass) is still accepted if jsonschema accepts it.
+        self.schema_validator.validate(SH_input)
+
+
+    def get_error(self, SH_input):
+        """
+        Like validate_input(), but return the validation error message instead
+        of raising, so callers don't need to import jsonschema.
+
+        @param obj $SH_input - Decoded JSON payload
+
+        @returns str or None - Error message, or None if 'SH_input' is valid
+
+        """
+        if self.is_valid(SH_input):
+            return None
+
+        error = next(self.schema_validator.iter_errors(SH_input), None)
+
+        return None if error is None else error.message
+
+
+if __name__ == '__main__':
+
+    import jsonschema
+
+    #
+    # Verify the fast path and the full jsonschema validator agree
+    #
+    print("Verify SHJsonValidator fast path matches jsonschema...", end="")
+
+    validator = SHJsonValidator()
+
+    test_inputs = [
+        {"message": "SH Rocks", "recipients": ["+15555550000"]},
+        {"message": "SH Rocks", "recipients": ["+15555550000", "+15555550001"]},
+        {"message": "SH Rocks", "recipients": ["+15555550000", "+15555550000"]},
+        {"message": "SH Rocks", "recipients": []},
+        {"message": "SH Rocks", "recipients": [1]},
+        {"message": "SH Rocks", "recipients": [None]},
+        {"message": "SH Rocks", "recipients": [True]},
+        {"message": "SH Rocks", "recipients": "+15555550000"},
+        {"message": "SH Rocks", "recipients": ["+15555550000"], "extra": 1},
+        {"message": 5, "recipients": ["+15555550000"]},
+        {"message": None, "recipients": ["+15555550000"]},
+        {"message": "SH Rocks"},
+        {"recipients": ["+15555550000"]},
+        {},
+        [],
+        None,
+        "SH Rocks",
+    ]
+
+    failed = False
+
+    for test_input in test_inputs:
+        expected = validator.schema_validator.is_valid(test_input)
+
+        try:
+            validator.validate_input(test_input)
+        except jsonschema.exceptions.ValidationError as exc:
+            received = False
+            message  = exc.message
+        else:
+            received = True
+            message  = None
+
+        if (received != expected or validator.is_valid(test_input) != expected or
+            validator.get_error(test_input) != message):
+            print("\n")
+            print("FAIL: validate_input(%r) accepted=%r" % (test_input, received))
+            print("FAIL: expected accepted=%r" % expected)
+            failed = True
+
+    if not failed:
+        print("PASS")
@@ -0,0 +1,152 @@
+# Admission control for the SH challenge servers
+# Requires Python3
+#
+# Bounds the work a server has in flight, measured in recipients rather than
+# requests: a 100k recipient request costs 100k times more to validate, route
+# and serialize than a 1 recipient one.  Requests that would exceed the budget
+# are turned away at once (HTTP 429) instead of queueing behind it, so
+# latency stays bounded for the requests that are admitted.
+
+
+import threading
+
+# Seconds a shed client is told to wait before retrying (Retry-After)
+DEFAULT_RETRY_AFTER = 1
+
+# Request body bytes per recipient of a typical E.164 list: '"+15555550000",'
+# is 15 bytes.  Used to estimate a request's recipients from its size before
+# parsing it.
+BYTES_PER_RECIPIENT = 15
+
+
+def estimate_recipients(content_length, max_recipients,
+                        bytes_per_recipient=BYTES_PER_RECIPIENT):
+    """
+    Estimate the recipients of a /route request from its body size, before
+    the body is read, so shed requests are never parsed.
+
+    @param int $content_length      - Request body size, or None if unknown
+                                      (chunked)
+
+    @param int $max_recipients      - Budget to charge bodies of unknown size
+
+    @param int $bytes_per_recipient - Body bytes per recipient of the request
+                                      format
+
+    @returns int - At least 1
+
+    """
+    if content_length is None:
+        return max_recipients
+
+    return max(1, content_length // bytes_per_recipient)
+
+
+class AdmissionController:
+    """
+    Recipient-weighted in-flight budget.
+
+    Usage example:
+
+        admission = AdmissionController(max_recipients=200000)
+
+        cost = estimate_recipients(content_length, admission.max_recipients)
+        if not admission.try_admit(cost):
+            ...                           # Answer 429 with Retry-After
+        try:
+            ...                           # Handle the request
+        finally:
+            admission.release(cost)
+
+    A request costing more than the whole budget is only admitted when
+    nothing else is in flight, so it never runs alongside other work.  There
+    is no queue or reservation: while other requests keep arriving, a large
+    request can be shed on every retry until the load lets up.
+
+    """
+
+    def __init__(self, max_recipients, retry_after=DEFAULT_RETRY_AFTER):
+        """
+        @param int $max_recipients - In-flight budget, in recipients
+
+        @param int $retry_after    - Retry-After seconds for shed requests
+
+        """
+        if max_recipients < 1:
+            raise ValueError("max_recipients must be 1 or more, not %d" % max_recipients)
+
+        self.max_recipients = max_recipients
+        self.retry_after    = retry_after
+        self.lock           = threading.Lock()
+
+        self.in_flight_recipients = 0
+        self.in_flight_requests   = 0
+        self.admitted             = 0
+        self.shed                 = 0
+
+    def try_admit(self, cost):
+        """
+        Admit a request costing 'cost' recipients if the budget allows.
+
+        @returns bool - True if admitted; release(cost) must follow
+
+        """
+        with self.lock:
+            if (self.in_flight_requests and
+                self.in_flight_recipients + cost > self.max_recipients):
+                self.shed += 1
+                return False
+
+            self.in_flight_recipients += cost
+            self.in_flight_requests   += 1
+            self.admitted             += 1
+
+            return True
+
+    def release(self, cost):
+        """
+        Return the budget of a finished request admitted with 'cost'.
+
+        """
+        with self.lock:
+            self.in_flight_recipients -= cost
+            self.in_flight_requests   -= 1
+
+
+if __name__ == '__main__':
+
+    #
+    # Verify requests are shed once the budget is used up
+    #
+    print("Verify AdmissionController sheds requests over budget...", end="")
+
+    admission = AdmissionController(max_recipients=100)
+
+    admitted = [admission.try_admit(cost) for cost in (60, 30, 20, 10)]
+    admission.release(60)
+    after_release = admission.try_admit(50)
+
+    if admitted != [True, True, False, True] or not after_release or admission.shed != 1:
+        print("\n")
+        print("FAIL: admitted %r, then %r, shed %d" % (admitted, after_release, admission.shed))
+    else:
+        print("PASS")
+
+    #
+    # Verify an oversized request is admitted only when idle
+    #
+    print("Verify AdmissionController admits oversized requests only when idle...", end="")
+
+    admission = AdmissionController(max_recipients=100)
+
+    idle_admit = admission.try_admit(500)
+    busy_admit = admission.try_admit(1)
+    admission.release(500)
+    busy_oversized = (admission.try_admit(1), admission.try_admit(500))
+
+    if not idle_admit or busy_admit or busy_oversized != (True, False):
+        print("\n")
+        print("FAIL: idle %r, busy %r, oversized while busy %r"
+              % (idle_admit, busy_admit, busy_oversized))
+    else:
+        print("PASS")
@@ -4,6 +4,8 @@
 
 import itertools_ext_lib
 
+# Bin sizes, largest first
+BIN_SIZES = (25, 10, 5, 1)
 
 def binner(items):
     """
@@ -12,11 +14,13 @@ def binner(items):
 
     @param list $items - list of N items
 
-    @returns four tuples:
-        tuple of subtuples of 25 elements each
-        tuple of subtuples of 10 elements each
-        tuple of subtuples of  5 elements each
-        tuple of single elements
+    @returns four itertools_ext_lib.ChunkView sequences:
+        sequence of sub-sequences of 25 elements each
+        sequence of sub-sequences of 10 elements each
+        sequence of sub-sequences of  5 elements each
+        sequence of single-element sub-sequences
+
+    Each sub-sequence is a slice of 'items', so it has the same type as 'items'.
 
     Note: Any or all of the returned sub-tuples can be empty
     
@@ -43,11 +47,9 @@ def binner(items):
     """
 
     # Split items into the largest bin first, splitting remainders into progressively
-    # smaller bins.
-    bin_25, remainder = itertools_ext_lib.div_mod(items,     25)
-    bin_10, remainder = itertools_ext_lib.div_mod(remainder, 10)
-    bin_5,  remainder = itertools_ext_lib.div_mod(remainder,  5)
-    bin_1,  remainder = itertools_ext_lib.div_mod(remainder,  1)
+    # smaller bins.  All bin boundaries are computed up front; each bin is a view
+    # onto 'items', so nothing is copied until a sub-sequence is accessed.
+    bin_25, bin_10, bin_5, bin_1 = itertools_ext_lib.cascade_split(items, BIN_SIZES)
 
     return bin_25, bin_10, bin_5, bin_1
 
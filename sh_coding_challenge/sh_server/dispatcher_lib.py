@@ -0,0 +1,478 @@
+# Relay dispatcher for the SH challenge
+# Requires Python3
+#
+# get_routes() only plans the routes.  RelayDispatcher delivers them: each
+# route's recipient block is POSTed with the message to its relay, all routes
+# concurrently, over a keep-alive connection pool per relay.  In-flight sends
+# are bounded per tier, and failed sends are retried with a timeout on every
+# attempt.  Uses only asyncio streams and a minimal HTTP/1.1 client.
+
+
+import asyncio
+import collections
+import json
+
+import recipients_lib
+import router_lib
+
+# Relay endpoint receiving {"message": ..., "recipients": [...]}
+RELAY_PORT = 8080
+RELAY_PATH = '/send'
+
+# Seconds allowed for one attempt (connect, send and read the response)
+DEFAULT_TIMEOUT = 5.0
+
+# Attempts after the first one, and the delay before the first retry
+# (doubled on each further retry)
+DEFAULT_RETRIES       = 2
+DEFAULT_RETRY_BACKOFF = 0.05
+
+# Open connections per relay
+DEFAULT_CONNECTIONS_PER_RELAY = 4
+
+# Largest relay response head accepted, in bytes
+MAX_RESPONSE_HEAD_BYTES = 64 * 1024
+
+
+# Outcome of one route's delivery.
+#   ip             - Relay IP of the route
+#   num_recipients - Recipients in the route
+#   status         - HTTP status of the last attempt, or None if it failed
+#                    before getting a response
+#   attempts       - Number of attempts made
+#   error          - Error of the last attempt, or None on success
+DispatchResult = collections.namedtuple(
+    'DispatchResult', ['ip', 'num_recipients', 'status', 'attempts', 'error'])
+
+
+class RelayError(Exception):
+    """
+    A relay answered with a status that is worth retrying (5xx, 429) or sent
+    a malformed response.
+
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def default_resolver(ip):
+    """
+    Relay address resolver: connect to the relay IP itself on RELAY_PORT.
+
+    @returns (host, port)
+
+    """
+    return ip, RELAY_PORT
+
+
+def localhost_resolver(port, host='127.0.0.1'):
+    """
+    Return a resolver that sends every relay's traffic to host:port, e.g. a
+    local fake relay (see sh_bench/fake_relay.py).  Each relay IP still gets
+    its own connection pool.
+
+    """
+    return lambda ip: (host, port)
+
+
+def tier_limits(tiers=router_lib.DEFAULT_TIERS):
+    """
+    Default in-flight send limit of each tier: its size, so the 25/10/5/1
+    tiers allow 25/10/5/1 concurrent sends.
+
+    @returns dict - {tier name: limit}
+
+    """
+    return {tier.name: tier.size for tier in tiers}
+
+
+class _RelayPool:
+    """
+    Keep-alive connections to one relay.
+
+    """
+
+    def __init__(self, address, max_connections):
+        self.address = address
+        self.idle    = []
+        self.slots   = asyncio.Semaphore(max_connections)
+
+    async def open(self):
+        """
+        @returns (reader, writer, reused) - An idle connection if there is one,
+                                            else a new one
+
+        """
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        reader, writer = await asyncio.open_connection(*self.address,
+                                                       limit=MAX_RESPONSE_HEAD_BYTES)
+        return reader, writer, False
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class RelayDispatcher:
+    """
+    Deliver routes to their relays concurrently.
+
+    Usage example:
+
+        async with RelayDispatcher() as dispatcher:
+            results = await dispatcher.dispatch("SH Rocks", router_lib.get_routes(recipients))
+
+    or, from synchronous code:
+
+        results = dispatch_routes("SH Rocks", routes)
+
+    Routes are matched to tiers by their relay subnet.  Each tier has a
+    semaphore bounding its in-flight sends (see tier_limits()); each relay
+    has a pool of at most 'connections_per_relay' keep-alive connections.
+    An attempt that times out, fails to connect, loses its connection or gets
+    a 5xx/429 response is retried up to 'retries' times.  A stale pooled
+    connection that was closed by the relay is replaced without counting as
+    an attempt.
+
+    """
+
+    def __init__(self, resolver=default_resolver, tiers=router_lib.DEFAULT_TIERS,
+                 limits=None, connections_per_relay=DEFAULT_CONNECTIONS_PER_RELAY,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF, scheduler=None):
+        """
+        @param func  $resolver              - Maps a relay IP to the (host, port)
+                                              to connect to
+
+        @param list  $tiers                 - Tier table the routes were planned with
+
+        @param dict  $limits                - {tier name: in-flight limit}, default
+                                              tier_limits(tiers)
+
+        @param int   $connections_per_relay - Pool size per relay
+
+        @param float $timeout               - Seconds per attempt
+
+        @param int   $retries               - Attempts after the first one
+
+        @param float $retry_backoff         - Seconds before the first retry
+
+        @param obj   $scheduler             - relay_scheduler_lib.RelayScheduler
+                                              the routes were assigned by; each
+                                              route's relay is released once its
+                                              delivery is finished
+
+        """
+        self.resolver              = resolver
+        self.tier_table            = router_lib.sort_tiers(tiers)
+        self.limits                = limits or tier_limits(self.tier_table)
+        self.connections_per_relay = connections_per_relay
+        self.timeout               = timeout
+        self.retries               = retries
+        self.retry_backoff         = retry_backoff
+        self.scheduler             = scheduler
+
+        # Subnet ("10.0.4.") -> tier name
+        self.subnet_tiers = {subnet: tier.name for tier in self.tier_table
+                             for subnet in tier.subnets}
+
+        # Created on first use, so they belong to the running event loop
+        self.tier_slots = None
+        self.pools      = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close every pooled connection.
+
+        """
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+    def tier_of(self, ip):
+        """
+        @returns str - Name of the tier relay 'ip' belongs to
+
+        Raises ValueError if 'ip' isn't in any tier subnet.
+
+        """
+        tier_name = self.subnet_tiers.get(ip[:ip.rindex('.') + 1])
+        if tier_name is None:
+            raise ValueError("Relay %s is not in any tier subnet" % ip)
+
+        return tier_name
+
+    async def dispatch(self, message, routes):
+        """
+        Send 'message' to every route's recipients, concurrently.
+
+        @param str  $message - Message text
+
+        @param list $routes  - Route dictionaries, e.g. from get_routes()
+
+        @returns list of DispatchResult - One per route, in route order
+
+        """
+        if self.tier_slots is None:
+            self.tier_slots = {name: asyncio.Semaphore(limit)
+                               for name, limit in self.limits.items()}
+
+        return await asyncio.gather(*[self._send_route(message, route) for route in routes])
+
+    async def _send_route(self, message, route):
+        ip     = route['ip']
+        body   = json.dumps({"message": message, "recipients": route['recipients']},
+                            separators=(',', ':'),
+                            default=recipients_lib.json_default).encode('utf-8')
+        result = None
+
+        try:
+            async with self.tier_slots[self.tier_of(ip)]:
+                result = await self._send_with_retries(ip, body, len(route['recipients']))
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release((ip,))
+
+        return result
+
+    async def _send_with_retries(self, ip, body, num_recipients):
+        pool = self.pools.get(ip)
+        if pool is None:
+            pool = self.pools[ip] = _RelayPool(self.resolver(ip), self.connections_per_relay)
+
+        delay = self.retry_backoff
+        status, error = None, None
+
+        for attempt in range(1, self.retries + 2):
+            try:
+                status = await asyncio.wait_for(self._post(pool, ip, body), self.timeout)
+
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, RelayError) as exc:
+                status = getattr(exc, 'status', None)
+                error  = "%s: %s" % (type(exc).__name__, exc)
+
+            else:
+                # Other 4xx responses won't succeed on a retry
+                error = None if status < 300 else "Relay %s answered %d" % (ip, status)
+                return DispatchResult(ip, num_recipients, status, attempt, error)
+
+            if attempt <= self.retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        return DispatchResult(ip, num_recipients, status, self.retries + 1, error)
+
+    async def _post(self, pool, ip, body):
+        """
+        POST 'body' to the relay over a pooled connection.
+
+        @returns int - HTTP status of a successful (non-retryable) response
+
+        """
+        async with pool.slots:
+            while True:
+                reader, writer, reused = await pool.open()
+                try:
+                    status, keep_alive = await self._exchange(reader, writer, ip, body)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # The relay closed an idle connection; try a fresh one
+                    if not reused:
+                        raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep_alive:
+                pool.idle.append((reader, writer))
+            else:
+                writer.close()
+
+        if status >= 500 or status == 429:
+            raise RelayError("Relay %s answered %d" % (ip, status), status)
+
+        return status
+
+    async def _exchange(self, reader, writer, ip, body):
+        """
+        Send one request and read its response.
+
+        @returns (status, keep_alive)
+
+        """
+        writer.write(("POST %s HTTP/1.1\r\n"
+                      "Host: %s\r\n"
+                      "Content-Type: application/json\r\n"
+                      "Content-Length: %d\r\n"
+                      "\r\n" % (RELAY_PATH, ip, len(body))).encode('latin-1') + body)
+        await writer.drain()
+
+        head  = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+
+        try:
+            version, status = lines[0].split(' ', 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise RelayError("Malformed status line from %s: %r" % (ip, lines[0]))
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        await reader.readexactly(int(headers.get('content-length', '0')))
+
+        keep_alive = (headers.get('connection', '').lower() != 'close' and
+                      version == 'HTTP/1.1')
+
+        return status, keep_alive
+
+
+def dispatch_routes(message, routes, **kwargs):
+    """
+    Synchronous wrapper: deliver 'routes' with a new RelayDispatcher(**kwargs)
+    and close its connections.
+
+    @returns list of DispatchResult
+
+    """
+    async def run():
+        async with RelayDispatcher(**kwargs) as dispatcher:
+            return await dispatcher.dispatch(message, routes)
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+
+    import relay_scheduler_lib
+    import sh_async_server
+
+    class TestRelay:
+        """
+        In-process relay recording deliveries and in-flight sends per subnet.
+
+        """
+
+        def __init__(self, fail_first=False):
+            self.fail_first = fail_first
+            self.seen_ips   = set()
+            self.recipients = []
+            self.in_flight  = collections.Counter()
+            self.max_flight = collections.Counter()
+
+        async def handle_connection(self, reader, writer):
+            try:
+                await self.serve_requests(reader, writer)
+            except asyncio.CancelledError:
+                pass    # Idle keep-alive connection at shutdown
+            finally:
+                writer.close()
+
+        async def serve_requests(self, reader, writer):
+            while True:
+                request = await sh_async_server.read_request(reader, writer)
+                if request is None:
+                    break
+
+                method, path, query, version, headers, body = request
+                ip     = headers['host']
+                subnet = ip[:ip.rindex('.') + 1]
+
+                self.in_flight[subnet] += 1
+                self.max_flight[subnet] = max(self.max_flight[subnet], self.in_flight[subnet])
+                await asyncio.sleep(0.001)
+                self.in_flight[subnet] -= 1
+
+                if self.fail_first and ip not in self.seen_ips:
+                    self.seen_ips.add(ip)
+                    status = 503
+                else:
+                    status = 200
+                    self.recipients.extend(json.loads(body)['recipients'])
+
+                writer.write(sh_async_server.build_response(status, b'{}', True))
+                await writer.drain()
+
+    def run_dispatch(relay, routes, **kwargs):
+        async def run():
+            server = await asyncio.start_server(relay.handle_connection, '127.0.0.1', 0)
+            port   = server.sockets[0].getsockname()[1]
+
+            async with server:
+                async with RelayDispatcher(localhost_resolver(port), **kwargs) as dispatcher:
+                    return await dispatcher.dispatch("SH Rocks", routes)
+
+        return asyncio.run(run())
+
+    recipients = ["+1555%07d" % index for index in range(1043)]
+    routes     = router_lib.get_routes(recipients)
+
+    #
+    # Verify every recipient is delivered once, within the tier limits
+    #
+    print("Verify RelayDispatcher delivers every route within tier limits...", end="")
+
+    relay   = TestRelay()
+    results = run_dispatch(relay, routes)
+    limits  = {subnet: limit for tier, limit in zip(router_lib.DEFAULT_TIERS, (25, 10, 5, 1))
+               for subnet in tier.subnets}
+
+    if (sorted(relay.recipients) != recipients or
+        any(result.status != 200 or result.error for result in results) or
+        any(relay.max_flight[subnet] > limits[subnet] for subnet in relay.max_flight)):
+        print("\n")
+        print("FAIL: delivered %d of %d recipients, max in flight %r"
+              % (len(relay.recipients), len(recipients), dict(relay.max_flight)))
+    else:
+        print("PASS")
+
+    #
+    # Verify failed sends are retried
+    #
+    print("Verify RelayDispatcher retries a 503 response...", end="")
+
+    relay   = TestRelay(fail_first=True)
+    results = run_dispatch(relay, routes, retry_backoff=0.001)
+
+    if (sorted(relay.recipients) != recipients or
+        any(result.attempts != 2 or result.error for result in results)):
+        print("\n")
+        print("FAIL: attempts %r" % sorted({result.attempts for result in results}))
+    else:
+        print("PASS")
+
+    #
+    # Verify scheduled relays are released after delivery
+    #
+    print("Verify RelayDispatcher releases scheduled relays...", end="")
+
+    scheduler = relay_scheduler_lib.RelayScheduler()
+    routes    = router_lib.get_routes(recipients, scheduler=scheduler)
+    loaded    = any(scheduler.loads().values())
+
+    run_dispatch(TestRelay(), routes, scheduler=scheduler)
+
+    if not loaded or any(scheduler.loads().values()):
+        print("\n")
+        print("FAIL: loads after delivery %r" % scheduler.loads())
+    else:
+        print("PASS")
@@ -0,0 +1,191 @@
+# Consistent hash ring for the SH challenge
+# Requires Python3
+#
+# Maps keys (phone numbers) to nodes (relay IPs) so that a key keeps landing
+# on the same node, and adding or removing one of N nodes only moves about
+# 1/N of the keys.  Hashes are blake2b, so placements are stable across
+# processes and runs, unlike hash().
+
+
+import bisect
+import hashlib
+
+# Points per node on the ring; more points even out the share of each node
+DEFAULT_VNODES = 64
+
+
+def key_point(key):
+    """
+    Position of 'key' on the ring.
+
+    @param str $key
+
+    @returns int - 64 bit ring position
+
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+
+    Usage example:
+
+        ring = HashRing(["10.0.1.1", "10.0.1.2", "10.0.1.3"])
+        ring.node_for("+15555550000")   --> "10.0.1.2"
+        ring.remove("10.0.1.2")
+        ring.node_for("+15555550000")   --> "10.0.1.3"
+
+    A key belongs to the node owning the first point at or after its own
+    position, wrapping around past the largest point.
+
+    """
+
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.nodes  = list(dict.fromkeys(nodes))
+
+        # Sort all the initial points once rather than inserting one by one
+        ring = sorted((point, node) for node in self.nodes
+                      for point in self._node_points(node))
+
+        self.points = [point for point, node in ring]   # Sorted ring positions
+        self.owners = [node for point, node in ring]    # owners[i] owns points[i]
+
+    def _node_points(self, node):
+        return [key_point("%s#%d" % (node, replica)) for replica in range(self.vnodes)]
+
+    def add(self, node):
+        """
+        Add 'node' to the ring.  Adding a node already present does nothing.
+
+        """
+        if node in self.nodes:
+            return
+
+        self.nodes.append(node)
+
+        for point in self._node_points(node):
+            index = bisect.bisect_left(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        """
+        Remove 'node' from the ring.  Its keys move to the following nodes.
+
+        """
+        self.nodes.remove(node)
+
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners)
+                if owner != node]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+
+    def node_for_point(self, point):
+        """
+        @param int $point - Ring position, e.g. from key_point()
+
+        @returns the node owning 'point'
+
+        Raises LookupError if the ring is empty.
+
+        """
+        if not self.points:
+            raise LookupError("Hash ring has no nodes")
+
+        index = bisect.bisect_left(self.points, point)
+
+        return self.owners[index if index < len(self.points) else 0]
+
+    def iter_nodes_from(self, point):
+        """
+        Walk the ring clockwise from 'point', e.g. to spill a key over to the
+        next node when its own node is full.
+
+        @param int $point - Ring position, e.g. from key_point()
+
+        @returns iterator of every node once, the owner of 'point' first
+
+        """
+        seen  = set()
+        start = bisect.bisect_left(self.points, point)
+
+        for index in range(start, start + len(self.points)):
+            node = self.owners[index % len(self.points)]
+
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+                if len(seen) == len(self.nodes):
+                    return
+
+    def node_for(self, key):
+        """
+        @param str $key
+
+        @returns the node owning 'key'
+
+        """
+        return self.node_for_point(key_point(key))
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+if __name__ == '__main__':
+
+    keys = ["+1555%07d" % index for index in range(20000)]
+
+    #
+    # Verify placements are stable and only ~1/N keys move when a node joins
+    #
+    print("Verify adding a 21st node moves about 1/21 of the keys...", end="")
+
+    ring   = HashRing(["10.0.1.%d" % host for host in range(1, 21)])
+    before = [ring.node_for(key) for key in keys]
+
+    ring.add("10.0.1.21")
+    after = [ring.node_for(key) for key in keys]
+
+    moved = sum(old != new for old, new in zip(before, after))
+    to_new = sum(new == "10.0.1.21" for new in after)
+
+    if moved != to_new or not len(keys) / 21 / 2 < moved < len(keys) / 21 * 2:
+        print("\n")
+        print("FAIL: %d keys moved, %d to the new node" % (moved, to_new))
+    else:
+        print("PASS")
+
+    #
+    # Verify removing a node only moves its own keys
+    #
+    print("Verify removing a node only moves that node's keys...", end="")
+
+    ring.remove("10.0.1.5")
+    after_remove = [ring.node_for(key) for key in keys]
+
+    wrongly_moved = [key for key, old, new in zip(keys, after, after_remove)
+                     if old != new and old != "10.0.1.5"]
+
+    if wrongly_moved or "10.0.1.5" in after_remove:
+        print("\n")
+        print("FAIL: %d keys of other nodes moved" % len(wrongly_moved))
+    else:
+        print("PASS")
+
+    #
+    # Verify walking the ring visits every node once, the key's owner first
+    #
+    print("Verify iter_nodes_from() walks every node from the key's owner...", end="")
+
+    walks = [list(ring.iter_nodes_from(key_point(key))) for key in keys[:100]]
+
+    if any(walk[0] != ring.node_for(key) or sorted(walk) != sorted(ring.nodes)
+           for key, walk in zip(keys, walks)):
+        print("\n")
+        print("FAIL: walk doesn't start at the owner or misses nodes")
+    else:
+        print("PASS")
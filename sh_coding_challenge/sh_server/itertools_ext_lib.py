@@ -2,10 +2,15 @@
 # Requires Python3
 
 
+import collections.abc
 import itertools
 
+
+# Private padding marker.  Unlike None, it can never collide with a real item.
+_SENTINEL = object()
+
     
-def grouper(items, n):
+def grouper(items, n, fillvalue=None):
     """
     Collect data into fixed-length chunks or blocks.
     @param itr $items     - List to be split into M N-length chunks
@@ -15,6 +20,8 @@ def grouper(items, n):
 
     @param int $n        - Desired length of each chunk/block returned
 
+    @param obj $fillvalue - Value used to pad the last chunk (default None)
+
     @returns - A single tuple, composed of ceil(len(items)/n) sub-tuples
 
     Note:
@@ -28,7 +35,7 @@ def grouper(items, n):
     # https://docs.python.org/3.3/library/itertools.html#itertools.zip_longest
 
     args = [iter(items)] * n
-    generator = itertools.zip_longest(*args, fillvalue=None)
+    generator = itertools.zip_longest(*args, fillvalue=fillvalue)
     
     return tuple(generator)
 
@@ -62,8 +69,8 @@ def div_mod(items, n):
 
     
     # Split 'items' into M N-element tuples.  If 'items' doesn't split evenly
-    # into 'n' chunks, the last typle will be padded with None values
-    groups = grouper(items, n)
+    # into 'n' chunks, the last typle will be padded with sentinel values
+    groups = grouper(items, n, fillvalue=_SENTINEL)
 
     # Split result into "quotient" and "remainder" tuples.
     # The "quotient" tuple will contain M sub-tuples contain of N elements each.
@@ -88,13 +95,215 @@ def div_mod(items, n):
         quotient_tuple = groups[:-1]
         remainder_tuple = groups[-1]
 
-    # Remove any None entries from remainder tuple
+    # Remove the sentinel padding from the remainder tuple.  Real None items
+    # are kept.
     if remainder_tuple:
-        remainder_tuple = tuple(filter(lambda x: x is not None, remainder_tuple))
+        remainder_tuple = tuple(filter(lambda x: x is not _SENTINEL, remainder_tuple))
         
     return quotient_tuple, remainder_tuple
 
 
+def igrouper(items, n):
+    """
+    Lazy version of grouper().  Yield fixed-length chunks from any iterable,
+    including generators that don't support len().
+
+    @param itr $items     - Iterable to be split into N-length chunks
+
+    @param int $n         - Desired length of each chunk yielded
+
+    @yields - tuples of 'n' items.  The last tuple is shorter (not padded)
+              when the number of items isn't evenly divisible by 'n'.
+
+    Only one chunk is held in memory at a time, so memory use is O(n) no
+    matter how long 'items' is.
+
+    Example usage:
+    list(igrouper(iter([1,2,3,4,5,6,7]), 3)) --> [(1,2,3), (4,5,6), (7,)]
+
+    """
+    if n <= 0:
+        return
+
+    args = [iter(items)] * n
+
+    for group in itertools.zip_longest(*args, fillvalue=_SENTINEL):
+        # Only the final group can contain padding
+        if group[-1] is _SENTINEL:
+            group = tuple(itertools.takewhile(lambda x: x is not _SENTINEL, group))
+
+        yield group
+
+
+def idiv_mod(items, n):
+    """
+    Lazy version of div_mod().  Iterating over the returned object yields the
+    N-length "quotient" tuples one at a time; once iteration is finished the
+    leftover items are available in its 'remainder' attribute.
+
+    @param itr $items     - Iterable to be split into N-length tuples.
+                            Generators are accepted.
+
+    @param int $n         - Desired length of each sub-tuple
+
+    @returns LazyDivMod
+
+    Memory use is O(n): neither the input nor the quotient is materialized.
+
+    Example usage:
+    chunks = idiv_mod(iter([1,2,3,4,5,6,7]), 3)
+    list(chunks)     --> [(1,2,3), (4,5,6)]
+    chunks.remainder --> (7,)
+
+    """
+    return LazyDivMod(items, n)
+
+
+class LazyDivMod:
+    """
+    Iterator state for idiv_mod().  'remainder' is () until iteration is done.
+
+    """
+
+    def __init__(self, items, n):
+        self.items     = items
+        self.n         = n
+        self.remainder = ()
+
+    def __iter__(self):
+        for group in igrouper(self.items, self.n):
+            if len(group) < self.n:
+                self.remainder = group
+            else:
+                yield group
+
+
+
+class ChunkView(collections.abc.Sequence):
+    """
+    Read-only sequence of 'count' consecutive 'size'-length slices of 'items',
+    starting at offset 'start'.
+
+    Nothing is copied when the view is created.  Each chunk is sliced from
+    'items' only when it is accessed, so a chunk has the same type as a slice
+    of 'items' (a list slice for lists, a tuple slice for tuples, etc.).
+
+    Example usage:
+    view = ChunkView([1,2,3,4,5,6,7], start=1, size=3, count=2)
+    list(view) --> [[2,3,4], [5,6,7]]
+    view.stop  --> 7
+
+    """
+
+    def __init__(self, items, start, size, count):
+        self.items = items
+        self.start = start
+        self.size  = size
+        self.count = count
+
+    @property
+    def stop(self):
+        """Offset just past the last item covered by this view."""
+        return self.start + self.size * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+
+        if not 0 <= index < self.count:
+            raise IndexError("ChunkView index out of range")
+
+        offset = self.start + index * self.size
+
+        return self.items[offset:offset + self.size]
+
+    def __repr__(self):
+        return ("ChunkView(start=%d, size=%d, count=%d)"
+                % (self.start, self.size, self.count))
+
+
+def cascade_counts(num_items, tiers):
+    """
+    Compute how many chunks of each tier size a largest-first split of
+    'num_items' items produces, using integer arithmetic only.
+
+    @param int  $num_items - Number of items to be split
+
+    @param list $tiers     - Chunk sizes, in the order they are to be filled
+                             (normally largest first)
+
+    @returns tuple of (size, count) pairs, one per tier
+
+    Example usage:
+    cascade_counts(43, (25, 10, 5, 1)) --> ((25,1), (10,1), (5,1), (1,3))
+
+    """
+    counts    = []
+    remainder = num_items
+
+    for size in tiers:
+        if size <= 0:
+            raise ValueError("Tier sizes must be positive, not %r" % (size,))
+
+        count, remainder = divmod(remainder, size)
+        counts.append((size, count))
+
+    return tuple(counts)
+
+
+def split_by_counts(items, tier_counts):
+    """
+    Split sequence 'items' into consecutive ChunkViews, one per tier.
+
+    @param seq  $items       - Sequence to be split.  Must support len() and
+                               slicing.
+
+    @param list $tier_counts - (size, count) pairs, in output order
+
+    @returns tuple of ChunkViews, one per (size, count) pair
+
+    Items past the end of the last view (if any) are not assigned to any
+    tier; they start at offset views[-1].stop.
+
+    """
+    views = []
+    start = 0
+
+    for size, count in tier_counts:
+        view = ChunkView(items, start, size, count)
+        views.append(view)
+        start = view.stop
+
+    if start > len(items):
+        raise ValueError("Tier counts cover %d items, but only %d were given"
+                         % (start, len(items)))
+
+    return tuple(views)
+
+
+def cascade_split(items, tiers):
+    """
+    Single-pass replacement for chaining div_mod() once per tier.
+
+    All tier boundaries are computed up front with cascade_counts(), then
+    'items' is split into one ChunkView per tier.  No intermediate tuples are
+    built, and each item is copied at most once (when its chunk is accessed).
+
+    @param seq  $items - Sequence to be split
+
+    @param list $tiers - Chunk sizes, largest first
+
+    @returns tuple of ChunkViews, one per tier
+
+    Example usage:
+    cascade_split(range(13), (10, 5, 1)) --> views yielding
+        [range(0,10)], [], [range(10,11), range(11,12), range(12,13)]
+
+    """
+    return split_by_counts(items, cascade_counts(len(items), tiers))
 
     
 if __name__ == '__main__':
@@ -267,14 +476,169 @@ if __name__ == '__main__':
         print("PASS")
  
 
+    #
+    # Verify div_mod keeps real None items in the remainder
+    #
+    test_list    = [1,2,3,None]
+    test_modulus = 3
+  
+    expected_quot = ((1,2,3),)
+    expected_rem  = (None,)
+
+    print("Verify div_mod(%r, %d) returns %r, %r..."
+          % (test_list, test_modulus, expected_quot, expected_rem), end="")
+  
+    quot, rem = div_mod(test_list, test_modulus)
+
+    if ((quot != expected_quot) or
+       (rem  != expected_rem)):
+        print("\n")
+        print("FAIL: div_mod(%r, %r) returned %r, %r"
+              % (test_list, test_modulus, quot, rem))
+        print("FAIL: expected %r %r" % (expected_quot, expected_rem))
+    else:
+        print("PASS")
+
+
+    # ==========================================================================
+    # Test igrouper()
+    # ==========================================================================
+    print("\n")
+    print("Testing igrouper()")
+    print("------------------")
+
+    #
+    # Verify igrouper accepts a generator and doesn't pad the last chunk
+    #
+    test_list    = [1,2,3,4,5,6,7]
+    test_modulus = 3
+
+    expected_groups = [(1,2,3), (4,5,6), (7,)]
+
+    print("Verify igrouper(iter(%r), %d) yields %r..."
+          % (test_list, test_modulus, expected_groups), end="")
+
+    return_val = list(igrouper(iter(test_list), test_modulus))
+
+    if return_val != expected_groups:
+        print("\n")
+        print("FAIL: returned %r" % return_val)
+        print("FAIL: expected %r" % expected_groups)
+    else:
+        print("PASS")
+
+    #
+    # Verify igrouper keeps real None items
+    #
+    test_list    = [None, 1, None]
+    test_modulus = 2
 
+    expected_groups = [(None, 1), (None,)]
 
+    print("Verify igrouper(%r, %d) yields %r..."
+          % (test_list, test_modulus, expected_groups), end="")
 
+    return_val = list(igrouper(test_list, test_modulus))
 
+    if return_val != expected_groups:
+        print("\n")
+        print("FAIL: returned %r" % return_val)
+        print("FAIL: expected %r" % expected_groups)
+    else:
+        print("PASS")
 
 
+    # ==========================================================================
+    # Test idiv_mod()
+    # ==========================================================================
+    print("\n")
+    print("Testing idiv_mod()")
+    print("------------------")
 
+    #
+    # Verify idiv_mod matches div_mod for a range of lengths, using generators
+    # as input
+    #
+    print("Verify idiv_mod(gen, x) matches div_mod(list, x)...", end="")
 
+    failed = False
+
+    for num_items in range(0, 60):
+        for test_modulus in (1, 3, 5, 25):
+            test_list = list(range(num_items))
+
+            chunks = idiv_mod((x for x in test_list), test_modulus)
+            quot   = tuple(chunks)
+            rem    = chunks.remainder
+
+            if (quot, rem) != div_mod(test_list, test_modulus):
+                print("\n")
+                print("FAIL: idiv_mod(%d items, %d) returned %r, %r"
+                      % (num_items, test_modulus, quot, rem))
+                failed = True
+                break
+
+        if failed:
+            break
+
+    if not failed:
+        print("PASS")
+
+
+    # ==========================================================================
+    # Test cascade_split()
+    # ==========================================================================
+    print("\n")
+    print("Testing cascade_split()")
+    print("-----------------------")
+
+    #
+    # Verify cascade_split matches chained div_mod calls
+    #
+    print("Verify cascade_split(x, (25,10,5,1)) matches chained div_mod()...",
+          end="")
+
+    failed = False
+
+    for num_items in range(0, 200):
+        test_list = list(range(num_items))
+
+        expected  = []
+        remainder = test_list
+        for test_modulus in (25, 10, 5, 1):
+            quot, remainder = div_mod(remainder, test_modulus)
+            expected.append(quot)
+
+        views    = cascade_split(test_list, (25, 10, 5, 1))
+        received = [tuple(tuple(chunk) for chunk in view) for view in views]
+
+        if received != expected:
+            print("\n")
+            print("FAIL: cascade_split(%d items) returned %r" % (num_items, received))
+            print("FAIL: expected %r" % expected)
+            failed = True
+            break
+
+    if not failed:
+        print("PASS")
+
+    #
+    # Verify leftover items when the last tier isn't 1
+    #
+    test_list = list(range(13))
+    tiers     = (10, 5)
+
+    print("Verify cascade_split(%r, %r) leaves 3 unassigned items..."
+          % (test_list, tiers), end="")
+
+    views = cascade_split(test_list, tiers)
+
+    if test_list[views[-1].stop:] != [10, 11, 12]:
+        print("\n")
+        print("FAIL: unassigned items: %r" % test_list[views[-1].stop:])
+        print("FAIL: expected [10, 11, 12]")
+    else:
+        print("PASS")
 
         
  #   # Verify grouper doesn't re-arrange items in the original list
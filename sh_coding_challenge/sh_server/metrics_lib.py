@@ -0,0 +1,283 @@
+# Low-overhead metrics for the SH challenge servers
+# Requires Python3
+#
+# Counters and fixed-bucket histograms, rendered in the Prometheus text
+# exposition format.  Recording a value only updates preallocated slots; no
+# objects are allocated per observation.
+
+
+import bisect
+import threading
+
+# Histogram bucket upper bounds in seconds: 10 usec doubling up to ~10.5 sec
+LATENCY_BUCKETS = tuple(10e-6 * 2 ** power for power in range(21))
+
+
+def _format_labels(labels):
+    """
+    Render a label dict as '{name="value",...}', or '' for no labels.
+
+    """
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in sorted(labels.items()))
+
+
+class Counter:
+    """
+    Monotonic counter with an optional label.
+
+    Usage example:
+
+        responses = Counter('sh_responses_total', "Responses sent", label='status')
+        responses.inc(200)
+        responses.inc(400)
+
+    """
+
+    def __init__(self, name, help_text, label=None):
+        self.name      = name
+        self.help_text = help_text
+        self.label     = label
+        self.values    = {}
+        self.lock      = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s counter" % self.name]
+
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+
+        for label_value, value in values:
+            labels = {self.label: label_value} if self.label else {}
+            lines.append("%s%s %s" % (self.name, _format_labels(labels), value))
+
+        return lines
+
+
+class CounterFunc:
+    """
+    Monotonic counter kept elsewhere, e.g. by a cache, and read from a
+    callable at render time.
+
+    Usage example:
+
+        CounterFunc('sh_plan_cache_hits_total', "Route plan cache hits",
+                    lambda: router_lib.route_plan_cache_info().hits)
+
+    """
+
+    def __init__(self, name, help_text, read):
+        self.name      = name
+        self.help_text = help_text
+        self.read      = read
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help_text),
+                "# TYPE %s counter" % self.name,
+                "%s %s" % (self.name, self.read())]
+
+
+class Gauge:
+    """
+    Value that can go up and down, read from a callable at render time.
+
+    Usage example:
+
+        Gauge('sh_plan_cache_size', "Cached route plans",
+              lambda: router_lib.route_plan_cache_info().currsize)
+
+    """
+
+    def __init__(self, name, help_text, read):
+        self.name      = name
+        self.help_text = help_text
+        self.read      = read
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help_text),
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, self.read())]
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket bounds (default: LATENCY_BUCKETS).
+
+    observe() does a binary search and increments preallocated slots.
+
+    """
+
+    def __init__(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+        self.name      = name
+        self.help_text = help_text
+        self.labels    = labels or {}
+        self.buckets   = tuple(buckets)
+        self.counts    = [0] * (len(self.buckets) + 1)   # Last slot is +Inf
+        self.sum       = 0.0
+        self.lock      = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, header=True):
+        lines = []
+        if header:
+            lines.append("# HELP %s %s" % (self.name, self.help_text))
+            lines.append("# TYPE %s histogram" % self.name)
+
+        with self.lock:
+            counts = list(self.counts)
+            total  = self.sum
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = dict(self.labels, le=('+Inf' if bound == float('inf') else '%g' % bound))
+            lines.append("%s_bucket%s %d" % (self.name, _format_labels(labels), cumulative))
+
+        lines.append("%s_sum%s %r" % (self.name, _format_labels(self.labels), total))
+        lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels), cumulative))
+
+        return lines
+
+
+class HistogramFamily:
+    """
+    One Histogram per value of a single label, all sharing a name.
+
+    Usage example:
+
+        phases = HistogramFamily('sh_phase_seconds', "Time per phase", 'phase',
+                                 ('parse', 'validate'))
+        phases['parse'].observe(0.0002)
+
+    """
+
+    def __init__(self, name, help_text, label, label_values, buckets=LATENCY_BUCKETS):
+        self.name      = name
+        self.help_text = help_text
+        self.children  = {value: Histogram(name, help_text, {label: value}, buckets)
+                          for value in label_values}
+
+    def __getitem__(self, label_value):
+        return self.children[label_value]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s histogram" % self.name]
+
+        for label_value in sorted(self.children):
+            lines.extend(self.children[label_value].render(header=False))
+
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics rendered together, e.g. by a /metrics endpoint.
+
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        Add 'metric' (anything with a render() method returning lines).
+
+        @returns the metric, so registration can wrap construction
+
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        @returns str - All metrics in Prometheus text format
+
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+
+    #
+    # Verify histogram buckets are cumulative and counts add up
+    #
+    print("Verify Histogram renders cumulative buckets...", end="")
+
+    histogram = Histogram('test_seconds', "Test")
+    for value in (5e-6, 15e-6, 15e-6, 100.0):
+        histogram.observe(value)
+
+    lines = histogram.render()
+
+    expected = ['test_seconds_bucket{le="1e-05"} 1',
+                'test_seconds_bucket{le="2e-05"} 3',
+                'test_seconds_bucket{le="+Inf"} 4',
+                'test_seconds_count 4']
+
+    missing = [line for line in expected if line not in lines]
+    if missing:
+        print("\n")
+        print("FAIL: missing lines %r" % missing)
+        print("FAIL: rendered %r" % lines)
+    else:
+        print("PASS")
+
+    #
+    # Verify labelled counters
+    #
+    print("Verify Counter renders one line per label value...", end="")
+
+    counter = Counter('test_total', "Test", label='status')
+    counter.inc(200)
+    counter.inc(200)
+    counter.inc(400)
+
+    lines = counter.render()
+
+    expected = ['test_total{status="200"} 2', 'test_total{status="400"} 1']
+
+    if lines[2:] != expected:
+        print("\n")
+        print("FAIL: rendered %r" % lines)
+        print("FAIL: expected %r" % expected)
+    else:
+        print("PASS")
+
+    #
+    # Verify counters read at render time are typed as counters
+    #
+    print("Verify CounterFunc renders the value it reads as a counter...", end="")
+
+    hits    = [0]
+    counter = CounterFunc('test_hits_total', "Test", lambda: hits[0])
+
+    hits[0] = 7
+    lines   = counter.render()
+    expected = ['# HELP test_hits_total Test', '# TYPE test_hits_total counter',
+                'test_hits_total 7']
+
+    if lines != expected:
+        print("\n")
+        print("FAIL: rendered %r" % lines)
+        print("FAIL: expected %r" % expected)
+    else:
+        print("PASS")
@@ -0,0 +1,172 @@
+# Prefork process manager for the SH challenge servers
+# Requires Python3 and a POSIX os.fork()
+#
+# The parent process binds one listening socket, then forks worker processes
+# that inherit it and accept connections on it directly.  Crashed workers are
+# restarted; SIGTERM/SIGINT shut every worker down gracefully.
+
+
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# Listen backlog of the shared socket
+LISTEN_BACKLOG = 1024
+
+# Seconds to wait for workers to exit after SIGTERM before killing them
+SHUTDOWN_TIMEOUT = 10
+
+# Seconds a worker waits for its in-flight requests after SIGTERM.  Shorter
+# than SHUTDOWN_TIMEOUT, so workers exit on their own before being killed.
+DRAIN_TIMEOUT = SHUTDOWN_TIMEOUT - 2
+
+# Workers that die sooner than this (seconds) after starting are restarted
+# only after RESTART_DELAY, so a worker that can't start doesn't spin
+MIN_WORKER_LIFETIME = 1
+RESTART_DELAY       = 1
+
+
+def create_listening_socket(host, port):
+    """
+    Bind and listen on a TCP socket meant to be inherited by worker processes.
+
+    @param str $host - Interface to bind to, e.g. '0.0.0.0'
+
+    @param int $port - TCP port
+
+    @returns socket.socket
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+
+    return sock
+
+
+def stop_on_signal(stop):
+    """
+    Call 'stop' from a helper thread when this process gets SIGTERM or SIGINT.
+
+    Server loops such as socketserver's serve_forever() can only be shut down
+    from another thread, hence the helper thread.
+
+    @param func $stop - Callable taking no arguments
+
+    """
+    def handler(signum, frame):
+        threading.Thread(target=stop, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT,  handler)
+
+
+def _spawn_worker(sock, worker_main):
+    """
+    Fork one worker running worker_main(sock).
+
+    @returns int - Worker pid (in the parent only; the child never returns)
+
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # Child process
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT,  signal.SIG_DFL)
+
+    exit_code = 0
+    try:
+        worker_main(sock)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def serve_prefork(sock, worker_main, num_workers):
+    """
+    Run 'num_workers' worker processes on 'sock' until SIGTERM or SIGINT.
+
+    @param socket $sock        - Listening socket (see create_listening_socket())
+
+    @param func   $worker_main - worker_main(sock) serves requests on 'sock'
+                                 until the worker gets SIGTERM, then waits
+                                 up to DRAIN_TIMEOUT for in-flight requests
+                                 and returns
+
+    @param int    $num_workers - Number of worker processes
+
+    Any worker that exits while the server is running is replaced.
+
+    """
+    workers  = {}    # pid -> start time
+    stopping = []    # Non-empty once shutdown has been requested
+
+    def request_stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT,  request_stop)
+
+    for _ in range(num_workers):
+        workers[_spawn_worker(sock, worker_main)] = time.monotonic()
+
+    print("Started %d workers on %s:%d" % ((num_workers,) + sock.getsockname()[:2]))
+
+    # Supervise workers, replacing any that exit
+    while not stopping:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        started = workers.pop(pid, None)
+        if stopping or started is None:
+            continue
+
+        print("Worker %d exited with status %d, restarting" % (pid, status))
+
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(RESTART_DELAY)
+
+        if not stopping:
+            workers[_spawn_worker(sock, worker_main)] = time.monotonic()
+
+    # Graceful shutdown: workers already got SIGTERM, give them time to finish
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    while workers and time.monotonic() < deadline:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.05)
+
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    sock.close()
@@ -0,0 +1,184 @@
+# Sampling request profiler for the SH challenge servers
+# Requires Python3
+#
+# Wraps 1 in N calls with cProfile and merges the results, so live traffic can
+# be profiled without restarting the server under a profiler.  When sampling
+# is off, each call costs one attribute check.  cProfile and pstats are only
+# imported once the first call is sampled.
+
+
+import io
+import itertools
+import marshal
+import threading
+
+
+class SamplingProfiler:
+    """
+    Profile 1 in 'sample_every' calls made through call().
+
+    Usage example:
+
+        profiler = SamplingProfiler(sample_every=100)
+        result = profiler.call(handler, request)
+        ...
+        profiler.dump_stats("route.pstats")   # Open with snakeviz, flameprof...
+
+    Only one call is profiled at a time; a sample that comes up while another
+    one is running is skipped.
+
+    """
+
+    def __init__(self, sample_every=0):
+        """
+        @param int $sample_every - Profile 1 in this many calls.  0 disables
+                                   sampling.
+
+        """
+        self.sample_every = sample_every
+        self.calls        = itertools.count()
+        self.busy         = threading.Lock()
+        self.stats_lock   = threading.Lock()
+        self.stats        = None
+        self.num_samples  = 0
+
+    def set_sample_every(self, sample_every):
+        """
+        Change the sampling rate.  0 disables sampling.
+
+        """
+        if sample_every < 0:
+            raise ValueError("sample_every must be 0 or more, not %d" % sample_every)
+
+        self.sample_every = sample_every
+
+    def call(self, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), profiling it if this call is sampled.
+
+        """
+        sample_every = self.sample_every
+        if not sample_every or next(self.calls) % sample_every:
+            return func(*args, **kwargs)
+
+        if not self.busy.acquire(blocking=False):
+            return func(*args, **kwargs)
+
+        import cProfile
+
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._merge(profile)
+        finally:
+            self.busy.release()
+
+    def _merge(self, profile):
+        import pstats
+
+        profile.create_stats()
+
+        with self.stats_lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+            self.num_samples += 1
+
+    def reset(self):
+        """
+        Discard all accumulated samples.
+
+        """
+        with self.stats_lock:
+            self.stats       = None
+            self.num_samples = 0
+
+    def stats_bytes(self):
+        """
+        @returns bytes - Merged samples in the marshal format written by
+                         pstats.Stats.dump_stats(), or b'' if there are none
+
+        """
+        with self.stats_lock:
+            if self.stats is None:
+                return b''
+
+            return marshal.dumps(self.stats.stats)
+
+    def dump_stats(self, path):
+        """
+        Write the merged samples to 'path' (pstats format).
+
+        """
+        with open(path, 'wb') as stats_file:
+            stats_file.write(self.stats_bytes())
+
+    def report(self, sort='cumulative', limit=50):
+        """
+        @returns str - Human readable summary of the merged samples
+
+        """
+        with self.stats_lock:
+            if self.stats is None:
+                return "No samples\n"
+
+            output = io.StringIO()
+            self.stats.stream = output
+            output.write("%d sampled calls\n" % self.num_samples)
+            self.stats.sort_stats(sort).print_stats(limit)
+
+            return output.getvalue()
+
+
+if __name__ == '__main__':
+
+    #
+    # Verify 1 in N calls are sampled
+    #
+    print("Verify SamplingProfiler samples 1 in 5 calls...", end="")
+
+    profiler = SamplingProfiler(sample_every=5)
+    for value in range(20):
+        profiler.call(sum, range(value))
+
+    if profiler.num_samples != 4:
+        print("\n")
+        print("FAIL: %d calls sampled" % profiler.num_samples)
+        print("FAIL: expected 4")
+    else:
+        print("PASS")
+
+    #
+    # Verify merged stats can be loaded back
+    #
+    print("Verify SamplingProfiler stats load with pstats...", end="")
+
+    stats = marshal.loads(profiler.stats_bytes())
+
+    if not any(function[2] == "<built-in method builtins.sum>" for function in stats):
+        print("\n")
+        print("FAIL: sum() missing from %r" % list(stats))
+    else:
+        print("PASS")
+
+    #
+    # Verify sampling can be switched off
+    #
+    print("Verify SamplingProfiler(0) samples nothing...", end="")
+
+    profiler.reset()
+    profiler.set_sample_every(0)
+    for value in range(20):
+        profiler.call(sum, range(value))
+
+    if profiler.num_samples or profiler.stats_bytes():
+        print("\n")
+        print("FAIL: %d calls sampled" % profiler.num_samples)
+    else:
+        print("PASS")
@@ -0,0 +1,323 @@
+# Compact recipient lists for the SH challenge
+# Requires Python3.  Uses NumPy when it is installed.
+#
+# A million recipients as Python str objects cost tens of MB of object
+# overhead.  PackedRecipients stores E.164 phone numbers as 64 bit integers
+# instead (8 bytes each), hands out zero-copy slices for routing, and turns
+# numbers back into strings only when a route is serialized.
+
+
+import array
+import collections.abc
+import sys
+
+# The numpy module once import_numpy() has loaded it, else None.  NumPy is
+# only imported when a list is first packed, so processes that never pack one
+# don't pay for the import at startup.
+numpy = None
+_numpy_imported = False
+
+# Longest E.164 number: '+' followed by up to 15 digits
+MAX_E164_LENGTH = 16
+
+# Packed E.164 numbers are 1 to this, inclusive
+MAX_E164_NUMBER = 10 ** (MAX_E164_LENGTH - 1) - 1
+
+# Bytes per number in from_bytes() input: little-endian uint64
+PACKED_NUMBER_BYTES = 8
+
+
+def import_numpy():
+    """
+    Import NumPy on first use.
+
+    @returns the numpy module, or None if NumPy isn't installed
+
+    """
+    global numpy, _numpy_imported
+
+    if not _numpy_imported:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            numpy_module = None
+
+        numpy = numpy_module
+        _numpy_imported = True
+
+    return numpy
+
+
+def is_e164(recipient):
+    """
+    Check whether 'recipient' is an E.164 number that survives a round trip
+    through an integer: '+', a non-zero digit, then up to 14 more ASCII digits.
+
+    @param str $recipient
+
+    @returns bool
+
+    """
+    digits = recipient[1:]
+
+    return (2 <= len(recipient) <= MAX_E164_LENGTH and
+            recipient[0] == '+' and
+            digits.isascii() and digits.isdigit() and
+            digits[0] != '0')
+
+
+class PackedRecipients(collections.abc.Sequence):
+    """
+    Read-only sequence of E.164 phone number strings, stored as integers.
+
+    'numbers' is a NumPy uint64 array or a memoryview of unsigned 64 bit
+    integers; both slice without copying.  Indexing returns a str, slicing
+    returns another PackedRecipients sharing the same buffer.
+
+    Usage example:
+
+        recipients = PackedRecipients.from_strings(["+15555550000", "+15555550001"])
+        recipients[0]           --> "+15555550000"
+        recipients[1:].tolist() --> ["+15555550001"]
+
+    """
+
+    def __init__(self, numbers):
+        self.numbers = numbers
+
+    @classmethod
+    def from_strings(cls, recipients, use_numpy=True):
+        """
+        Pack a list of phone number strings.
+
+        @param list $recipients - Phone number strings
+
+        @param bool $use_numpy  - Use a NumPy array if NumPy is installed,
+                                  else an array('Q')
+
+        @returns PackedRecipients, or None if any recipient isn't E.164
+
+        """
+        if not all(map(is_e164, recipients)):
+            return None
+
+        if use_numpy and import_numpy() is not None:
+            numbers = numpy.fromiter((int(recipient[1:]) for recipient in recipients),
+                                     dtype=numpy.uint64, count=len(recipients))
+        else:
+            numbers = memoryview(array.array('Q', (int(recipient[1:])
+                                                   for recipient in recipients)))
+
+        return cls(numbers)
+
+    @classmethod
+    def from_array(cls, numbers):
+        """
+        Wrap an existing array('Q') or NumPy uint64 array without copying.
+
+        """
+        if isinstance(numbers, array.array):
+            numbers = memoryview(numbers)
+
+        return cls(numbers)
+
+    @classmethod
+    def from_bytes(cls, data, use_numpy=True):
+        """
+        Unpack little-endian uint64 numbers, e.g. from a request body.
+
+        NumPy arrays are a zero-copy view of 'data'; array('Q') is filled with
+        one frombytes() copy.  Neither parses the numbers one at a time.  Use
+        get_error() to check the numbers are valid recipients.
+
+        @param bytes $data     - PACKED_NUMBER_BYTES bytes per number
+
+        @param bool $use_numpy - Use a NumPy array if NumPy is installed,
+                                 else an array('Q')
+
+        @returns PackedRecipients
+
+        Raises ValueError if 'data' isn't a whole number of numbers.
+
+        """
+        if len(data) % PACKED_NUMBER_BYTES:
+            raise ValueError("%d bytes is not a whole number of %d byte numbers"
+                             % (len(data), PACKED_NUMBER_BYTES))
+
+        if use_numpy and import_numpy() is not None:
+            return cls(numpy.frombuffer(data, dtype='<u8'))
+
+        numbers = array.array('Q')
+        numbers.frombytes(data)
+        if sys.byteorder == 'big':
+            numbers.byteswap()
+
+        return cls.from_array(numbers)
+
+    def get_error(self):
+        """
+        Check the numbers are unique E.164 numbers, like the schema checks a
+        recipient list is unique.
+
+        @returns str or None - Error message, or None if valid
+
+        """
+        numbers = self.numbers
+
+        if not len(numbers):
+            return None
+
+        if isinstance(numbers, memoryview):
+            smallest, largest = min(numbers), max(numbers)
+        else:
+            smallest, largest = int(numbers.min()), int(numbers.max())
+
+        if smallest < 1 or largest > MAX_E164_NUMBER:
+            bad = smallest if smallest < 1 else largest
+            return "%d is not an E.164 number" % bad
+
+        if isinstance(numbers, memoryview):
+            seen = set()
+            for number in numbers:
+                if number in seen:
+                    return "Duplicate recipient +%d" % number
+                seen.add(number)
+
+        else:
+            ordered = numpy.sort(numbers)
+            duplicates = numpy.flatnonzero(ordered[1:] == ordered[:-1])
+            if len(duplicates):
+                return "Duplicate recipient +%d" % ordered[duplicates[0]]
+
+        return None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise ValueError("PackedRecipients only supports contiguous slices")
+            return PackedRecipients(self.numbers[index])
+
+        return "+%d" % self.numbers[index]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        """
+        @returns list of str - The phone numbers as strings
+
+        """
+        return ["+%d" % number for number in self.numbers.tolist()]
+
+    def __repr__(self):
+        return "PackedRecipients(%d numbers)" % len(self)
+
+
+def pack_recipients(recipients, use_numpy=True):
+    """
+    Pack 'recipients' if every one of them is an E.164 number.
+
+    @param list $recipients - Phone number strings
+
+    @returns PackedRecipients, or 'recipients' unchanged if it can't be packed
+
+    """
+    packed = PackedRecipients.from_strings(recipients, use_numpy)
+
+    return recipients if packed is None else packed
+
+
+def json_default(obj):
+    """
+    'default' hook for json encoders: serialize PackedRecipients as a list of
+    strings.
+
+    """
+    if isinstance(obj, PackedRecipients):
+        return obj.tolist()
+
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+if __name__ == '__main__':
+
+    import json
+
+    test_list = ["+15555550000", "+15555550001", "+442071838750", "+999999999999999"]
+
+    for use_numpy in (False, True):
+        if use_numpy and import_numpy() is None:
+            continue
+
+        backend = "numpy" if use_numpy else "array"
+
+        #
+        # Verify packing round trips
+        #
+        print("Verify PackedRecipients (%s) round trips %r..." % (backend, test_list),
+              end="")
+
+        packed = PackedRecipients.from_strings(test_list, use_numpy)
+
+        if packed is None or packed.tolist() != test_list or list(packed) != test_list:
+            print("\n")
+            print("FAIL: unpacked %r" % (packed and packed.tolist()))
+        else:
+            print("PASS")
+
+        #
+        # Verify slices and JSON encoding
+        #
+        print("Verify PackedRecipients (%s) slices encode as JSON lists..." % backend,
+              end="")
+
+        encoded = json.dumps({"recipients": packed[1:3]}, default=json_default)
+        expected = json.dumps({"recipients": test_list[1:3]})
+
+        if encoded != expected or packed[-1] != test_list[-1]:
+            print("\n")
+            print("FAIL: encoded %s" % encoded)
+            print("FAIL: expected %s" % expected)
+        else:
+            print("PASS")
+
+        #
+        # Verify unpacking and checking little-endian uint64 bytes
+        #
+        print("Verify PackedRecipients (%s) from_bytes() and get_error()..." % backend,
+              end="")
+
+        data = b''.join(int(recipient[1:]).to_bytes(8, 'little') for recipient in test_list)
+        unpacked = PackedRecipients.from_bytes(data, use_numpy)
+
+        errors = [PackedRecipients.from_bytes(bad, use_numpy).get_error()
+                  for bad in (data + data[-8:], data + bytes(8),
+                              data + (10 ** 15).to_bytes(8, 'little'))]
+
+        if (unpacked.tolist() != test_list or unpacked.get_error() is not None or
+            errors != ["Duplicate recipient %s" % test_list[-1], "0 is not an E.164 number",
+                       "%d is not an E.164 number" % 10 ** 15]):
+            print("\n")
+            print("FAIL: unpacked %r, errors %r" % (unpacked.tolist(), errors))
+        else:
+            print("PASS")
+
+    #
+    # Verify non E.164 lists are left alone
+    #
+    print("Verify pack_recipients() leaves non E.164 lists unchanged...", end="")
+
+    failed = False
+
+    for test_list in (["+15555550000", "5555550001"], ["+05555550000"], ["+"],
+                      ["+1555555000012345"], ["+1555٥"], ["+1 555"]):
+        if pack_recipients(test_list) is not test_list:
+            print("\n")
+            print("FAIL: packed %r" % test_list)
+            failed = True
+
+    if not failed:
+        print("PASS")
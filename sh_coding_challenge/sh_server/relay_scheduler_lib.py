@@ -0,0 +1,348 @@
+# Load-balanced relay assignment for the SH challenge
+# Requires Python3
+#
+# get_routes() on its own numbers relays from .1 in every request, so every
+# small request lands on the same four relays.  RelayScheduler tracks the
+# outstanding routes of each relay across requests and hands out the least
+# loaded ones instead (or round robin / power of two choices).
+
+
+import heapq
+import random
+import threading
+
+import router_lib
+
+STRATEGIES = ('least_loaded', 'round_robin', 'p2c')
+
+# Stale least_loaded heap entries are dropped once the heap grows past this
+# many entries per relay
+HEAP_COMPACT_FACTOR = 4
+
+
+class _TierPool:
+    """
+    Relays of one tier and their outstanding load.
+
+    """
+
+    def __init__(self, ips):
+        self.ips    = ips
+        self.loads  = [0] * len(ips)
+        self.heap   = [(0, index) for index in range(len(ips))]
+        self.cursor = 0
+
+    def extend(self, ips):
+        """
+        Add idle relays after the existing ones.
+
+        """
+        for ip in ips:
+            heapq.heappush(self.heap, (0, len(self.ips)))
+            self.ips.append(ip)
+            self.loads.append(0)
+
+    def add(self, index, amount):
+        self.loads[index] += amount
+        heapq.heappush(self.heap, (self.loads[index], index))
+
+        if len(self.heap) > HEAP_COMPACT_FACTOR * len(self.ips):
+            self.heap = [(load, index) for index, load in enumerate(self.loads)]
+            heapq.heapify(self.heap)
+
+    def pop_least_loaded(self):
+        """
+        @returns int - Index of the least loaded relay, lowest index on ties
+
+        """
+        while True:
+            load, index = heapq.heappop(self.heap)
+            if load == self.loads[index]:
+                return index
+
+
+class RelayScheduler:
+    """
+    Assign routes to relays across requests, balancing outstanding load
+    within each tier.
+
+    Usage example:
+
+        scheduler = RelayScheduler(strategy='least_loaded')
+        routes = router_lib.get_routes(recipients, scheduler=scheduler)
+        ...                                   # Send the routes
+        scheduler.release(route['ip'] for route in routes)
+
+    Strategies:
+        least_loaded - relay with the fewest outstanding routes (a heap per
+                       tier); with no load, relays are used from .1 upward
+                       like the plain route plan
+        round_robin  - next relays in turn, ignoring load
+        p2c          - the less loaded of two random relays
+
+    A relay's load is the number of routes assigned to it and not yet
+    released.  Callers that never call release(), like the servers, get
+    cumulative balancing instead: least_loaded and p2c even out the total
+    number of routes each relay has been given.  Loads live in this object,
+    so every process (e.g. each prefork worker) balances on its own.
+
+    A request needing more routes than a tier's pool has relays grows the
+    pool into the tier's overflow subnets, a whole subnet at a time, like the
+    plain route plan.
+
+    """
+
+    def __init__(self, tiers=router_lib.DEFAULT_TIERS,
+                 pool_size=router_lib.MAX_HOSTS_PER_SUBNET,
+                 strategy='least_loaded', seed=None):
+        """
+        @param list $tiers     - Tier table (see router_lib.get_routes())
+
+        @param int  $pool_size - Relays per tier to start with, taken in
+                                 router_lib.tier_ips() order.  Pools grow
+                                 when a request needs more.
+
+        @param str  $strategy  - One of STRATEGIES
+
+        @param int  $seed      - Random seed for the p2c strategy
+
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy %r, expected one of %r" % (strategy, STRATEGIES))
+
+        if pool_size < 1:
+            raise ValueError("pool_size must be 1 or more, not %d" % pool_size)
+
+        self.tier_table = router_lib.sort_tiers(tiers)
+        self.strategy   = strategy
+        self.random     = random.Random(seed)
+        self.lock       = threading.Lock()
+
+        self.pools      = [_TierPool(router_lib.tier_ips(tier, pool_size))
+                           for tier in self.tier_table]
+
+        # ip -> (pool, index), for release()
+        self.relays     = {ip: (pool, index)
+                           for pool in self.pools
+                           for index, ip in enumerate(pool.ips)}
+
+        self._pick      = getattr(self, '_pick_' + strategy)
+
+    def assign(self, tier_counts):
+        """
+        Pick relays for one request and add the routes to their load.
+
+        @param tuple $tier_counts - ((size, count), ...) per tier, as returned
+                                    by router_lib.solve_tier_counts() for
+                                    this scheduler's tier_table
+
+        @returns list of IP strings - One per route, in route plan order
+
+        """
+        ips = []
+
+        with self.lock:
+            for tier, pool, (size, count) in zip(self.tier_table, self.pools, tier_counts):
+                if count > len(pool.ips):
+                    self._grow(tier, pool, count)
+
+                ips.extend(self._pick(pool, count))
+
+        return ips
+
+    def _grow(self, tier, pool, count):
+        """
+        Extend 'pool' to the whole subnets of 'tier' holding 'count' relays.
+
+        Raises ValueError if the tier's subnets hold fewer than 'count'.
+
+        """
+        subnets = -(-count // router_lib.MAX_HOSTS_PER_SUBNET)
+        new_ips = router_lib.tier_ips(tier, subnets * router_lib.MAX_HOSTS_PER_SUBNET)[
+            len(pool.ips):]
+
+        start = len(pool.ips)
+        pool.extend(new_ips)
+
+        for index, ip in enumerate(new_ips, start):
+            self.relays[ip] = (pool, index)
+
+    def release(self, ips):
+        """
+        Remove finished routes from their relays' load.
+
+        @param iterable $ips - Relay IP of each finished route
+
+        """
+        with self.lock:
+            for ip in ips:
+                pool, index = self.relays[ip]
+                if pool.loads[index] > 0:
+                    pool.add(index, -1)
+
+    def loads(self):
+        """
+        @returns dict - {tier name: {ip: outstanding routes}} for loaded relays
+
+        """
+        with self.lock:
+            return {tier.name: {ip: load for ip, load in zip(pool.ips, pool.loads) if load}
+                    for tier, pool in zip(self.tier_table, self.pools)}
+
+    def _pick_least_loaded(self, pool, count):
+        ips = []
+
+        for _ in range(count):
+            index = pool.pop_least_loaded()
+            pool.add(index, 1)
+            ips.append(pool.ips[index])
+
+        return ips
+
+    def _pick_round_robin(self, pool, count):
+        num_relays = len(pool.ips)
+        indexes = [(pool.cursor + offset) % num_relays for offset in range(count)]
+        pool.cursor = (pool.cursor + count) % num_relays
+
+        for index in indexes:
+            pool.loads[index] += 1
+
+        return [pool.ips[index] for index in indexes]
+
+    def _pick_p2c(self, pool, count):
+        num_relays = len(pool.ips)
+        loads      = pool.loads
+        randrange  = self.random.randrange
+        ips        = []
+
+        for _ in range(count):
+            first, second = randrange(num_relays), randrange(num_relays)
+            index = first if (loads[first], first) <= (loads[second], second) else second
+            pool.add(index, 1)
+            ips.append(pool.ips[index])
+
+        return ips
+
+
+if __name__ == '__main__':
+
+    #
+    # Verify an idle least_loaded scheduler matches the plain route plan
+    #
+    print("Verify idle least_loaded scheduler matches get_route_plan()...", end="")
+
+    failed = False
+
+    for num_recipients in (1, 12, 41, 6000):
+        scheduler = RelayScheduler()
+        tier_counts = router_lib.solve_tier_counts(num_recipients, scheduler.tier_table)
+        plan = router_lib.get_route_plan(num_recipients, scheduler.tier_table)
+
+        ips = scheduler.assign(tier_counts)
+        if ips != [ip for ip, start, stop in plan]:
+            print("\n")
+            print("FAIL: %d recipients assigned %r" % (num_recipients, ips[:8]))
+            failed = True
+
+    if not failed:
+        print("PASS")
+
+    #
+    # Verify repeated small requests are spread over the relays
+    #
+    for strategy in STRATEGIES:
+        print("Verify %s spreads 1000 one-recipient requests..." % strategy, end="")
+
+        scheduler = RelayScheduler(strategy=strategy, seed=1)
+        for _ in range(1000):
+            scheduler.assign(router_lib.solve_tier_counts(1, scheduler.tier_table))
+
+        small = scheduler.loads()['small']
+        bound = 6 if strategy == 'p2c' else 4
+
+        if len(small) != 254 or max(small.values()) > bound:
+            print("\n")
+            print("FAIL: %d relays used, max load %d" % (len(small), max(small.values())))
+        else:
+            print("PASS")
+
+    #
+    # Verify a tier needing more relays than its pool grows into its
+    # overflow subnets instead of reusing relays
+    #
+    print("Verify pools grow into overflow subnets for large requests...", end="")
+
+    failed = False
+
+    for strategy in STRATEGIES:
+        scheduler   = RelayScheduler(strategy=strategy, seed=1)
+        tier_counts = router_lib.solve_tier_counts(10000, scheduler.tier_table)
+
+        ips = scheduler.assign(tier_counts)
+
+        if (len(set(ips)) != len(ips) and strategy != 'p2c' or
+            len(scheduler.pools[0].ips) != 2 * router_lib.MAX_HOSTS_PER_SUBNET or
+            "10.1.4.1" not in scheduler.relays):
+            print("\n")
+            print("FAIL: %s put %d routes on %d relays" % (strategy, len(ips), len(set(ips))))
+            failed = True
+
+        scheduler.release(ips)
+        if any(scheduler.loads().values()):
+            print("\n")
+            print("FAIL: %s loads left after release: %r" % (strategy, scheduler.loads()))
+            failed = True
+
+    if not failed:
+        print("PASS")
+
+    #
+    # Verify release() frees relays for the next request
+    #
+    print("Verify release() returns relays to the least loaded pool...", end="")
+
+    scheduler = RelayScheduler(pool_size=3)
+    first  = scheduler.assign(((25, 0), (10, 0), (5, 0), (1, 2)))
+    scheduler.release(first[:1])
+    second = scheduler.assign(((25, 0), (10, 0), (5, 0), (1, 2)))
+
+    if first != ["10.0.1.1", "10.0.1.2"] or second != ["10.0.1.1", "10.0.1.3"]:
+        print("\n")
+        print("FAIL: assigned %r then %r" % (first, second))
+    else:
+        print("PASS")
+
+    #
+    # Verify get_routes() uses the scheduler's relays on both backends
+    #
+    print("Verify get_routes(scheduler=...) spreads consecutive requests...", end="")
+
+    import recipients_lib
+
+    recipients = recipients_lib.PackedRecipients.from_strings(
+        ["+1555%07d" % index for index in range(router_lib.NUMPY_MIN_RECIPIENTS + 12)])
+
+    scheduler = RelayScheduler()
+    failed    = False
+
+    for backend in ('python', 'numpy'):
+        first  = router_lib.get_routes(recipients[:12], backend=backend, scheduler=scheduler)
+        second = router_lib.get_routes(recipients, backend=backend, scheduler=scheduler)
+
+        first_ips  = {route['ip'] for route in first}
+        second_ips = {route['ip'] for route in second}
+
+        if (first_ips & second_ips or
+            [len(route['recipients']) for route in second] !=
+            [len(route['recipients']) for route in router_lib.get_routes(recipients)]):
+            print("\n")
+            print("FAIL: %s backend reused %r" % (backend, sorted(first_ips & second_ips)))
+            failed = True
+
+        scheduler.release(route['ip'] for route in first + second)
+
+    if not failed and not any(scheduler.loads().values()):
+        print("PASS")
+    elif not failed:
+        print("\n")
+        print("FAIL: loads left after release: %r" % scheduler.loads())
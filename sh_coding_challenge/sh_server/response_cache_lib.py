@@ -0,0 +1,240 @@
+# Idempotent response cache for the SH challenge servers
+# Requires Python3
+#
+# Upstream retries re-send identical /route requests.  ResponseCache keeps the
+# serialized response of recent requests, keyed by an Idempotency-Key header
+# or a hash of the raw request body, so a retry is answered with the stored
+# bytes without re-validating or re-routing.
+
+
+import collections
+import hashlib
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES   = 64 * 1024 * 1024
+DEFAULT_TTL         = 60     # Seconds
+
+
+def request_key(path, body, idempotency_key=None):
+    """
+    Build a cache key for a request.
+
+    @param str   $path            - Request path and query string; requests for
+                                    different endpoints or formats never share
+                                    an entry
+
+    @param bytes $body            - Raw request body
+
+    @param str   $idempotency_key - Client supplied Idempotency-Key header, if
+                                    any.  When given it identifies the request
+                                    and the body isn't hashed.
+
+    @returns bytes
+
+    """
+    if idempotency_key:
+        return b'key:' + path.encode('utf-8') + b'\0' + idempotency_key.encode('utf-8')
+
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+
+    return b'body:' + path.encode('utf-8') + b'\0' + digest
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses, bounded by entry count and total body
+    bytes, with per-entry TTL.
+
+    Usage example:
+
+        cache = ResponseCache(max_entries=1000, max_bytes=2**26, ttl=60)
+        key = request_key('/route', body)
+        cached = cache.get(key)
+        if cached is None:
+            status, response_body = handle(body)
+            cache.put(key, status, response_body)
+
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.ttl         = ttl
+        self.clock       = clock
+
+        self.entries     = collections.OrderedDict()   # key -> (expires, status, body)
+        self.num_bytes   = 0
+
+        # key -> expires, in insertion order.  With one TTL for every entry,
+        # that is also expiry order, so expired entries are always at the
+        # front.
+        self.expiry      = collections.OrderedDict()
+        self.lock        = threading.Lock()
+
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+
+    def get(self, key):
+        """
+        @returns (int, bytes) - Stored (status, body), or None on a miss
+
+        """
+        now = self.clock()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1], entry[2]
+
+    def put(self, key, status, body):
+        """
+        Store a serialized response.  Bodies larger than the whole byte budget
+        are not stored.
+
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        expires = self.clock() + self.ttl
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (expires, status, body)
+            self.expiry[key]  = expires
+            self.num_bytes += len(body)
+
+            # Evict expired entries first, then least recently used ones
+            now = self.clock()
+            while self.expiry:
+                old_key, old_expires = next(iter(self.expiry.items()))
+                if old_expires > now:
+                    break
+
+                self._remove(old_key)
+                self.evictions += 1
+
+            while (len(self.entries) > self.max_entries or
+                   self.num_bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires, status, body = self.entries.pop(key)
+        del self.expiry[key]
+        self.num_bytes -= len(body)
+
+    def hit_rate(self):
+        """
+        @returns float - Fraction of lookups that were hits (0.0 if none)
+
+        """
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups else 0.0
+
+
+if __name__ == '__main__':
+
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    #
+    # Verify hits, misses and TTL expiry
+    #
+    print("Verify ResponseCache hits and TTL expiry...", end="")
+
+    clock = FakeClock()
+    cache = ResponseCache(max_entries=10, max_bytes=100, ttl=5, clock=clock)
+    key   = request_key('/route', b'{"message": "SH Rocks"}')
+
+    cache.put(key, 200, b'response')
+    first = cache.get(key)
+
+    clock.now = 6
+    second = cache.get(key)
+
+    if first != (200, b'response') or second is not None or (cache.hits, cache.misses) != (1, 1):
+        print("\n")
+        print("FAIL: got %r then %r, hits=%d misses=%d"
+              % (first, second, cache.hits, cache.misses))
+    else:
+        print("PASS")
+
+    #
+    # Verify entry and byte bounds
+    #
+    print("Verify ResponseCache stays within its entry and byte bounds...", end="")
+
+    cache = ResponseCache(max_entries=3, max_bytes=25, ttl=60, clock=FakeClock())
+
+    for index in range(5):
+        cache.put(request_key('/route', b'%d' % index), 200, b'x' * 10)
+
+    cache.put(request_key('/route', b'too big'), 200, b'x' * 26)
+
+    if len(cache.entries) != 2 or cache.num_bytes != 20:
+        print("\n")
+        print("FAIL: %d entries, %d bytes" % (len(cache.entries), cache.num_bytes))
+        print("FAIL: expected 2 entries, 20 bytes")
+    else:
+        print("PASS")
+
+    #
+    # Verify put() evicts expired entries, even recently used ones
+    #
+    print("Verify ResponseCache put() evicts expired entries...", end="")
+
+    clock = FakeClock()
+    cache = ResponseCache(max_entries=10, max_bytes=100, ttl=5, clock=clock)
+
+    for index in range(3):
+        clock.now = index
+        cache.put(request_key('/route', b'%d' % index), 200, b'x')
+
+    # Used last, but stored first: still the first to expire
+    cache.get(request_key('/route', b'0'))
+
+    clock.now = 6
+    cache.put(request_key('/route', b'3'), 200, b'x')
+
+    if (len(cache.entries), len(cache.expiry), cache.evictions) != (2, 2, 2):
+        print("\n")
+        print("FAIL: %d entries, %d expiry entries, %d evictions"
+              % (len(cache.entries), len(cache.expiry), cache.evictions))
+        print("FAIL: expected 2, 2, 2")
+    else:
+        print("PASS")
+
+    #
+    # Verify Idempotency-Key takes precedence over the body
+    #
+    print("Verify request_key() uses the Idempotency-Key when given...", end="")
+
+    if (request_key('/route', b'a', 'k1') != request_key('/route', b'b', 'k1') or
+        request_key('/route', b'a') == request_key('/route', b'b') or
+        request_key('/route', b'a') == request_key('/route?stream=1', b'a')):
+        print("\n")
+        print("FAIL: unexpected key collisions")
+    else:
+        print("PASS")
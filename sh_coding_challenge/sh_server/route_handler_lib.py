@@ -0,0 +1,658 @@
+# Framework-independent handling of SH challenge /route payloads
+# Requires Python3
+
+import json
+import os
+import struct
+
+import itertools_ext_lib
+import recipients_lib
+import relay_scheduler_lib
+import router_lib
+from SHJsonValidator import SHJsonValidator
+
+# Every successful response carries this message
+RESPONSE_MESSAGE = 'SH Rocks'
+
+# Routes encoded per chunk of a streamed response
+STREAM_CHUNK_ROUTES = 256
+
+# Requests with at least this many recipients are always streamed
+STREAM_MIN_RECIPIENTS = 10000
+
+# Requests with at least this many recipients are packed into integers
+# (see recipients_lib) once validated
+PACK_MIN_RECIPIENTS = 10000
+
+# Routing modes, selected with /route?mode=...
+#   plan     - recipients fill the cached route plan in request order
+#   affinity - recipients are placed on relays by consistent hashing, see
+#              router_lib.get_affinity_routes()
+ROUTE_MODES = ('plan', 'affinity')
+
+# Response formats, selected with /route?format=...
+#   full    - one {"ip": ..., "recipients": [...]} object per route
+#   compact - per tier, the relay IPs and the block of the request's
+#             recipients they cover (see router_lib.get_compact_routes());
+#             plan mode only
+ROUTE_FORMATS = ('full', 'compact')
+
+# Content type of /route/stream request and response bodies
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Bytes read from a streamed request body at a time
+STREAM_READ_SIZE = 64 * 1024
+
+# Recipient lines of a streamed upload decoded per json.loads() call
+STREAM_DECODE_LINES = 1024
+
+# Content type of the compact binary /route request body:
+#   uint32 message length, UTF-8 message, uint32 recipient count, then one
+#   uint64 E.164 number per recipient (without the '+'), all little-endian
+PACKED_MIMETYPE = 'application/x-sh-route'
+
+# Length and count fields of a packed request body
+PACKED_LENGTH = struct.Struct('<I')
+
+# HTTP status of valid requests with more recipients than the relays can
+# carry (see check_capacity())
+CAPACITY_STATUS = 413
+
+# prewarm() fills the route plan cache for requests of 1 to this many
+# recipients
+PREWARM_PLAN_SIZES = 256
+
+# Same output format as Flask's jsonify() outside debug mode
+json_encoder = json.JSONEncoder(separators=(',', ':'), sort_keys=True,
+                                default=recipients_lib.json_default)
+
+json_validator = SHJsonValidator()
+
+# Opt-in cumulative relay balancing across requests (see relay_scheduler_lib):
+# SH_RELAY_SCHEDULER=least_loaded, round_robin or p2c.  The server only plans
+# routes and never learns when they are sent, so it never calls release():
+# least_loaded and p2c balance the number of routes each relay has been
+# given so far, not routes in flight.  Each prefork worker (--workers N) has
+# its own scheduler and balances only the requests it serves.
+relay_scheduler = None
+if os.environ.get('SH_RELAY_SCHEDULER'):
+    relay_scheduler = relay_scheduler_lib.RelayScheduler(
+        strategy=os.environ['SH_RELAY_SCHEDULER'])
+
+
+def prewarm():
+    """
+    Do the one-off work of the first requests ahead of time, e.g. before a
+    server starts accepting traffic:
+
+        - import jsonschema and build the schema validator, which is
+          otherwise deferred until the first invalid payload
+        - solve the tier tables and cache the route plans of small requests
+        - import NumPy and pack, route and encode a PACK_MIN_RECIPIENTS list
+        - build the consistent hash rings of the affinity mode
+
+    The relay scheduler, if any, is left untouched.
+
+    """
+    validate_payload({"message": RESPONSE_MESSAGE, "recipients": []})
+
+    tier_table = router_lib.sort_tiers(router_lib.DEFAULT_TIERS)
+    for num_recipients in range(1, PREWARM_PLAN_SIZES + 1):
+        router_lib.get_route_plan(num_recipients, tier_table)
+
+    payload = {"message": RESPONSE_MESSAGE,
+               "recipients": ["+1555%07d" % index for index in range(PACK_MIN_RECIPIENTS)]}
+
+    if validate_payload(payload) is None:
+        recipients = prepare_recipients(payload)
+        json_encoder.encode({'message': RESPONSE_MESSAGE,
+                             'routes': router_lib.get_routes(recipients)})
+
+    router_lib.get_affinity_routes(payload['recipients'][:PREWARM_PLAN_SIZES])
+
+
+def route_payload(payload, mode='plan', response_format='full'):
+    """
+    Validate a decoded /route payload and build its response object.
+
+    Shared by every server front end (Flask, asyncio), so they all honor the
+    same contract.
+
+    @param obj $payload         - Decoded JSON request body
+
+    @param str $mode            - Routing mode, one of ROUTE_MODES
+
+    @param str $response_format - Response format, one of ROUTE_FORMATS
+
+    @returns (dict, int) - Response object and HTTP status code:
+        ({"message": "SH Rocks", "routes": [...]}, 200) on success
+        ({"error": "<validation error>"}, 400)            on invalid input
+        ({"error": "<capacity error>"}, CAPACITY_STATUS)  on too many recipients
+
+    """
+    error = (check_mode(mode) or check_format(response_format, mode) or
+             validate_payload(payload))
+    if error is not None:
+        return {"error": error}, 400
+
+    error = check_capacity(len(payload['recipients']))
+    if error is not None:
+        return {"error": error}, CAPACITY_STATUS
+
+    recipients = prepare_recipients(payload, response_format)
+
+    return build_route_response(recipients, mode, response_format), 200
+
+
+def check_mode(mode):
+    """
+    @param str $mode - Requested routing mode
+
+    @returns str or None - Error message, or None if 'mode' is in ROUTE_MODES
+
+    """
+    if mode not in ROUTE_MODES:
+        return "Unknown mode %r, expected one of %s" % (mode, ", ".join(ROUTE_MODES))
+
+    return None
+
+
+def check_capacity(num_recipients):
+    """
+    Check the relays can carry a valid request of 'num_recipients'
+    recipients, so it is turned away before any route is built.
+
+    @param int $num_recipients - Number of recipients in the request
+
+    @returns str or None - Error message, or None if the request fits
+
+    """
+    if relay_scheduler is None:
+        tier_table = router_lib.sort_tiers(router_lib.DEFAULT_TIERS)
+    else:
+        tier_table = relay_scheduler.tier_table
+
+    return router_lib.capacity_error(num_recipients, tier_table)
+
+
+def check_format(response_format, mode='plan'):
+    """
+    @param str $response_format - Requested response format
+
+    @param str $mode            - Requested routing mode
+
+    @returns str or None - Error message, or None if 'response_format' is in
+                           ROUTE_FORMATS and works with 'mode'
+
+    """
+    if response_format not in ROUTE_FORMATS:
+        return ("Unknown format %r, expected one of %s"
+                % (response_format, ", ".join(ROUTE_FORMATS)))
+
+    # Affinity routes aren't contiguous blocks of the request
+    if response_format == 'compact' and mode != 'plan':
+        return "Format 'compact' only supports mode 'plan', not %r" % mode
+
+    return None
+
+
+def prepare_recipients(payload, response_format='full'):
+    """
+    Return the recipients of a validated payload in their routing form.
+
+    Large recipient lists of E.164 numbers are packed into integers, and the
+    packed copy replaces the string list in 'payload' so the strings can be
+    freed before the response is built.  Packed request bodies already are.
+    Compact responses never look at the recipients, so they're left alone.
+
+    @param dict $payload         - Validated /route payload.  Modified in
+                                   place.
+
+    @param str  $response_format - Response format, one of ROUTE_FORMATS
+
+    @returns list or recipients_lib.PackedRecipients
+
+    """
+    recipients = payload['recipients']
+
+    if response_format == 'compact':
+        return recipients
+
+    if type(recipients) is list and len(recipients) >= PACK_MIN_RECIPIENTS:
+        recipients = recipients_lib.pack_recipients(recipients)
+        payload['recipients'] = recipients
+
+    return recipients
+
+
+def validate_payload(payload):
+    """
+    Check a decoded /route payload against the SH Challenge schema.
+
+    @param obj $payload - Decoded JSON request body, or a packed one from
+                          decode_packed_payload(), which is already valid
+
+    @returns str or None - Validation error message, or None if valid
+
+    """
+    if (type(payload) is dict and
+        isinstance(payload.get('recipients'), recipients_lib.PackedRecipients)):
+        return None
+
+    return json_validator.get_error(payload)
+
+
+def encode_packed_payload(message, recipients):
+    """
+    Encode a /route request body in the PACKED_MIMETYPE format.
+
+    @param str  $message    - Message text
+
+    @param list $recipients - E.164 phone number strings
+
+    @returns bytes
+
+    """
+    message = message.encode('utf-8')
+
+    return b''.join((PACKED_LENGTH.pack(len(message)), message,
+                     PACKED_LENGTH.pack(len(recipients)),
+                     b''.join(int(recipient[1:]).to_bytes(recipients_lib.PACKED_NUMBER_BYTES,
+                                                          'little')
+                              for recipient in recipients)))
+
+
+def decode_packed_payload(body):
+    """
+    Decode and validate a PACKED_MIMETYPE /route request body.
+
+    The recipients are unpacked straight from the body bytes (see
+    recipients_lib.PackedRecipients.from_bytes()) rather than parsed one by
+    one, and checked against the same rules as the JSON schema: at least one
+    recipient, no duplicates.
+
+    @param bytes $body - Request body
+
+    @returns dict - {"message": str, "recipients": PackedRecipients}, ready
+                    for build_route_response()
+
+    Raises ValueError with the error message on invalid input.
+
+    """
+    body = memoryview(body)
+
+    try:
+        message_length, = PACKED_LENGTH.unpack_from(body)
+        message_end = PACKED_LENGTH.size + message_length
+        count, = PACKED_LENGTH.unpack_from(body, message_end)
+    except struct.error:
+        raise ValueError("Packed body is truncated")
+
+    numbers_start = message_end + PACKED_LENGTH.size
+    expected = numbers_start + count * recipients_lib.PACKED_NUMBER_BYTES
+    if len(body) != expected:
+        raise ValueError("Packed body of %d recipients must be %d bytes, not %d"
+                         % (count, expected, len(body)))
+
+    try:
+        message = str(body[PACKED_LENGTH.size:message_end], 'utf-8')
+    except UnicodeDecodeError as exc:
+        raise ValueError("Invalid message: %s" % exc)
+
+    if not count:
+        raise ValueError("No recipients")
+
+    recipients = recipients_lib.PackedRecipients.from_bytes(body[numbers_start:])
+
+    error = recipients.get_error()
+    if error is not None:
+        raise ValueError(error)
+
+    return {"message": message, "recipients": recipients}
+
+
+def build_route_response(recipients, mode='plan', response_format='full'):
+    """
+    Build the /route response object for validated 'recipients'.
+
+    @param list $recipients      - Validated recipient phone numbers, as a
+                                   list or recipients_lib.PackedRecipients
+
+    @param str  $mode            - Routing mode, one of ROUTE_MODES
+
+    @param str  $response_format - Response format, one of ROUTE_FORMATS.
+                                   Must pass check_format() with 'mode'.
+
+    @returns dict - {"message": "SH Rocks", "routes": [...]}, or for the
+                    compact format {"message": "SH Rocks", "tiers": [...]}
+
+    """
+    if response_format == 'compact':
+        tiers = router_lib.get_compact_routes(len(recipients), scheduler=relay_scheduler)
+        return {'message': RESPONSE_MESSAGE, 'tiers': tiers}
+
+    if mode == 'affinity':
+        routes = router_lib.get_affinity_routes(recipients)
+    else:
+        routes = router_lib.get_routes(recipients=recipients, scheduler=relay_scheduler)
+
+    response = {'message': RESPONSE_MESSAGE}
+    response['routes'] = routes
+
+    return response
+
+
+def iter_route_response_json(recipients, mode='plan'):
+    """
+    Stream the JSON encoding of a /route response for an already validated
+    list of recipients.
+
+    Routes are encoded as they are produced and flushed in chunks of
+    STREAM_CHUNK_ROUTES, so memory use is bounded by the chunk size and the
+    first bytes go out before the last route is built.
+
+    @param list $recipients - Validated recipient phone numbers
+
+    @param str  $mode       - Routing mode, one of ROUTE_MODES.  Affinity
+                              routes are all placed before the first one is
+                              encoded.
+
+    @yields str - Consecutive pieces of the response body.  Joined, they equal
+                  the body jsonify() would produce.
+
+    """
+    yield '{"message":%s,"routes":[' % json_encoder.encode(RESPONSE_MESSAGE)
+
+    separator = ''
+    chunk     = []
+
+    if mode == 'affinity':
+        routes = router_lib.get_affinity_routes(recipients)
+    else:
+        routes = router_lib.iter_routes(recipients, scheduler=relay_scheduler)
+
+    for route in routes:
+        chunk.append(json_encoder.encode(route))
+
+        if len(chunk) >= STREAM_CHUNK_ROUTES:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk     = []
+
+    if chunk:
+        yield separator + ','.join(chunk)
+
+    yield ']}\n'
+
+
+class StreamError(Exception):
+    """
+    Invalid input found part way through a streamed /route upload.
+
+    """
+
+
+def iter_body_lines(stream, read_size=STREAM_READ_SIZE):
+    """
+    Split a request body stream into lines while it is being read.
+
+    Reads blocks of 'read_size' bytes, so unbuffered WSGI input (e.g. a
+    dechunked body, where readline() reads one byte at a time) stays fast.
+    Memory use is one block plus one line.
+
+    @param file $stream - Binary file-like object with read()
+
+    @yields bytes - Lines, without their line endings
+
+    """
+    partial = b''
+
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+
+        lines = (partial + block).split(b'\n')
+        partial = lines.pop()
+
+        yield from lines
+
+    if partial:
+        yield partial
+
+
+def check_stream_header(line):
+    """
+    Validate the first line of a /route/stream upload: a JSON object with a
+    string "message".
+
+    @param bytes $line - First line of the request body
+
+    @returns str or None - Validation error message, or None if valid
+
+    """
+    try:
+        header = json.loads(line)
+    except ValueError as exc:
+        return "Invalid JSON: %s" % exc
+
+    if type(header) is not dict or type(header.get('message')) is not str:
+        return "First line must be an object with a string 'message'"
+
+    return None
+
+
+def iter_stream_recipients(lines):
+    """
+    Decode and validate the recipient lines of a /route/stream upload, one
+    JSON string per line, as they are read.
+
+    Lines are decoded STREAM_DECODE_LINES at a time with a single json.loads()
+    call, separated by a comma and a newline.  A JSON string can't hold a
+    raw newline, so no string spans two lines (e.g. '"c' and '"' can't join
+    into "c,"), and a batch decoding to one string per line therefore has
+    exactly one string on every line.  Any other batch is decoded again line
+    by line to report the bad line.  Uniqueness is checked against a set of
+    the recipients seen so far.
+
+    @param itr $lines - Remaining request body lines (bytes).  Blank lines
+                        are skipped.
+
+    @yields str - Recipient phone numbers
+
+    Raises StreamError on a line that isn't a JSON string, on a duplicate
+    recipient, or at the end of input if there were no recipients.
+
+    """
+    seen = set()
+
+    for batch in itertools_ext_lib.igrouper(filter(bytes.strip, lines), STREAM_DECODE_LINES):
+        try:
+            recipients = json.loads(b'[' + b',\n'.join(batch) + b']')
+        except ValueError:
+            recipients = None
+
+        if (recipients is None or len(recipients) != len(batch) or
+            not all(type(recipient) is str for recipient in recipients)):
+            recipients = [_decode_stream_recipient(line) for line in batch]
+
+        for recipient in recipients:
+            if recipient in seen:
+                raise StreamError("Duplicate recipient %s" % recipient)
+
+            seen.add(recipient)
+
+        yield from recipients
+
+    if not seen:
+        raise StreamError("No recipients")
+
+
+def _decode_stream_recipient(line):
+    """
+    Decode one recipient line, raising StreamError if it isn't a JSON string.
+
+    """
+    try:
+        recipient = json.loads(line)
+    except ValueError as exc:
+        raise StreamError("Invalid JSON: %s" % exc)
+
+    if type(recipient) is not str:
+        raise StreamError("%r is not of type 'string'" % (recipient,))
+
+    return recipient
+
+
+def iter_route_stream(lines):
+    """
+    Route a /route/stream upload while it is being read.
+
+    The response is NDJSON: a {"message": "SH Rocks"} line, then one route
+    object per line in /route order.  Largest tier routes go out as soon as
+    their recipients have been read; the smaller tiers follow at the end of
+    the upload (see router_lib.iter_stream_routes()).  Invalid input, or more
+    recipients than the relays can carry, ends the stream with an
+    {"error": ...} line, after any routes already sent.
+
+    @param itr $lines - Request body lines (bytes) after the header line,
+                        which must already have passed check_stream_header()
+
+    @yields str - Response lines, each ending in a newline
+
+    """
+    yield json_encoder.encode({"message": RESPONSE_MESSAGE}) + '\n'
+
+    try:
+        for route in router_lib.iter_stream_routes(iter_stream_recipients(lines)):
+            yield json_encoder.encode(route) + '\n'
+
+    # ValueError: more recipients than the relays can carry
+    except (StreamError, ValueError) as exc:
+        yield json_encoder.encode({"error": str(exc)}) + '\n'
+
+
+def route_batch(payloads):
+    """
+    Validate and route many /route payloads in one pass.
+
+    @param list $payloads - Decoded /route payloads
+
+    @returns list - One response object per payload, in input order.  Invalid
+                    payloads get an {"error": ...} object instead of failing
+                    the whole batch.
+
+    """
+    return [route_payload(payload)[0] for payload in payloads]
+
+
+def route_ndjson_batch(body):
+    """
+    Route a newline-delimited JSON batch: one /route payload per line.
+
+    @param bytes $body - NDJSON request body.  Blank lines are skipped.
+
+    @returns list - One response object per non-blank line, in input order.
+                    Lines that aren't valid JSON get an {"error": ...} object.
+
+    """
+    results = []
+
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            payload = json.loads(line)
+        except ValueError as exc:
+            results.append({"error": "Invalid JSON: %s" % exc})
+            continue
+
+        results.append(route_payload(payload)[0])
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import sys
+
+    #
+    # Verify streamed responses are byte-identical to the whole response,
+    # encoded like jsonify() (sorted keys, compact, trailing newline)
+    #
+    print("Verify iter_route_response_json() matches the unstreamed response...", end="")
+
+    # The second size spans more than STREAM_CHUNK_ROUTES routes
+    for num_recipients in (1, 43, STREAM_CHUNK_ROUTES * 25 + 43):
+        recipients = ["+1555%07d" % index for index in range(num_recipients)]
+
+        for test_recipients in (recipients, recipients_lib.pack_recipients(recipients)):
+            for mode in ROUTE_MODES:
+                streamed = ''.join(iter_route_response_json(test_recipients, mode))
+                whole    = json_encoder.encode(build_route_response(test_recipients, mode)) + '\n'
+
+                if streamed != whole:
+                    print("\n")
+                    print("FAIL: %d recipients, mode %r: streamed body differs"
+                          % (num_recipients, mode))
+                    sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify streamed uploads are validated line by line
+    #
+    print("Verify check_stream_header() and iter_stream_recipients() reject bad lines...", end="")
+
+    not_a_header = "First line must be an object with a string 'message'"
+
+    for line, expected in ((b'{"message": "SH Rocks"}', None),
+                           (b'{"message": 1}',          not_a_header),
+                           (b'["SH Rocks"]',            not_a_header),
+                           (b'{"message": ',            "Invalid JSON")):
+        error = check_stream_header(line)
+        if (error is None) != (expected is None) or (error and not error.startswith(expected)):
+            print("\n")
+            print("FAIL: header %r gave error %r" % (line, error))
+            sys.exit(1)
+
+    bad_uploads = (
+        # Lines that only make a valid array when joined
+        ([b'"a","b"', b'"c', b'"'], "Invalid JSON"),
+        ([b'"+15555550000"', b'"+15555550001", "+15555550002"'], "Invalid JSON"),
+        ([b'"+15555550000"', b'1555'],   "1555 is not of type 'string'"),
+        ([b'"+15555550000"', b'"+15555550000"'], "Duplicate recipient +15555550000"),
+        ([b'', b'  '],                   "No recipients"),
+    )
+
+    for lines, expected in bad_uploads:
+        try:
+            list(iter_stream_recipients(iter(lines)))
+            error = None
+        except StreamError as exc:
+            error = str(exc)
+
+        if error is None or not error.startswith(expected):
+            print("\n")
+            print("FAIL: %r gave error %r, expected %r" % (lines, error, expected))
+            sys.exit(1)
+
+    # Errors end the response with an error line, after any routes already sent
+    lines = [b'"+1555%07d"' % index for index in range(STREAM_DECODE_LINES + 30)] + [b'"c']
+    response = [json.loads(line) for line in iter_route_stream(iter(lines))]
+
+    if (response[0] != {"message": RESPONSE_MESSAGE} or 'ip' not in response[1] or
+        not response[-1]['error'].startswith("Invalid JSON")):
+        print("\n")
+        print("FAIL: bad line didn't end the stream with an error line: %r" % response[-1])
+        sys.exit(1)
+
+    # Escapes and surrounding blanks still decode in the batched path
+    lines = [b'"+1555%07d"' % index for index in range(3000)] + [b' "\\u002b15559999999" ']
+    if list(iter_stream_recipients(iter(lines)))[-1] != "+15559999999":
+        print("\n")
+        print("FAIL: escaped recipient decoded wrongly")
+        sys.exit(1)
+
+    print("PASS")
@@ -1,13 +1,84 @@
 # Creates routing info for the SH challenge
 # Requires Python3
 
+import collections
+import functools
+import sys
+
+import hash_ring_lib
 import itertools_ext_lib
+import recipients_lib
 
 SUPER_BASE_IP  = "10.0.4."
 LARGE_BASE_IP  = "10.0.3."
 MEDIUM_BASE_IP = "10.0.2."
 SMALL_BASE_IP  = "10.0.1."
 
+# Usable host numbers per relay subnet (.1 through .254)
+MAX_HOSTS_PER_SUBNET = 254
+
+# Bin sizes, largest first
+BIN_SIZES = (25, 10, 5, 1)
+
+# Maximum number of (N, tier table) solutions remembered by solve_tier_counts()
+TIER_SOLVER_CACHE_SIZE = 4096
+
+# Maximum number of tier tables whose solver tables solve_tier_counts()
+# remembers.  Each holds an entry per recipient count up to the most
+# cost-efficient tier's size times the largest size, so far fewer are kept
+# than solutions.
+TIER_COST_TABLE_CACHE_SIZE = 32
+
+# Maximum number of route plan templates remembered by get_route_plan()
+ROUTE_PLAN_CACHE_SIZE = 512
+
+# Maximum number of affinity hash rings remembered by get_affinity_routes()
+AFFINITY_RING_CACHE_SIZE = 16
+
+# With backend='auto', NumPy-packed requests at least this large are routed
+# with the NumPy backend.  Measured with sh_bench/bench_numpy_binner.py.
+NUMPY_MIN_RECIPIENTS = 5000
+
+BACKENDS = ('auto', 'python', 'numpy')
+
+
+# A relay capacity tier.
+#   name    - Human readable tier name
+#   size    - Recipients per transaction (pkts/transaction)
+#   subnets - Tuple of relay subnets, each given as its first three octets
+#             including the last '.'.  Relays are numbered .1 to .254 in the
+#             first subnet, then spill into the next one.
+#   cost    - Cost of one transaction on this tier
+Tier = collections.namedtuple('Tier', ['name', 'size', 'subnets', 'cost'])
+
+
+def overflow_subnets(base_ip):
+    """
+    Return the relay subnets for a tier whose primary subnet is 'base_ip'.
+
+    Overflow subnets keep the tier's third octet and walk the second one, e.g.
+    "10.0.4." is followed by "10.1.4.", "10.2.4.", ... "10.255.4.".
+
+    @param str base_ip - Primary subnet, e.g. "10.0.4."
+
+    @returns tuple of subnet strings, 'base_ip' first
+
+    """
+    first, second, third = base_ip.split('.')[:3]
+
+    return (base_ip,) + tuple("%s.%d.%s." % (first, octet, third)
+                              for octet in range(int(second) + 1, 256))
+
+
+# Default tier table.  With equal per-transaction costs the solver minimizes the
+# number of transactions, which for these sizes is the largest-first split.
+DEFAULT_TIERS = (
+    Tier('super',  25, overflow_subnets(SUPER_BASE_IP),  1),
+    Tier('large',  10, overflow_subnets(LARGE_BASE_IP),  1),
+    Tier('medium',  5, overflow_subnets(MEDIUM_BASE_IP), 1),
+    Tier('small',   1, overflow_subnets(SMALL_BASE_IP),  1),
+)
+
 def binner(items):
     """
     Given a list of N items, split the elements of 'items' into 'bins' of the following
@@ -15,11 +86,13 @@ def binner(items):
 
     @param list items - list of N items
 
-    @returns four tuples:
-        tuple of subtuples of 25 elements each
-        tuple of subtuples of 10 elements each
-        tuple of subtuples of  5 elements each
-        tuple of single elements
+    @returns four itertools_ext_lib.ChunkView sequences:
+        sequence of sub-sequences of 25 elements each
+        sequence of sub-sequences of 10 elements each
+        sequence of sub-sequences of  5 elements each
+        sequence of single-element sub-sequences
+
+    Each sub-sequence is a slice of 'items', so it has the same type as 'items'.
 
     Note: Any or all of the returned sub-tuples can be empty
     
@@ -46,21 +119,301 @@ def binner(items):
     """
 
     # Split items into the largest bin first, splitting remainders into progressively
-    # smaller bins.
-    bin_25, remainder = itertools_ext_lib.div_mod(items,     25)
-    bin_10, remainder = itertools_ext_lib.div_mod(remainder, 10)
-    bin_5,  remainder = itertools_ext_lib.div_mod(remainder,  5)
-    bin_1,  remainder = itertools_ext_lib.div_mod(remainder,  1)
+    # smaller bins.  All bin boundaries are computed up front; each bin is a view
+    # onto 'items', so nothing is copied until a sub-sequence is accessed.
+    bin_25, bin_10, bin_5, bin_1 = itertools_ext_lib.cascade_split(items, BIN_SIZES)
 
     return bin_25, bin_10, bin_5, bin_1
 
 
-def get_routes(recipients):
+def sort_tiers(tiers):
+    """
+    Return 'tiers' as a tuple ordered largest tier first.
+
+    @param list tiers - Tier tuples, in any order
+
+    @returns tuple of Tier, largest 'size' first
+
+    """
+    tier_table = tuple(sorted(tiers, key=lambda tier: tier.size, reverse=True))
+
+    if not tier_table:
+        raise ValueError("At least one tier is required")
+
+    for tier in tier_table:
+        if tier.size <= 0:
+            raise ValueError("Tier %r has a non-positive size" % (tier.name,))
+
+    return tier_table
+
+
+@functools.lru_cache(maxsize=None)
+def _subnet_ips(subnet):
+    """
+    Precomputed, interned relay IPs .1 to .254 of 'subnet'.
+
+    @param str subnet - First three octets, including the last '.'
+
+    @returns tuple of MAX_HOSTS_PER_SUBNET IP strings
+
+    """
+    return tuple(sys.intern(subnet + "%d" % host)
+                 for host in range(1, MAX_HOSTS_PER_SUBNET + 1))
+
+
+def tier_ips(tier, count):
+    """
+    Return the first 'count' relay IPs of 'tier'.
+
+    IPs come from a per-subnet table built once, so no strings are formatted
+    per route.  Once a subnet's 254 hosts are used, allocation continues in
+    the tier's next subnet.
+
+    @param Tier tier  - Tier whose relays are wanted
+
+    @param int  count - Number of relay IPs wanted
+
+    @returns list of 'count' IP strings
+
+    Raises ValueError if the tier's subnets hold fewer than 'count' relays.
+
+    """
+    ips = []
+
+    for subnet in tier.subnets:
+        if len(ips) >= count:
+            break
+
+        ips.extend(_subnet_ips(subnet)[:count - len(ips)])
+
+    if len(ips) < count:
+        raise ValueError("Tier %r needs %d relays, but its subnets only hold %d"
+                         % (tier.name, count, len(ips)))
+
+    return ips
+
+
+
+def tier_ip(tier, index):
+    """
+    Return relay IP number 'index' (from 0) of 'tier', i.e. tier_ips(tier,
+    index + 1)[-1], without building the list.
+
+    Raises ValueError if the tier's subnets hold 'index' relays or fewer.
+
+    """
+    subnet_index, host_index = divmod(index, MAX_HOSTS_PER_SUBNET)
+
+    if subnet_index >= len(tier.subnets):
+        raise ValueError("Tier %r needs %d relays, but its subnets only hold %d"
+                         % (tier.name, index + 1, len(tier.subnets) * MAX_HOSTS_PER_SUBNET))
+
+    return _subnet_ips(tier.subnets[subnet_index])[host_index]
+
+def capacity_error(num_recipients, tier_table):
+    """
+    Check the relays of 'tier_table' can carry a request of 'num_recipients'
+    recipients, before any route is built.
+
+    @param int   num_recipients - Number of recipients in the request
+
+    @param tuple tier_table     - Tier tuples, largest first (see sort_tiers())
+
+    @returns str or None - Error message, or None if the request fits
+
+    """
+    try:
+        tier_counts = solve_tier_counts(num_recipients, tier_table)
+    except ValueError as exc:
+        return str(exc)
+
+    for tier, (size, count) in zip(tier_table, tier_counts):
+        relays = len(tier.subnets) * MAX_HOSTS_PER_SUBNET
+        if count > relays:
+            return ("%d recipients need %d relays on tier %r, but it only has %d"
+                    % (num_recipients, count, tier.name, relays))
+
+    return None
+
+
+@functools.lru_cache(maxsize=TIER_COST_TABLE_CACHE_SIZE)
+def _tier_cost_table(tier_table):
+    """
+    Solve the minimum-cost split for every recipient count up to the point
+    past which only the most cost-efficient tier needs to grow.
+
+    @param tuple tier_table - Tier tuples, largest first (see sort_tiers())
+
+    @returns (best_index, costs, choices)
+        best_index - index in 'tier_table' of the lowest cost-per-recipient tier
+        costs      - costs[n] is the minimum cost of splitting n recipients,
+                     or None if n can't be split exactly
+        choices    - choices[n] is the index of the tier holding one of the
+                     transactions in that minimum-cost split
+
+    Dev.Note: An optimal split never needs 'best size' or more transactions on
+    the other tiers: by the pigeonhole principle some of them would add up to a
+    multiple of the best tier's size, and could be swapped for best-tier
+    transactions at no extra cost.  Every other tier therefore contributes less
+    than best_size * max_size recipients, which bounds the table.
+
+    """
+    best_index = min(range(len(tier_table)),
+                     key=lambda index: (tier_table[index].cost / tier_table[index].size,
+                                        -tier_table[index].size))
+
+    bound = tier_table[best_index].size * tier_table[0].size
+
+    costs   = [None] * (bound + 1)
+    choices = [None] * (bound + 1)
+    costs[0] = 0
+
+    for num in range(1, bound + 1):
+        # Tiers are scanned largest first and only replaced by a strictly
+        # cheaper tier, so ties are broken in favor of larger tiers.
+        for index, tier in enumerate(tier_table):
+            if tier.size > num or costs[num - tier.size] is None:
+                continue
+
+            cost = costs[num - tier.size] + tier.cost
+            if costs[num] is None or cost < costs[num]:
+                costs[num]   = cost
+                choices[num] = index
+
+    return best_index, tuple(costs), tuple(choices)
+
+
+@functools.lru_cache(maxsize=TIER_SOLVER_CACHE_SIZE)
+def solve_tier_counts(num_items, tier_table):
+    """
+    Find the cheapest way of splitting 'num_items' recipients into full
+    transactions on the tiers in 'tier_table'.
+
+    @param int   num_items  - Number of recipients
+
+    @param tuple tier_table - Tier tuples, largest first (see sort_tiers())
+
+    @returns tuple of (size, count) pairs, one per tier, in 'tier_table' order
+
+    Results are memoized per (num_items, tier_table), and the underlying
+    dynamic programming table is built once per tier table, so repeated
+    requests never re-run the solver.
+
+    Raises ValueError if 'num_items' can't be split exactly, e.g. when there
+    is no tier of size 1.
+
+    Example usage:
+    solve_tier_counts(43, DEFAULT_TIERS) --> ((25,1), (10,1), (5,1), (1,3))
+
+    """
+    best_index, costs, choices = _tier_cost_table(tier_table)
+
+    best_size = tier_table[best_index].size
+    best_cost = tier_table[best_index].cost
+    bound     = len(costs) - 1
+
+    # Pick the cheapest remainder for the other tiers, leaving the rest to the
+    # most cost-efficient tier.  Ties go to the smallest remainder, i.e. the
+    # most transactions on the best tier.
+    best_remainder = None
+    best_total     = None
+
+    # Largest remainder covered by the table, then every smaller one
+    min_best_count = max(0, -(-(num_items - bound) // best_size))
+    remainder = num_items - min_best_count * best_size
+
+    while remainder >= 0:
+        if costs[remainder] is not None:
+            total = costs[remainder] + ((num_items - remainder) // best_size) * best_cost
+            if best_total is None or total <= best_total:
+                best_total     = total
+                best_remainder = remainder
+
+        remainder -= best_size
+
+    if best_remainder is None:
+        raise ValueError("%d recipients can't be split into tiers of sizes %r"
+                         % (num_items, [tier.size for tier in tier_table]))
+
+    counts = [0] * len(tier_table)
+    counts[best_index] = (num_items - best_remainder) // best_size
+
+    remainder = best_remainder
+    while remainder:
+        index = choices[remainder]
+        counts[index] += 1
+        remainder -= tier_table[index].size
+
+    return tuple((tier.size, count) for tier, count in zip(tier_table, counts))
+
+
+@functools.lru_cache(maxsize=ROUTE_PLAN_CACHE_SIZE)
+def get_route_plan(num_recipients, tier_table):
+    """
+    Build the route plan template for a request of 'num_recipients'
+    recipients.
+
+    The plan depends only on the recipient count and the tier table, so it is
+    kept in a bounded LRU cache.  get_routes() only has to slice the actual
+    recipients into it.
+
+    @param int   num_recipients - Number of recipients in the request
+
+    @param tuple tier_table     - Tier tuples, largest first (see sort_tiers())
+
+    @returns tuple of (ip, start, stop) tuples, one per route, where
+             recipients[start:stop] is the route's block of recipients
+
+    Example usage:
+    get_route_plan(12, DEFAULT_TIERS) --> (("10.0.3.1",  0, 10),
+                                           ("10.0.1.1", 10, 11),
+                                           ("10.0.1.2", 11, 12))
+
+    """
+    tier_counts = solve_tier_counts(num_recipients, tier_table)
+
+    plan  = []
+    start = 0
+
+    for tier, (size, count) in zip(tier_table, tier_counts):
+        for ip in tier_ips(tier, count):
+            plan.append((ip, start, start + size))
+            start += size
+
+    return tuple(plan)
+
+
+def route_plan_cache_info():
+    """
+    Report route plan cache statistics.
+
+    @returns functools cache info named tuple: (hits, misses, maxsize, currsize)
+
+    """
+    return get_route_plan.cache_info()
+
+
+def get_routes(recipients, tiers=DEFAULT_TIERS, backend='auto', scheduler=None):
     """
     Convert the list of recipient phone numbers to a dictionary of routes.
 
     @param list recipients - List of recipient phone numbers
 
+    @param list tiers      - Tier table describing the available relay
+                             capacities and their per-transaction costs.
+                             Defaults to DEFAULT_TIERS (25/10/5/1).
+
+    @param str  backend    - 'python', 'numpy', or 'auto' (NumPy for packed
+                             requests of NUMPY_MIN_RECIPIENTS or more).  The
+                             NumPy backend only applies to NumPy-packed
+                             recipients (see recipients_lib); anything else
+                             falls back to the pure-Python backend.
+
+    @param obj  scheduler  - Optional relay_scheduler_lib.RelayScheduler.
+                             When given, it picks each route's relay IP
+                             (balancing load across requests) and its tier
+                             table is used instead of 'tiers'.
+
     @returns dict - List of route dictionaries in the following format:
 
         {
@@ -92,58 +445,316 @@ def get_routes(recipients):
                            "+15555555551"]
         }
 
+    Routes are listed largest tier first.  Within a tier, relay IPs are
+    numbered from 1, spilling into the tier's overflow subnets past .254
+    (see tier_ips()), unless a scheduler assigns them.
+
     """
- 
-    
-    bin25, bin10, bin5, bin1 = binner(recipients)
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend %r, expected one of %r" % (backend, BACKENDS))
 
-    route_list = []
-    
-    # Iterate through the "25/Super" bin, creating dictionary entries
-    # add adding them to the route list
-    for index, block in enumerate(bin25):
-        ip_addr = SUPER_BASE_IP + "%d" % (index+1)
-        sub_dict = {}
-        sub_dict['ip'] = ip_addr
+    tier_table = sort_tiers(tiers) if scheduler is None else scheduler.tier_table
+
+    if _use_numpy(recipients, backend):
+        return _get_routes_numpy(recipients, tier_table, scheduler)
+
+    plan = get_route_plan(len(recipients), tier_table)
+
+    if scheduler is not None:
+        ips = _relay_ips(len(recipients), tier_table, scheduler)
+        return [{'ip': ip, 'recipients': recipients[start:stop]}
+                for ip, (_, start, stop) in zip(ips, plan)]
+
+    # Fill the recipients into the (cached) plan template
+    route_list = [{'ip': ip, 'recipients': recipients[start:stop]}
+                  for ip, start, stop in plan]
+
+    return route_list
+
+
+def get_compact_routes(num_recipients, tiers=DEFAULT_TIERS, scheduler=None):
+    """
+    Compact form of get_routes(): the routes of each tier as one block of
+    the recipient list plus the tier's relay IPs, instead of one route
+    dictionary per relay.  Only the number of recipients is needed, so the
+    result is O(routes) rather than O(recipients).
+
+    @param int  num_recipients - Number of recipients in the request
+
+    @param list tiers          - Tier table (see get_routes())
+
+    @param obj  scheduler      - Optional relay scheduler (see get_routes())
+
+    @returns list - One dictionary per tier with routes, largest first:
+
+        {"size": 25, "start": 0, "end": 50, "ips": ["10.0.4.1", "10.0.4.2"]}
+
+    Route k of a tier is relay ips[k] with recipients
+    [start + k*size, start + (k+1)*size); the tiers cover [0, num_recipients)
+    in get_routes() order.
+
+    Example usage:
+    get_compact_routes(12) --> [{"size": 10, "start":  0, "end": 10, "ips": ["10.0.3.1"]},
+                                {"size":  1, "start": 10, "end": 12,
+                                 "ips": ["10.0.1.1", "10.0.1.2"]}]
+
+    """
+    tier_table = sort_tiers(tiers) if scheduler is None else scheduler.tier_table
+    ips = _relay_ips(num_recipients, tier_table, scheduler)
+
+    compact_routes = []
+    start = 0
+    index = 0
+
+    for size, count in solve_tier_counts(num_recipients, tier_table):
+        if not count:
+            continue
+
+        compact_routes.append({'size': size, 'start': start, 'end': start + size * count,
+                               'ips': ips[index:index + count]})
+        start += size * count
+        index += count
+
+    return compact_routes
+
+
+def _use_numpy(recipients, backend):
+    """
+    Decide whether get_routes() can and should use the NumPy backend.
+
+    """
+    # Recipients can only be NumPy-packed if recipients_lib has imported NumPy
+    numpy = recipients_lib.numpy
+
+    if backend == 'python' or numpy is None:
+        return False
+
+    if not (isinstance(recipients, recipients_lib.PackedRecipients) and
+            isinstance(recipients.numbers, numpy.ndarray)):
+        return False
 
-        sub_dict['recipients'] = list(block)
+    return backend == 'numpy' or len(recipients) >= NUMPY_MIN_RECIPIENTS
 
-        route_list.append(sub_dict)
 
-    # Iterate through the "10/Large" bin, creating dictionary entries
-    # add adding them to the route list
-    for index, block in enumerate(bin10):
-        ip_addr = LARGE_BASE_IP + "%d" % (index+1)
-        sub_dict = {}
-        sub_dict['ip'] = ip_addr
+def numpy_binner(numbers, tiers=DEFAULT_TIERS):
+    """
+    NumPy version of binner(): split a 1-D array into one 2-D block per tier.
+
+    The first k*25 entries become a (k, 25) block, the next m*10 a (m, 10)
+    block and so on.  Every block is a reshaped view of 'numbers'; nothing is
+    copied.
+
+    @param ndarray numbers - 1-D NumPy array, e.g. packed phone numbers
+
+    @param list    tiers   - Tier table (see get_routes())
+
+    @returns tuple of 2-D arrays, one per tier, largest tier first
 
-        sub_dict['recipients'] = list(block)
+    """
+    tier_table  = sort_tiers(tiers)
+    tier_counts = solve_tier_counts(len(numbers), tier_table)
+
+    blocks = []
+    start  = 0
+
+    for size, count in tier_counts:
+        stop = start + size * count
+        blocks.append(numbers[start:stop].reshape(count, size))
+        start = stop
 
-        route_list.append(sub_dict)
+    return tuple(blocks)
 
-    # There will never be more than 1 entry in the 5/Medium bin.
-    # If an entry exists, add it to the route list
-    if bin5:
-        sub_dict = {}
-        sub_dict['ip'] = MEDIUM_BASE_IP + "1"
-        sub_dict['recipients'] = bin5[0]
 
-        route_list.append(sub_dict)
+def _get_routes_numpy(recipients, tier_table, scheduler=None):
+    """
+    NumPy backend of get_routes() for NumPy-packed recipients.
+
+    Each tier is one reshaped view; its rows are paired with the tier's relay
+    IPs, taken from the cached route plan or the scheduler.
 
-    # Iterate through the "1/Small" bin, creating dictionary entries
-    # add adding them to the route list
-    for index, block in enumerate(bin1):
-        ip_addr = SMALL_BASE_IP + "%d" % (index+1)
-        sub_dict = {}
-        sub_dict['ip'] = ip_addr
+    """
+    ips    = _relay_ips(len(recipients), tier_table, scheduler)
+    packed = recipients_lib.PackedRecipients
 
-        sub_dict['recipients'] = list(block)
+    route_list = []
+    start      = 0
 
-        route_list.append(sub_dict)
+    for block in numpy_binner(recipients.numbers, tier_table):
+        stop = start + len(block)
+        route_list.extend([{'ip': ip, 'recipients': packed(row)}
+                           for ip, row in zip(ips[start:stop], block)])
+        start = stop
 
     return route_list
 
 
+@functools.lru_cache(maxsize=ROUTE_PLAN_CACHE_SIZE)
+def _route_plan_ips(num_recipients, tier_table):
+    """
+    The relay IPs of get_route_plan(num_recipients, tier_table), in order.
+
+    """
+    return tuple(ip for ip, start, stop in get_route_plan(num_recipients, tier_table))
+
+
+def _relay_ips(num_recipients, tier_table, scheduler):
+    """
+    Relay IP of each route, in plan order: picked by 'scheduler' if there is
+    one, else the cached plan's.
+
+    """
+    if scheduler is None:
+        return _route_plan_ips(num_recipients, tier_table)
+
+    return scheduler.assign(solve_tier_counts(num_recipients, tier_table))
+
+
+def iter_routes(recipients, tiers=DEFAULT_TIERS, scheduler=None):
+    """
+    Lazy version of get_routes(): yield the route dictionaries one at a time,
+    in the same order, without building the whole route list.
+
+    @param list recipients - List of recipient phone numbers
+
+    @param list tiers      - Tier table (see get_routes())
+
+    @param obj  scheduler  - Optional relay scheduler (see get_routes()).
+                             Relays are assigned for the whole request up
+                             front.
+
+    @yields dict - {"ip": ..., "recipients": [...]}
+
+    """
+    tier_table = sort_tiers(tiers) if scheduler is None else scheduler.tier_table
+    plan = get_route_plan(len(recipients), tier_table)
+
+    if scheduler is None:
+        for ip, start, stop in plan:
+            yield {'ip': ip, 'recipients': recipients[start:stop]}
+        return
+
+    ips = _relay_ips(len(recipients), tier_table, scheduler)
+
+    for ip, (_, start, stop) in zip(ips, plan):
+        yield {'ip': ip, 'recipients': recipients[start:stop]}
+
+
+
+def iter_stream_routes(recipients, tiers=DEFAULT_TIERS):
+    """
+    Route recipients as they arrive, e.g. from a streamed upload.
+
+    A route on the largest tier is yielded as soon as enough recipients for
+    it have been read; the remaining recipients (fewer than the largest tier
+    size) are split across the smaller tiers at the end of the input.  Only
+    one route's worth of recipients is held at a time.
+
+    @param itr  recipients - Iterable of recipient phone numbers.  Generators
+                             are accepted; len() is never called.
+
+    @param list tiers      - Tier table (see get_routes())
+
+    @yields dict - {"ip": ..., "recipients": (...)}, in get_routes() order
+
+    The output matches get_routes() for tier tables where filling the
+    largest tier first is optimal, such as DEFAULT_TIERS.
+
+    """
+    tier_table = sort_tiers(tiers)
+    largest    = tier_table[0]
+
+    chunks = itertools_ext_lib.idiv_mod(recipients, largest.size)
+
+    for index, chunk in enumerate(chunks):
+        yield {'ip': tier_ip(largest, index), 'recipients': chunk}
+
+    remainder = chunks.remainder
+
+    for ip, start, stop in get_route_plan(len(remainder), tier_table):
+        yield {'ip': ip, 'recipients': remainder[start:stop]}
+
+
+@functools.lru_cache(maxsize=AFFINITY_RING_CACHE_SIZE)
+def _affinity_ring(tier, pool_size):
+    """
+    Consistent hash ring over the first 'pool_size' relays of 'tier'.
+
+    """
+    return hash_ring_lib.HashRing(tier_ips(tier, pool_size))
+
+
+def get_affinity_routes(recipients, tiers=DEFAULT_TIERS, pool_size=MAX_HOSTS_PER_SUBNET):
+    """
+    Affinity version of get_routes(): place recipients on relays with a
+    consistent hash ring per tier, so a phone number keeps going through the
+    same relay of a tier whatever the size of the request.
+
+    The tier mix is the route plan's (see solve_tier_counts()).  Recipients
+    are split between the tiers in ring order, largest tier first.  Each tier
+    has a fixed ring over its first 'pool_size' relays, and every recipient
+    goes to its ring relay.  A relay takes at most as many routes' worth of
+    recipients as the tier needs routes per ring relay; past that, a
+    recipient spills over to the next relay clockwise with room.
+
+    Routes hold only the recipients of their own relay, so besides its full
+    routes each relay may carry one partial route: a tier uses at most
+    min(pool_size, recipients) more routes than the plan.  The overhead is
+    fixed, so it shrinks relative to the plan as requests grow.  Relays carry
+    more than one route of a request once a tier needs more routes than it
+    has ring relays.
+
+    @param list recipients - List of recipient phone numbers, or
+                             recipients_lib.PackedRecipients
+
+    @param list tiers      - Tier table (see get_routes())
+
+    @param int  pool_size  - Relays per tier on its ring, taken in tier_ips()
+                             order
+
+    @returns list of route dictionaries, largest tier first (see get_routes())
+
+    """
+    tier_table  = sort_tiers(tiers)
+    tier_counts = solve_tier_counts(len(recipients), tier_table)
+
+    if isinstance(recipients, recipients_lib.PackedRecipients):
+        recipients = recipients.tolist()
+
+    # (ring position, recipient), in ring order
+    entries    = sorted((hash_ring_lib.key_point(recipient), recipient)
+                        for recipient in recipients)
+    start      = 0
+    route_list = []
+
+    for tier, (size, count) in zip(tier_table, tier_counts):
+        if not count:
+            continue
+
+        ring     = _affinity_ring(tier, min(pool_size, len(tier.subnets) * MAX_HOSTS_PER_SUBNET))
+        capacity = size * -(-count // len(ring))
+        buckets  = collections.defaultdict(list)
+
+        for point, recipient in entries[start:start + size * count]:
+            bucket = buckets[ring.node_for_point(point)]
+
+            if len(bucket) >= capacity:
+                for relay in ring.iter_nodes_from(point):
+                    bucket = buckets[relay]
+                    if len(bucket) < capacity:
+                        break
+
+            bucket.append(recipient)
+
+        start += size * count
+
+        for relay in ring.nodes:
+            bucket = buckets.get(relay, ())
+
+            for offset in range(0, len(bucket), size):
+                route_list.append({'ip': relay, 'recipients': bucket[offset:offset + size]})
+
+    return route_list
+
     
    
 if __name__ == '__main__':
@@ -264,4 +875,233 @@ if __name__ == '__main__':
  #                 exp_num_bin5_entries,
  #                 exp_num_bin1_entries))
 
+
+    #
+    # Verify solve_tier_counts() against an exhaustive minimum-cost search,
+    # using a fleet with extra 50 and 20 tiers and uneven costs
+    #
+    TEST_TIERS = sort_tiers(DEFAULT_TIERS + (Tier('jumbo', 50, ("10.0.6.",), 1.5),
+                                             Tier('bulk',  20, ("10.0.5.",), 1)))
+
+    print("Verify solve_tier_counts() finds minimum-cost splits...", end="")
+
+    min_costs = [0]
+    for num_items in range(1, MAX_LIST_LEN_TO_TEST):
+        min_costs.append(min(min_costs[num_items - tier.size] + tier.cost
+                             for tier in TEST_TIERS if tier.size <= num_items))
+
+    for num_items in range(0, MAX_LIST_LEN_TO_TEST):
+        counts = solve_tier_counts(num_items, TEST_TIERS)
+        cost = sum(tier.cost * count for tier, (size, count) in zip(TEST_TIERS, counts))
+
+        if (sum(size * count for size, count in counts) != num_items or
+            cost != min_costs[num_items]):
+            print("FAIL: solve_tier_counts(%d) returned %r (cost %r)"
+                  % (num_items, counts, cost))
+            print("FAIL: expected cost %r" % min_costs[num_items])
+            sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify get_routes() returns the same routes on a plan cache hit as on a
+    # miss, and that the hit is counted
+    #
+    print("Verify get_routes() plan cache hits...", end="")
+
+    get_route_plan.cache_clear()
+
+    test_recipients = ["+1555555%04d" % index for index in range(43)]
+    first_routes    = get_routes(test_recipients)
+    second_routes   = get_routes(test_recipients[::-1])
+
+    hits, misses, maxsize, currsize = route_plan_cache_info()
+
+    if ((hits, misses) != (1, 1) or
+        [route['ip'] for route in first_routes] != [route['ip'] for route in second_routes] or
+        second_routes[0]['recipients'] != test_recipients[::-1][:25]):
+        print("FAIL: cache hits=%d misses=%d" % (hits, misses))
+        print("FAIL: expected hits=1 misses=1")
+        sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify a blast needing more than 254 Super relays gets valid, unique IPs
+    #
+    num_items = 25 * 300
+
+    print("Verify get_routes() allocates valid IPs for %d recipients..." % num_items,
+          end="")
+
+    routes = get_routes(range(num_items))
+    ips    = [route['ip'] for route in routes]
+
+    if (len(set(ips)) != len(ips) or
+        max(int(ip.split('.')[3]) for ip in ips) > MAX_HOSTS_PER_SUBNET or
+        ips[MAX_HOSTS_PER_SUBNET] != "10.1.4.1"):
+        print("FAIL: invalid or duplicate relay IPs")
+        sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify capacity_error() accepts the largest request the relays can carry
+    #
+    print("Verify capacity_error() rejects requests past the relay capacity...", end="")
+
+    tier_table = sort_tiers(DEFAULT_TIERS)
+    max_items  = 25 * 256 * MAX_HOSTS_PER_SUBNET + 24
+
+    if (capacity_error(max_items, tier_table) is not None or
+        capacity_error(max_items + 1, tier_table) is None):
+        print("FAIL: capacity_error(%d) = %r, capacity_error(%d) = %r"
+              % (max_items, capacity_error(max_items, tier_table),
+                 max_items + 1, capacity_error(max_items + 1, tier_table)))
+        sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify compact routes expand to get_routes()
+    #
+    print("Verify get_compact_routes() expands to get_routes()...", end="")
+
+    for num_items in (0, 1, 12, 43, 999, 7500):
+        expanded = [(ip, list(range(tier['start'] + index * tier['size'],
+                                    tier['start'] + (index + 1) * tier['size'])))
+                    for tier in get_compact_routes(num_items)
+                    for index, ip in enumerate(tier['ips'])]
+
+        if expanded != [(route['ip'], list(route['recipients']))
+                        for route in get_routes(range(num_items))]:
+            print("FAIL: compact routes for %d recipients differ" % num_items)
+            sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify the NumPy backend returns the same routes as the Python backend
+    #
+    if recipients_lib.import_numpy() is not None:
+        print("Verify get_routes(backend='numpy') matches backend='python'...", end="")
+
+        for num_items in (1, 43, 999, 7500):
+            packed = recipients_lib.PackedRecipients.from_strings(
+                ["+1555%07d" % index for index in range(num_items)])
+
+            python_routes = [(route['ip'], route['recipients'].tolist())
+                             for route in get_routes(packed, backend='python')]
+            numpy_routes  = [(route['ip'], route['recipients'].tolist())
+                             for route in get_routes(packed, backend='numpy')]
+
+            if numpy_routes != python_routes:
+                print("FAIL: backends disagree for %d recipients" % num_items)
+                sys.exit(1)
+
+        print("PASS")
+
         
+
+    #
+    # Verify affinity routes bound relay loads and ignore request order
+    #
+    print("Verify get_affinity_routes() stays near the plan and ignores request order...", end="")
+
+    import random
+
+    def affinity_placements(items, **kwargs):
+        return {recipient: route['ip'] for route in get_affinity_routes(items, **kwargs)
+                for recipient in route['recipients']}
+
+    for num_items in (1, 43, 999, 7500, 30000):
+        items  = ["+1555%07d" % index for index in range(num_items)]
+        routes = get_affinity_routes(items)
+        plan   = get_routes(items)
+
+        shuffled = list(items)
+        random.shuffle(shuffled)
+
+        if sorted(recipient for route in routes for recipient in route['recipients']) != items:
+            print("FAIL: recipients lost or repeated for %d recipients" % num_items)
+            sys.exit(1)
+
+        # Tiers use the plan's sizes, plus at most one partial route per ring relay
+        plan_sizes = collections.Counter(len(route['recipients']) for route in plan)
+        max_routes = sum(count + min(MAX_HOSTS_PER_SUBNET, size * count)
+                         for size, count in plan_sizes.items())
+
+        if (len(routes) > max_routes or
+            any(len(route['recipients']) > 25 for route in routes)):
+            print("FAIL: %d routes for %d recipients, plan has %d"
+                  % (len(routes), num_items, len(plan)))
+            sys.exit(1)
+
+        if affinity_placements(shuffled) != affinity_placements(items):
+            print("FAIL: placements depend on request order for %d recipients" % num_items)
+            sys.exit(1)
+
+    # Large requests stay close to the plan
+    if len(get_affinity_routes(items)) > len(plan) * 1.1:
+        print("FAIL: %d routes for %d recipients, plan has %d"
+              % (len(get_affinity_routes(items)), len(items), len(plan)))
+        sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify affinity placements are stable across requests and relay changes
+    #
+    print("Verify get_affinity_routes() keeps recipients on their relays...", end="")
+
+    # A single recipient uses the small tier, like the plan
+    ring = _affinity_ring(sort_tiers(DEFAULT_TIERS)[-1], MAX_HOSTS_PER_SUBNET)
+    for item in ("+15555550000", "+15555550001", "+442071838750"):
+        if get_affinity_routes([item])[0]['ip'] != ring.node_for(item):
+            print("FAIL: %s not routed through its ring relay" % item)
+            sys.exit(1)
+
+    # Seeded, so the measured fractions don't vary between runs
+    rng = random.Random(19)
+
+    # The same numbers alone and inside a request 32 times larger, all on the
+    # super tier both times
+    numbers  = ["+1%010d" % rng.randrange(10**10) for _ in range(8000)]
+    alone    = affinity_placements(numbers[:250])
+    inside   = affinity_placements(numbers)
+    num_kept = sum(alone[number] == inside[number] for number in numbers[:250])
+
+    if num_kept < 250 * 0.95:
+        print("FAIL: only %d of 250 recipients kept their relay in a larger request" % num_kept)
+        sys.exit(1)
+
+    # Removing one of 254 relays should move about 1/254 of the recipients
+    items     = ["+1%010d" % rng.randrange(10**10) for _ in range(4000)]
+    before    = affinity_placements(items, pool_size=254)
+    after     = affinity_placements(items, pool_size=253)
+    num_moved = sum(before[item] != after[item] for item in items)
+
+    if num_moved > len(items) * 4 / 254:
+        print("FAIL: %d of %d recipients moved after removing a relay"
+              % (num_moved, len(items)))
+        sys.exit(1)
+
+    print("PASS")
+
+    #
+    # Verify streamed routing matches get_routes()
+    #
+    print("Verify iter_stream_routes() matches get_routes()...", end="")
+
+    for num_items in (0, 1, 24, 25, 43, 999, 7500):
+        items = ["+1555%07d" % index for index in range(num_items)]
+
+        streamed = [(route['ip'], list(route['recipients']))
+                    for route in iter_stream_routes(iter(items))]
+        expected = [(route['ip'], route['recipients']) for route in get_routes(items)]
+
+        if streamed != expected:
+            print("FAIL: streamed routes differ for %d recipients" % num_items)
+            sys.exit(1)
+
+    print("PASS")
@@ -0,0 +1,411 @@
+# asyncio server for the SH challenge
+# Requires Python3
+#
+# Serves the same /route and /route/batch contract as sh_server.py, using only
+# the standard library: asyncio.start_server plus a minimal HTTP/1.1
+# implementation with keep-alive.  Routing and validation are shared with the
+# Flask server through route_handler_lib.
+#
+# Usage:
+#   python sh_async_server.py [--host 0.0.0.0] [--port 5000] [--workers N]
+
+
+import argparse
+import asyncio
+import json
+import signal
+import traceback
+import urllib.parse
+
+import route_handler_lib
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 5000
+
+# Largest request head (request line + headers) accepted, in bytes
+MAX_HEADER_BYTES = 64 * 1024
+
+# Largest request body accepted, in bytes.  Bodies are read into memory
+# whole; 64 MB holds a JSON request of more recipients than the relays can
+# carry (see route_handler_lib.check_capacity()).
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# Seconds an idle keep-alive connection is held open, and a client may take
+# to send a request body
+KEEP_ALIVE_TIMEOUT = 75
+
+# Requests with bodies at least this large are handled on a worker thread, so
+# decoding and routing them doesn't hold up the event loop's other
+# connections.  Smaller ones are quicker to handle than to hand over.
+EXECUTOR_MIN_BODY_BYTES = 64 * 1024
+
+REASONS = {
+    100: 'Continue',
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+    500: 'Internal Server Error',
+}
+
+
+# Open connection tasks -> True while one of their requests is answered
+connections = {}
+
+# Set by drain_connections(): answer in-flight requests, then close
+draining = False
+
+
+class HTTPError(Exception):
+    """
+    Raised while reading a request that can't be handled.  The connection is
+    answered with 'status' and closed.
+
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status  = status
+        self.message = message
+
+
+def encode_json(obj):
+    """
+    Serialize 'obj' the way Flask's jsonify() does outside debug mode: sorted
+    keys, no spaces, and a trailing newline.
+
+    @param obj $obj - JSON-serializable object
+
+    @returns bytes
+
+    """
+    return (route_handler_lib.json_encoder.encode(obj) + '\n').encode('utf-8')
+
+
+def build_response(status, body, keep_alive, content_type='application/json'):
+    """
+    Build a complete HTTP/1.1 response.
+
+    @param int   $status       - HTTP status code
+
+    @param bytes $body         - Response body
+
+    @param bool  $keep_alive   - False to ask the client to close the connection
+
+    @param str   $content_type - Value of the Content-Type header
+
+    @returns bytes
+
+    """
+    head = ("HTTP/1.1 %d %s\r\n"
+            "Content-Type: %s\r\n"
+            "Content-Length: %d\r\n"
+            "%s"
+            "\r\n" % (status, REASONS.get(status, ''), content_type, len(body),
+                      '' if keep_alive else 'Connection: close\r\n'))
+
+    return head.encode('latin-1') + body
+
+
+def handle_request(method, path, headers, body, query=None):
+    """
+    Dispatch one request.
+
+    @param str   $method  - Request method, e.g. 'POST'
+
+    @param str   $path    - Request target, without any query string
+
+    @param dict  $headers - Request headers, lower-case names
+
+    @param bytes $body    - Request body
+
+    @param dict  $query   - Query string parameters, {name: [values]}
+
+    @returns (int, bytes) - HTTP status code and JSON response body
+
+    """
+    if path not in ('/route', '/route/batch'):
+        return 404, encode_json({"error": "Not found: %s" % path})
+
+    if method != 'POST':
+        return 405, encode_json({"error": "Method not allowed: %s" % method})
+
+    content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+
+    # NDJSON batch: one payload per line
+    if path == '/route/batch' and content_type == 'application/x-ndjson':
+        results = route_handler_lib.route_ndjson_batch(body)
+        return 200, encode_json({"results": results})
+
+    mode            = (query or {}).get('mode', ['plan'])[0]
+    response_format = (query or {}).get('format', ['full'])[0]
+
+    # Compact binary body, see route_handler_lib.PACKED_MIMETYPE
+    if path == '/route' and content_type == route_handler_lib.PACKED_MIMETYPE:
+        try:
+            payload = route_handler_lib.decode_packed_payload(body)
+        except ValueError as exc:
+            return 400, encode_json({"error": str(exc)})
+
+        response, status = route_handler_lib.route_payload(payload, mode, response_format)
+        return status, encode_json(response)
+
+    if content_type != 'application/json':
+        return 415, encode_json({"error": "Content-Type must be application/json"})
+
+    try:
+        payload = json.loads(body)
+    except ValueError as exc:
+        return 400, encode_json({"error": "Invalid JSON: %s" % exc})
+
+    if path == '/route/batch':
+        if not isinstance(payload, list):
+            return 400, encode_json({"error": "Batch body must be a JSON array"})
+
+        results = route_handler_lib.route_batch(payload)
+        return 200, encode_json({"results": results})
+
+    response, status = route_handler_lib.route_payload(payload, mode, response_format)
+
+    return status, encode_json(response)
+
+
+async def read_request(reader, writer):
+    """
+    Read one request from a connection.
+
+    @returns (method, path, query, version, headers, body), or None if the
+             client closed the connection between requests.  'query' is the
+             parsed query string, {name: [values]}.
+
+    Raises HTTPError on malformed requests, and on bodies over
+    MAX_BODY_BYTES.
+
+    """
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                      KEEP_ALIVE_TIMEOUT)
+    except asyncio.IncompleteReadError as exc:
+        if exc.partial.strip():
+            raise HTTPError(400, "Incomplete request")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(413, "Request head too large")
+    except asyncio.TimeoutError:
+        return None
+
+    lines = head.decode('latin-1').split('\r\n')
+
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HTTPError(400, "Malformed header line")
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise HTTPError(411, "Chunked request bodies are not supported")
+
+    try:
+        content_length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length")
+
+    if content_length < 0:
+        raise HTTPError(400, "Invalid Content-Length")
+
+    if content_length > MAX_BODY_BYTES:
+        raise HTTPError(413, "Request body larger than %d bytes" % MAX_BODY_BYTES)
+
+    # curl waits for this before sending large bodies
+    if headers.get('expect', '').lower() == '100-continue':
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    try:
+        body = await asyncio.wait_for(reader.readexactly(content_length),
+                                      KEEP_ALIVE_TIMEOUT)
+    except asyncio.IncompleteReadError:
+        raise HTTPError(400, "Incomplete request body")
+    except asyncio.TimeoutError:
+        raise HTTPError(408, "Timed out reading the request body")
+
+    path, _, query_string = target.partition('?')
+
+    return method, path, urllib.parse.parse_qs(query_string), version, headers, body
+
+
+async def handle_connection(reader, writer):
+    """
+    Serve requests on one client connection until either side closes it.
+
+    """
+    task = asyncio.current_task()
+    connections[task] = False
+
+    try:
+        while True:
+            try:
+                request = await read_request(reader, writer)
+            except HTTPError as exc:
+                writer.write(build_response(exc.status,
+                                            encode_json({"error": exc.message}),
+                                            keep_alive=False))
+                await writer.drain()
+                break
+
+            if request is None:
+                break
+
+            connections[task] = True
+
+            method, path, query, version, headers, body = request
+
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.0':
+                keep_alive = (connection == 'keep-alive')
+            else:
+                keep_alive = (connection != 'close')
+
+            try:
+                if len(body) >= EXECUTOR_MIN_BODY_BYTES:
+                    status, response_body = await asyncio.get_running_loop().run_in_executor(
+                        None, handle_request, method, path, headers, body, query)
+                else:
+                    status, response_body = handle_request(method, path, headers, body, query)
+            except Exception:
+                traceback.print_exc()
+                status, response_body = 500, encode_json({"error": "Internal server error"})
+
+            keep_alive = keep_alive and not draining
+
+            writer.write(build_response(status, response_body, keep_alive))
+            await writer.drain()
+
+            if not keep_alive:
+                break
+
+            connections[task] = False
+
+    except ConnectionError:
+        pass
+
+    finally:
+        connections.pop(task, None)
+        writer.close()
+
+
+async def drain_connections(timeout):
+    """
+    Let in-flight requests finish once the server has stopped accepting
+    connections.  Idle keep-alive connections are closed at once;
+    connections answering a request are closed after it.
+
+    @param float $timeout - Seconds to wait at most
+
+    """
+    global draining
+    draining = True
+
+    busy = []
+    for task, answering in list(connections.items()):
+        if answering:
+            busy.append(task)
+        else:
+            task.cancel()
+
+    if busy:
+        await asyncio.wait(busy, timeout=timeout)
+
+
+async def start(host=DEFAULT_HOST, port=DEFAULT_PORT, sock=None):
+    """
+    Start accepting connections.
+
+    @param socket $sock - Already listening socket to serve on instead of
+                          binding host:port (used by prefork workers)
+
+    @returns asyncio.Server
+
+    """
+    if sock is not None:
+        return await asyncio.start_server(handle_connection, sock=sock,
+                                          limit=MAX_HEADER_BYTES)
+
+    return await asyncio.start_server(handle_connection, host, port,
+                                      limit=MAX_HEADER_BYTES)
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, sock=None):
+    """
+    Run the server until cancelled.  See start() for the parameters.
+
+    """
+    server = await start(host, port, sock)
+
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(sock):
+    """
+    Serve on an inherited listening socket until SIGTERM/SIGINT, then let
+    in-flight requests finish.  Used by the prefork launcher.
+
+    """
+    import prefork_lib
+
+    async def serve_until_signalled():
+        server = await start(sock=sock)
+
+        stop = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        await stop.wait()
+
+        server.close()
+        await drain_connections(prefork_lib.DRAIN_TIMEOUT)
+
+    asyncio.run(serve_until_signalled())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="asyncio SH challenge server")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of prefork worker processes "
+                             "(default: serve from this process)")
+    parser.add_argument('--prewarm', action='store_true',
+                        help="warm up caches and deferred imports before "
+                             "opening the listening socket")
+    args = parser.parse_args()
+
+    if args.prewarm:
+        route_handler_lib.prewarm()
+
+    if args.workers > 0:
+        import prefork_lib
+
+        sock = prefork_lib.create_listening_socket(args.host, args.port)
+        prefork_lib.serve_prefork(sock, run_worker, args.workers)
+
+    else:
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
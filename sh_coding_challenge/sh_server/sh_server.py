@@ -4,50 +4,495 @@
 # Requires Python3
 
 
+import argparse
+import os
+import time
+
+import admission_lib
 import flask
-import jsonschema
+import flask.json.provider
+import metrics_lib
+import profiler_lib
+import recipients_lib
+import response_cache_lib
+import route_handler_lib
 import router_lib
-from SHJsonValidator import SHJsonValidator
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 5000
+
+
+class SHJSONProvider(flask.json.provider.DefaultJSONProvider):
+    """
+    Flask JSON provider that can also serialize packed recipient lists.
+
+    """
+    default = staticmethod(recipients_lib.json_default)
+
 
 app = flask.Flask(__name__)
+app.json = SHJSONProvider(app)
+
+#
+# Opt-in sampling profiler for /route: profile 1 in SH_PROFILE_SAMPLE_EVERY
+# requests.  Can also be changed at run time through /admin/profile.
+profiler = profiler_lib.SamplingProfiler(int(os.environ.get('SH_PROFILE_SAMPLE_EVERY', '0')))
+
+#
+# Opt-in cache of /route responses, so upstream retries of an identical
+# request (same body, or same Idempotency-Key header) skip validation and
+# routing.  SH_RESPONSE_CACHE is the maximum number of entries; 0 disables it.
+RESPONSE_CACHE_STATUSES = (200, 400)
+
+response_cache = None
+if int(os.environ.get('SH_RESPONSE_CACHE', '0')):
+    response_cache = response_cache_lib.ResponseCache(
+        max_entries=int(os.environ['SH_RESPONSE_CACHE']),
+        max_bytes=int(os.environ.get('SH_RESPONSE_CACHE_BYTES',
+                                     response_cache_lib.DEFAULT_MAX_BYTES)),
+        ttl=float(os.environ.get('SH_RESPONSE_CACHE_TTL', response_cache_lib.DEFAULT_TTL)))
+
+#
+# Opt-in admission control for /route, /route/batch and /route/stream: at
+# most SH_ADMISSION_MAX_RECIPIENTS recipients (estimated from body sizes) in
+# flight; requests over budget get an immediate 429.  0 disables it.  The
+# budget is for the whole server: under --workers N, each worker process
+# gets 1/N of it, since workers don't share their in-flight counts.
+admission = None
+if int(os.environ.get('SH_ADMISSION_MAX_RECIPIENTS', '0')):
+    admission = admission_lib.AdmissionController(
+        int(os.environ['SH_ADMISSION_MAX_RECIPIENTS']),
+        retry_after=int(os.environ.get('SH_ADMISSION_RETRY_AFTER',
+                                       admission_lib.DEFAULT_RETRY_AFTER)))
+
+#
+# Metrics, served at /metrics
+metrics = metrics_lib.Registry()
+
+phase_seconds = metrics.register(metrics_lib.HistogramFamily(
+    'sh_route_phase_seconds', "Time spent in each phase of a /route request",
+    'phase', ('parse', 'validate', 'route', 'serialize')))
+
+requests_total = metrics.register(metrics_lib.Counter(
+    'sh_requests_total', "Requests received, by endpoint", label='endpoint'))
+
+responses_total = metrics.register(metrics_lib.Counter(
+    'sh_responses_total', "Responses sent, by HTTP status", label='status'))
+
+recipients_total = metrics.register(metrics_lib.Counter(
+    'sh_recipients_total', "Recipients in valid /route requests"))
+
+metrics.register(metrics_lib.CounterFunc(
+    'sh_route_plan_cache_hits_total', "Route plan cache hits",
+    lambda: router_lib.route_plan_cache_info().hits))
+
+metrics.register(metrics_lib.CounterFunc(
+    'sh_route_plan_cache_misses_total', "Route plan cache misses",
+    lambda: router_lib.route_plan_cache_info().misses))
+
+if response_cache is not None:
+    metrics.register(metrics_lib.CounterFunc(
+        'sh_response_cache_hits_total', "Response cache hits",
+        lambda: response_cache.hits))
+
+    metrics.register(metrics_lib.CounterFunc(
+        'sh_response_cache_misses_total', "Response cache misses",
+        lambda: response_cache.misses))
+
+    metrics.register(metrics_lib.CounterFunc(
+        'sh_response_cache_evictions_total', "Response cache evictions",
+        lambda: response_cache.evictions))
+
+    metrics.register(metrics_lib.Gauge(
+        'sh_response_cache_bytes', "Bytes of cached response bodies",
+        lambda: response_cache.num_bytes))
+
+if admission is not None:
+    metrics.register(metrics_lib.Gauge(
+        'sh_admission_in_flight_requests', "Admitted /route requests in flight",
+        lambda: admission.in_flight_requests))
+
+    metrics.register(metrics_lib.Gauge(
+        'sh_admission_in_flight_recipients', "Estimated recipients of /route requests in flight",
+        lambda: admission.in_flight_recipients))
+
+    metrics.register(metrics_lib.CounterFunc(
+        'sh_admission_shed_total', "/route requests rejected with 429",
+        lambda: admission.shed))
+
+
+def should_stream(payload):
+    """
+    Decide whether to stream the response to a /route 'payload'.  Invalid
+    payloads are never streamed, so they still get a plain 400 response.
+
+    @param obj $payload - Decoded /route request body, JSON or packed
+
+    @returns bool
+
+    """
+    try:
+        num_recipients = len(payload['recipients'])
+    except (TypeError, KeyError):
+        return False
+
+    if (flask.request.args.get('stream') != '1' and
+        num_recipients < route_handler_lib.STREAM_MIN_RECIPIENTS):
+        return False
 
-json_validator = SHJsonValidator()
+    # decode_packed_payload() has already validated packed recipients
+    if isinstance(payload['recipients'], recipients_lib.PackedRecipients):
+        return True
+
+    return route_handler_lib.json_validator.is_valid(payload)
 
 
 @app.route('/route', methods=['POST'])
 def get_route():
-    
-    #
-    # Verify the payload is valid JSON
+    """
+    Route one message.  Large requests, or any request with '?stream=1', get
+    a streamed response so memory stays bounded and the first byte goes out
+    before all routes are built.
+
+    '?mode=affinity' places recipients on relays by consistent hashing of
+    their numbers instead of their position in the request.
+
+    '?format=compact' returns each tier's relay IPs and the block of
+    recipients they cover instead of echoing every recipient back.
+
+    Besides JSON, the body can use the compact binary format of
+    route_handler_lib.PACKED_MIMETYPE, which skips JSON parsing of the
+    recipients.  The response is JSON either way.
+
+    With admission control enabled, a request that doesn't fit in the
+    in-flight recipient budget gets an immediate 429 with Retry-After.
+
+    With the response cache enabled, a repeat of a recent request gets the
+    stored response body back unchanged.  Streamed responses aren't cached.
+
+    """
+    if flask.request.mimetype == route_handler_lib.PACKED_MIMETYPE:
+        return admit(serve_route, recipients_lib.PACKED_NUMBER_BYTES)
+
+    return admit(serve_route)
+
+
+def admit(serve, bytes_per_recipient=admission_lib.BYTES_PER_RECIPIENT):
+    """
+    Call 'serve' if admission control is off or the request fits in the
+    in-flight recipient budget, charging recipients estimated from the body
+    size until the response has been sent.  Otherwise answer 429 with
+    Retry-After without reading the body.
+
+    @param func $serve               - View returning the response
+
+    @param int  $bytes_per_recipient - Body bytes per recipient of the
+                                       request format
+
+    """
+    if admission is None:
+        return serve()
+
+    cost = admission_lib.estimate_recipients(flask.request.content_length,
+                                             admission.max_recipients, bytes_per_recipient)
+
+    if not admission.try_admit(cost):
+        response = flask.json.jsonify({"error": "Server overloaded, retry later"})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(admission.retry_after)
+        return response
+
     try:
-        json_validator.validate_input(flask.request.json)
+        response = flask.make_response(serve())
+    except BaseException:
+        admission.release(cost)
+        raise
+
+    # A streamed response is still being built after this returns
+    if response.is_streamed:
+        response.call_on_close(lambda: admission.release(cost))
+    else:
+        admission.release(cost)
+
+    return response
+
+
+def serve_route():
+    """
+    /route behind admission control: answer from the response cache, or
+    route the request.
+
+    """
+    if response_cache is None:
+        return profiler.call(handle_route)
+
+    request = flask.request
+    key = response_cache_lib.request_key(request.full_path, request.get_data(),
+                                         request.headers.get('Idempotency-Key'))
+
+    cached = response_cache.get(key)
+    if cached is not None:
+        status, body = cached
+        return flask.Response(body, status, mimetype='application/json')
+
+    response = flask.make_response(profiler.call(handle_route))
+
+    if not response.is_streamed and response.status_code in RESPONSE_CACHE_STATUSES:
+        response_cache.put(key, response.status_code, response.get_data())
+
+    return response
+
+
+def handle_route():
+    start = time.perf_counter()
+
+    if flask.request.mimetype == route_handler_lib.PACKED_MIMETYPE:
+        try:
+            payload = route_handler_lib.decode_packed_payload(flask.request.get_data())
+        except ValueError as exc:
+            return flask.json.jsonify({"error": str(exc)}), 400
+    else:
+        payload = flask.request.json
+
+    parsed = time.perf_counter()
+    phase_seconds['parse'].observe(parsed - start)
+
+    mode            = flask.request.args.get('mode', 'plan')
+    response_format = flask.request.args.get('format', 'full')
+
+    error = (route_handler_lib.check_mode(mode) or
+             route_handler_lib.check_format(response_format, mode))
+    if error is not None:
+        return flask.json.jsonify({"error": error}), 400
 
-    except jsonschema.exceptions.ValidationError as exc:
-        return flask.json.jsonify({"error": exc.message}), 400
-        
     #
-    # Decode request payload    
-    message    = flask.request.json['message'],
-    recipients = flask.request.json['recipients']
+    # Stream large responses.  Routing and serialization happen as the body
+    # is sent, so only the parse phase is recorded.  Compact responses are
+    # small enough to never need it.
+    if response_format == 'full' and should_stream(payload):
+        error = route_handler_lib.check_capacity(len(payload['recipients']))
+        if error is not None:
+            return flask.json.jsonify({"error": error}), route_handler_lib.CAPACITY_STATUS
+
+        recipients = route_handler_lib.prepare_recipients(payload)
+        recipients_total.inc(amount=len(recipients))
+        return flask.Response(route_handler_lib.iter_route_response_json(recipients, mode),
+                              mimetype='application/json')
 
     #
-    # Process payload
-    routes = router_lib.get_routes(recipients=recipients)
-    
+    # Validate payload
+    error = route_handler_lib.validate_payload(payload)
+
+    validated = time.perf_counter()
+    phase_seconds['validate'].observe(validated - parsed)
+
+    if error is not None:
+        return flask.json.jsonify({"error": error}), 400
+
+    error = route_handler_lib.check_capacity(len(payload['recipients']))
+    if error is not None:
+        return flask.json.jsonify({"error": error}), route_handler_lib.CAPACITY_STATUS
+
+    recipients = route_handler_lib.prepare_recipients(payload, response_format)
+    recipients_total.inc(amount=len(recipients))
+
     #
-    # Build response object
-    BASE_RESPONSE = {'message': 'SH Rocks'}
-    response = BASE_RESPONSE
-    response['routes'] = routes
+    # Process payload
+    response = route_handler_lib.build_route_response(recipients, mode, response_format)
 
-    # Send response    
+    routed = time.perf_counter()
+    phase_seconds['route'].observe(routed - validated)
+
+    # Send response
     response_json = flask.json.jsonify(response)
+
+    phase_seconds['serialize'].observe(time.perf_counter() - routed)
+
     return response_json
 
+@app.route('/route/batch', methods=['POST'])
+def get_route_batch():
+    """
+    Route many messages per request.  The body is either a JSON array of
+    /route payloads, or NDJSON (Content-Type: application/x-ndjson) with one
+    payload per line.  Results are returned in input order; a bad item gets
+    an error object without failing the rest of the batch.
+
+    Batches count against admission control like /route requests of the
+    same body size.
+
+    """
+    return admit(serve_route_batch)
+
+
+def serve_route_batch():
+    if flask.request.mimetype == 'application/x-ndjson':
+        results = route_handler_lib.route_ndjson_batch(flask.request.get_data())
+
+    else:
+        payloads = flask.request.json
+        if not isinstance(payloads, list):
+            return flask.json.jsonify({"error": "Batch body must be a JSON array"}), 400
+
+        results = route_handler_lib.route_batch(payloads)
+
+    return flask.json.jsonify({"results": results})
+
+@app.route('/route/stream', methods=['POST'])
+def get_route_stream():
+    """
+    Route one message from a streamed NDJSON upload (chunked transfer
+    encoding is fine).  The first line is {"message": ...}, every following
+    line one recipient as a JSON string:
+
+        {"message": "SH Rocks"}
+        "+15555550000"
+        "+15555550001"
+
+    Routes are sent back as NDJSON while the upload is still being read, so
+    the body is never held in memory; the client must read the response as
+    it uploads.  A bad header line gets a 400; errors found later end the
+    response with an {"error": ...} line.
+
+    Under admission control, an upload is charged until its response ends.
+    A chunked upload has no size to estimate from, so it is charged the
+    whole budget: it only starts when nothing else is in flight.
+
+    """
+    return admit(serve_route_stream)
+
+
+def serve_route_stream():
+    lines = route_handler_lib.iter_body_lines(flask.request.stream)
+
+    error = route_handler_lib.check_stream_header(next(lines, b''))
+    if error is not None:
+        return flask.json.jsonify({"error": error}), 400
+
+    return flask.Response(flask.stream_with_context(route_handler_lib.iter_route_stream(lines)),
+                          mimetype=route_handler_lib.NDJSON_MIMETYPE)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Serve request, recipient, status and per-phase latency metrics in the
+    Prometheus text format.
+
+    Metrics are kept per process.  Under --workers N each scrape is answered
+    by whichever worker accepts it, so it reports that worker's share of the
+    traffic only; the series are not summed across workers.
+
+    """
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    Control the /route sampling profiler.  Only served to local clients.
+
+        GET    /admin/profile               - Merged samples in pstats format
+        GET    /admin/profile?format=text   - Human readable summary
+        POST   /admin/profile?sample_every=N - Profile 1 in N requests (0 = off)
+        DELETE /admin/profile               - Discard accumulated samples
+
+    """
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+
+    if flask.request.method == 'POST':
+        try:
+            profiler.set_sample_every(int(flask.request.args['sample_every']))
+        except (KeyError, ValueError) as exc:
+            return flask.json.jsonify({"error": "Invalid sample_every: %s" % exc}), 400
+
+        return flask.json.jsonify({"sample_every": profiler.sample_every})
+
+    if flask.request.method == 'DELETE':
+        profiler.reset()
+        return flask.json.jsonify({"samples": profiler.num_samples})
+
+    if flask.request.args.get('format') == 'text':
+        return flask.Response(profiler.report(), mimetype='text/plain')
+
+    return flask.Response(profiler.stats_bytes(), mimetype='application/octet-stream',
+                          headers={'Content-Disposition': 'attachment; filename=route.pstats'})
+
+
+@app.after_request
+def count_response(response):
+    """
+    Count every request by endpoint and every response by status.
+
+    """
+    requests_total.inc(flask.request.endpoint)
+    responses_total.inc(response.status_code)
+
+    return response
+
+
+def prewarm():
+    """
+    Do the one-off work of the first requests before accepting traffic (see
+    route_handler_lib.prewarm()), including Flask's JSON serialization.
+
+    """
+    route_handler_lib.prewarm()
+
+    with app.app_context():
+        flask.json.jsonify({'message': route_handler_lib.RESPONSE_MESSAGE,
+                            'routes': router_lib.get_routes(["+15555550000"])})
+
+
+def run_worker(sock):
+    """
+    Serve the app on an inherited listening socket until SIGTERM/SIGINT,
+    then let in-flight requests finish.  Used by the prefork launcher.
+
+    @param socket $sock - Listening socket shared by all workers
+
+    """
+    import prefork_lib
+    import wsgi_drain_lib
+
+    host, port = sock.getsockname()[:2]
+    server = wsgi_drain_lib.DrainingWSGIServer(host, port, app, fd=sock.fileno())
+
+    prefork_lib.stop_on_signal(server.shutdown)
+    server.serve_forever()
+    server.drain(prefork_lib.DRAIN_TIMEOUT)
+    server.server_close()
+
 if __name__ == '__main__':
-    # Open server to world
-    app.run('0.0.0.0')
+
+    parser = argparse.ArgumentParser(description="SH challenge server")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of prefork worker processes; caches "
+                             "and /metrics are per worker "
+                             "(default: run Flask's single-process server)")
+    parser.add_argument('--prewarm', action='store_true',
+                        help="warm up caches and deferred imports before "
+                             "opening the listening socket")
+    args = parser.parse_args()
+
+    if args.prewarm:
+        prewarm()
+
+    if args.workers > 0:
+        import prefork_lib
+
+        # Split the admission budget between the workers before they fork
+        if admission is not None:
+            admission.max_recipients = max(1, admission.max_recipients // args.workers)
+
+        sock = prefork_lib.create_listening_socket(args.host, args.port)
+        prefork_lib.serve_prefork(sock, run_worker, args.workers)
+
+    else:
+        # Open server to world
+        app.run(args.host, args.port)
 
     # Keep server in Debug mode
     # app.run(debug=True)
-    
@@ -0,0 +1,126 @@
+# Draining werkzeug server for the SH challenge prefork workers
+# Requires Python3 and werkzeug
+#
+# werkzeug's ThreadedWSGIServer answers requests on daemon threads and
+# server_close() doesn't wait for them, so a worker that exits after shutdown
+# cuts off every response still being sent.  DrainingWSGIServer keeps track
+# of its connection threads and, after shutdown, closes idle keep-alive
+# connections and waits for the busy ones to finish their current request.
+
+
+import socket
+import threading
+import time
+
+import werkzeug.serving
+
+
+class DrainingRequestHandler(werkzeug.serving.WSGIRequestHandler):
+    """
+    Request handler that reports when it is answering a request, and ends
+    keep-alive connections once the server is draining.
+
+    """
+
+    def run_wsgi(self):
+        self.server.request_started(self.connection)
+
+        try:
+            super().run_wsgi()
+        finally:
+            if self.server.request_finished(self.connection):
+                self.close_connection = True
+
+
+class DrainingWSGIServer(werkzeug.serving.ThreadedWSGIServer):
+    """
+    ThreadedWSGIServer whose in-flight requests can be drained on shutdown.
+
+    Usage example:
+
+        server = DrainingWSGIServer(host, port, app, fd=sock.fileno())
+        ...                               # serve_forever(), then shutdown()
+        server.drain(timeout=8)
+        server.server_close()
+
+    """
+
+    def __init__(self, host, port, app, fd=None):
+        """
+        @param str $host - Interface to bind to
+
+        @param int $port - TCP port
+
+        @param obj $app  - WSGI application
+
+        @param int $fd   - Already listening socket to serve on instead of
+                           binding host:port
+
+        """
+        super().__init__(host, port, app, DrainingRequestHandler, fd=fd)
+
+        self.lock     = threading.Lock()
+        self.draining = False
+
+        # Connection socket -> True while one of its requests is answered
+        self.connections = {}
+        self.threads     = set()
+
+    def process_request_thread(self, request, client_address):
+        thread = threading.current_thread()
+
+        with self.lock:
+            self.connections[request] = False
+            self.threads.add(thread)
+
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.lock:
+                self.connections.pop(request, None)
+                self.threads.discard(thread)
+
+    def request_started(self, connection):
+        with self.lock:
+            self.connections[connection] = True
+
+    def request_finished(self, connection):
+        """
+        @returns bool - True if the connection should close now because the
+                        server is draining
+
+        """
+        with self.lock:
+            self.connections[connection] = False
+            return self.draining
+
+    def drain(self, timeout):
+        """
+        Wait for in-flight requests once serve_forever() has returned.
+
+        Idle keep-alive connections are closed at once; connections answering
+        a request are closed after it.
+
+        @param float $timeout - Seconds to wait at most
+
+        @returns int - Connections still open after 'timeout'
+
+        """
+        with self.lock:
+            self.draining = True
+            idle    = [connection for connection, busy in self.connections.items()
+                       if not busy]
+            threads = list(self.threads)
+
+        # Wakes the handler from its wait for the next request
+        for connection in idle:
+            try:
+                connection.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        return sum(thread.is_alive() for thread in threads)